@@ -0,0 +1,251 @@
+import os
+import socket
+import struct
+import threading
+import time
+
+HTTP_METHODS = (b'GET ', b'POST', b'PUT ', b'HEAD', b'DELE', b'PATC', b'OPTI', b'CONN', b'TRAC')
+
+LIMITS = {
+    'streams': int(os.getenv('ADMISSION_MAX_STREAMS', '2000')),
+    'pending': int(os.getenv('ADMISSION_MAX_PENDING', '256')),
+    'udp_sessions': int(os.getenv('ADMISSION_MAX_UDP_SESSIONS', '4096')),
+    'buffered_bytes': int(os.getenv('ADMISSION_MAX_BUFFERED_BYTES', str(256 * 1024 * 1024))),
+    'writer_bytes': int(os.getenv('ADMISSION_MAX_WRITER_BYTES', str(256 * 1024 * 1024))),
+}
+TUNNEL_LIMITS = {
+    'streams': int(os.getenv('ADMISSION_MAX_STREAMS_PER_TUNNEL', '500')),
+    'pending': int(os.getenv('ADMISSION_MAX_PENDING_PER_TUNNEL', '64')),
+    'udp_sessions': int(os.getenv('ADMISSION_MAX_UDP_SESSIONS_PER_TUNNEL', '1024')),
+    'buffered_bytes': int(os.getenv('ADMISSION_MAX_BUFFERED_BYTES_PER_TUNNEL', str(64 * 1024 * 1024))),
+    'writer_bytes': int(os.getenv('ADMISSION_MAX_WRITER_BYTES_PER_TUNNEL', str(64 * 1024 * 1024))),
+}
+# Connections over a limit wait this long for capacity before being rejected;
+# at most QUEUE_SIZE connections wait at once, the rest are rejected outright.
+QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '0.25'))
+QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', '64'))
+
+RESOURCES = ('streams', 'pending', 'udp_sessions', 'buffered_bytes', 'writer_bytes')
+STREAM = {'streams': 1, 'pending': 1}
+# try_admit_stream(): over a limit, but the caller may wait for capacity.
+QUEUED = 'queued'
+
+
+class AdmissionController:
+    """Global and per-tunnel caps on streams, opens, UDP sessions and buffers.
+
+    Every check-and-increment happens under one condition variable, so
+    limits are exact. Releases notify waiters, which is what lets a short
+    queue absorb bursts without spawning a thread per waiting connection.
+    """
+
+    def __init__(self, limits=None, tunnel_limits=None, queue_timeout=QUEUE_TIMEOUT, queue_size=QUEUE_SIZE):
+        self.limits = dict(limits or LIMITS)
+        self.tunnel_limits = dict(tunnel_limits or TUNNEL_LIMITS)
+        self.queue_timeout = queue_timeout
+        self.queue_size = queue_size
+        self._cond = threading.Condition(threading.Lock())
+        self._totals = dict.fromkeys(RESOURCES, 0)
+        self._tunnels = {}
+        self._queued = 0
+        self.decisions = {
+            kind: {'admitted': 0, 'queued': 0, 'rejected': 0}
+            for kind in ('stream', 'udp_session', 'bytes')
+        }
+        self.rejections = {}
+
+    def _usage(self, tunnel_id):
+        usage = self._tunnels.get(tunnel_id)
+        if usage is None:
+            usage = self._tunnels[tunnel_id] = dict.fromkeys(RESOURCES, 0)
+            usage['rejected'] = 0
+        return usage
+
+    def _blocked_by(self, usage, amounts):
+        for resource, amount in amounts.items():
+            if self._totals[resource] + amount > self.limits[resource]:
+                return f'global_{resource}'
+            if usage[resource] + amount > self.tunnel_limits[resource]:
+                return f'tunnel_{resource}'
+        return None
+
+    def _enqueue(self, kind, tunnel_id, amounts):
+        """True if the caller has taken one of the queue_size waiting slots."""
+        if self._blocked_by(self._usage(tunnel_id), amounts) is None or self._queued >= self.queue_size:
+            return False
+        self._queued += 1
+        self.decisions[kind]['queued'] += 1
+        return True
+
+    def _wait(self, tunnel_id, amounts):
+        """Wait in a queue slot for capacity; returns the reason it is still blocked, if any.
+
+        Usage is looked up again after every wait: _release() drops a
+        tunnel's entry once it is idle, and a dict held across the wait
+        would no longer be the one other connections are counted in.
+        """
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            reason = self._blocked_by(self._usage(tunnel_id), amounts)
+            while reason:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+                reason = self._blocked_by(self._usage(tunnel_id), amounts)
+            return reason
+        finally:
+            self._queued -= 1
+
+    def _decide(self, kind, tunnel_id, amounts, reason):
+        usage = self._usage(tunnel_id)
+        if reason:
+            self.decisions[kind]['rejected'] += 1
+            self.rejections[reason] = self.rejections.get(reason, 0) + 1
+            usage['rejected'] += 1
+            return reason
+
+        for resource, amount in amounts.items():
+            self._totals[resource] += amount
+            usage[resource] += amount
+        self.decisions[kind]['admitted'] += 1
+        return None
+
+    def _acquire(self, kind, tunnel_id, amounts, wait):
+        with self._cond:
+            if wait and self._enqueue(kind, tunnel_id, amounts):
+                reason = self._wait(tunnel_id, amounts)
+            else:
+                reason = self._blocked_by(self._usage(tunnel_id), amounts)
+            return self._decide(kind, tunnel_id, amounts, reason)
+
+    def _release(self, tunnel_id, amounts):
+        with self._cond:
+            usage = self._usage(tunnel_id)
+            for resource, amount in amounts.items():
+                self._totals[resource] = max(0, self._totals[resource] - amount)
+                usage[resource] = max(0, usage[resource] - amount)
+            if not usage['rejected'] and not any(usage[resource] for resource in RESOURCES):
+                del self._tunnels[tunnel_id]
+            self._cond.notify_all()
+
+    def admit_stream(self, tunnel_id, wait=True):
+        """Reserve a stream and a pending open; returns a rejection reason or None."""
+        return self._acquire('stream', tunnel_id, STREAM, wait)
+
+    def try_admit_stream(self, tunnel_id):
+        """admit_stream() that never blocks, for accept loops.
+
+        Returns None if admitted, a rejection reason, or QUEUED when the
+        connection may wait for capacity: the caller must then finish with
+        wait_stream() on a thread of its own.
+        """
+        with self._cond:
+            if self._enqueue('stream', tunnel_id, STREAM):
+                return QUEUED
+            return self._decide('stream', tunnel_id, STREAM, self._blocked_by(self._usage(tunnel_id), STREAM))
+
+    def wait_stream(self, tunnel_id):
+        """Finish admitting a connection try_admit_stream() queued; returns a rejection reason or None."""
+        with self._cond:
+            return self._decide('stream', tunnel_id, STREAM, self._wait(tunnel_id, STREAM))
+
+    def stream_opened(self, tunnel_id):
+        """The client acknowledged the open; it no longer counts as pending."""
+        self._release(tunnel_id, {'pending': 1})
+
+    def release_stream(self, tunnel_id, pending):
+        self._release(tunnel_id, {'streams': 1, 'pending': 1} if pending else {'streams': 1})
+
+    def admit_udp_session(self, tunnel_id):
+        return self._acquire('udp_session', tunnel_id, {'udp_sessions': 1}, wait=False)
+
+    def release_udp_session(self, tunnel_id, count=1):
+        self._release(tunnel_id, {'udp_sessions': count})
+
+    def reserve_bytes(self, tunnel_id, nbytes, wait=True):
+        """Account bytes held in memory on their way to or from the client.
+
+        Readers call this before handing data on; waiting here is the
+        backpressure that stops a single tunnel from filling memory.
+        """
+        return self._acquire('bytes', tunnel_id, {'buffered_bytes': nbytes}, wait)
+
+    def hold_writer_bytes(self, tunnel_id, nbytes):
+        """Account data from the client queued for a public socket.
+
+        The data is already in memory, so it is always counted; the return
+        value says whether that put the tunnel over its writer budget, in
+        which case the caller should pause the stream it came from.
+        """
+        with self._cond:
+            usage = self._usage(tunnel_id)
+            self._totals['writer_bytes'] += nbytes
+            usage['writer_bytes'] += nbytes
+            return (self._totals['writer_bytes'] > self.limits['writer_bytes']
+                    or usage['writer_bytes'] > self.tunnel_limits['writer_bytes'])
+
+    def release_writer_bytes(self, tunnel_id, nbytes):
+        self._release(tunnel_id, {'writer_bytes': nbytes})
+
+    def release_bytes(self, tunnel_id, nbytes):
+        self._release(tunnel_id, {'buffered_bytes': nbytes})
+
+    def metrics(self):
+        with self._cond:
+            return {
+                'limits': dict(self.limits),
+                'tunnel_limits': dict(self.tunnel_limits),
+                'totals': dict(self._totals),
+                'pressure': {
+                    resource: self._totals[resource] / self.limits[resource] if self.limits[resource] else 0.0
+                    for resource in RESOURCES
+                },
+                'queued_now': self._queued,
+                'decisions': {kind: dict(counts) for kind, counts in self.decisions.items()},
+                'rejections': dict(self.rejections),
+                'tunnels': {
+                    tunnel_id: dict(usage, pressure=max(
+                        usage[resource] / self.tunnel_limits[resource] if self.tunnel_limits[resource] else 0.0
+                        for resource in RESOURCES
+                    ))
+                    for tunnel_id, usage in self._tunnels.items()
+                }
+            }
+
+
+def reject_connection(client_socket, reason, message=None, http=False):
+    """Refuse an accepted connection as cheaply as possible.
+
+    Connections to HTTP tunnels (`http`), and others whose peer has already
+    sent an HTTP request line, get a 503 with Retry-After. Anything else is
+    reset so no FIN/TIME_WAIT is left behind; on a TCP tunnel that includes
+    an HTTP client whose request has not arrived yet at accept time.
+    """
+    try:
+        if not http:
+            client_socket.setblocking(False)
+            try:
+                http = client_socket.recv(4, socket.MSG_PEEK) in HTTP_METHODS
+            except (BlockingIOError, InterruptedError):
+                pass
+        if http:
+            client_socket.setblocking(True)
+            client_socket.settimeout(1.0)
+            body = (message or f'Server overloaded ({reason})').encode('utf-8')
+            client_socket.sendall(
+                b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nConnection: close\r\n'
+                + f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body
+            )
+        else:
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+    finally:
+        try:
+            client_socket.close()
+        except OSError:
+            pass
+
+
+admission = AdmissionController()
@@ -1,15 +1,34 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, Response, render_template, request, jsonify, send_file
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 from models import get_session, Tunnel, TunnelSession
 from proxy_server import get_proxy_instance
+from traffic_stats import traffic_accountant, RESOLUTIONS
+from socket_profiles import PROFILE_NAMES, resolve_profile, validate_custom_options
+from profiling import profiler, collapsed, dump_threads
+from handoff import HandoffServer, HttpServer, take_over, DRAIN_TIMEOUT, supported as handoff_supported
+from functools import wraps
+from datetime import timedelta
+import hmac
+import time
 from datetime import datetime
 import os
+import json
 import random
 import io
 import threading
 import requests
-from proxy_server import close_connection
+from proxy_server import (
+    EARLY_DATA_CAPABILITY, close_connection, connection_lock, mark_connection_ready, pause_stream, resume_stream,
+    stream_tunnel
+)
+from admission import admission
+from batching import (
+    BATCH_ENABLED, BATCH_CAPABILITY, ACK_CAPABILITY, PAUSE_CAPABILITY, WINDOW_BYTES, BatchSequencer, iter_batch
+)
+from http_mux import HTTP_CAPABILITY
+from recording import RECORDING_DIR, RECORDING_MAX_BYTES
+from sqlalchemy.exc import IntegrityError
 import socket
     
 app = Flask(__name__)
@@ -19,9 +38,39 @@ CORS(app)
 socketio = SocketIO(app, cors_allowed_origins="*", ping_timeout=120, ping_interval=25)
 
 connected_tunnels = {}
+# client sid -> BatchSequencer for the stream_batch events it sends
+inbound_batches = {}
 traffic_proxy = None
 # Prevent multiple pings from being scheduled or sent
 ping_scheduled = False
+# Listeners for tunnels that connected within this window are bound at boot,
+# before their clients reconnect, and released again if they do not return.
+PREWARM_WINDOW = int(os.getenv('TUNNEL_PREWARM_WINDOW', '3600'))
+PREWARM_TIMEOUT = float(os.getenv('TUNNEL_PREWARM_TIMEOUT', '600'))
+http_server = None
+# Admin endpoints (profiling, introspection) are disabled unless this is set.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+PROTOCOLS = ('TCP', 'UDP', 'BOTH', 'HTTP')
+TUNNEL_STATUSES = ('active', 'inactive')
+PUBLIC_PORT_RANGE = (10000, 60000)
+TUNNEL_PAGE_SIZE = 100
+TUNNEL_PAGE_MAX = 1000
+BULK_MAX_TUNNELS = int(os.getenv('BULK_MAX_TUNNELS', '5000'))
+# Tunnels one client connection may authenticate in a single tunnel_auth.
+CLIENT_MAX_TUNNELS = int(os.getenv('CLIENT_MAX_TUNNELS', '1000'))
+# Longest local service error kept from a client's service_health report.
+SERVICE_ERROR_MAX = 200
+
+def admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN to enable them'}), 403
+        supplied = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(supplied, ADMIN_TOKEN):
+            return jsonify({'error': 'Invalid admin token'}), 401
+        return view(*args, **kwargs)
+    return wrapper
 
 @app.route('/ping')
 def ping():
@@ -57,67 +106,237 @@ def ping():
 def index():
     return render_template('dashboard.html')
 
+def serialize_tunnel(tunnel, domain):
+    tunnel_info = connected_tunnels.get(tunnel.id) or {}
+    healthy = tunnel_info.get('service_healthy')
+    return {
+        'id': tunnel.id,
+        'name': tunnel.name,
+        'local_port': tunnel.local_port,
+        'public_port': tunnel.public_port,
+        'protocol': tunnel.protocol or 'TCP',
+        'socket_profile': tunnel.socket_profile or 'auto',
+        'public_ip': domain,
+        'status': tunnel.status,
+        # Reported by the connected client; 'unknown' for older clients.
+        'service_health': 'unknown' if healthy is None else ('up' if healthy else 'down'),
+        'service_error': tunnel_info.get('service_error'),
+        'service_rejections': traffic_proxy.service_rejections.get(tunnel.id, 0) if traffic_proxy else 0,
+        'verified': tunnel.verified,
+        'created_at': tunnel.created_at.isoformat() if tunnel.created_at else None,
+        'last_connected': tunnel.last_connected.isoformat() if tunnel.last_connected else None,
+        'verification_url': f"/verify/{tunnel.verification_code}" if not tunnel.verified else None
+    }
+
+def tunnel_filters(args):
+    """Build filters from the status/protocol/verified query args; returns (filters, error)."""
+    filters = []
+    status = args.get('status')
+    if status is not None:
+        if status not in TUNNEL_STATUSES:
+            return None, f"status must be one of {', '.join(TUNNEL_STATUSES)}"
+        filters.append(Tunnel.status == status)
+    protocol = args.get('protocol')
+    if protocol is not None:
+        if protocol not in PROTOCOLS:
+            return None, f"protocol must be one of {', '.join(PROTOCOLS)}"
+        filters.append(Tunnel.protocol == protocol)
+    verified = args.get('verified')
+    if verified is not None:
+        if verified not in ('true', 'false'):
+            return None, 'verified must be true or false'
+        filters.append(Tunnel.verified == (verified == 'true'))
+    return filters, None
+
+def page_args(args):
+    """Parse the limit/cursor query args; returns (limit, cursor, error)."""
+    limit = args.get('limit')
+    if limit is not None:
+        if not limit.isdecimal() or int(limit) < 1:
+            return None, None, 'limit must be a positive integer'
+        limit = min(int(limit), TUNNEL_PAGE_MAX)
+    cursor = args.get('cursor')
+    if cursor is not None:
+        # Tunnel ids are SQLite integers; anything wider cannot be bound.
+        if not cursor.isdecimal() or int(cursor) >= 2 ** 63:
+            return None, None, 'cursor must be a tunnel id'
+        cursor = int(cursor)
+    return limit, cursor, None
+
+def stream_tunnels(filters, domain):
+    """Yield matching tunnels as NDJSON without holding the whole list in memory."""
+    session = get_session()
+    try:
+        for tunnel in session.query(Tunnel).filter(*filters).order_by(Tunnel.id).yield_per(500):
+            yield json.dumps(serialize_tunnel(tunnel, domain)) + '\n'
+    finally:
+        session.close()
+
 @app.route('/api/tunnels', methods=['GET'])
 def get_tunnels():
+    """List tunnels.
+
+    Without `limit` or `cursor` this returns every matching tunnel as a JSON
+    array, as it always has. With them it returns one page ordered by id
+    plus the cursor for the next page; `format=ndjson` streams every
+    matching tunnel one per line.
+    """
+    filters, error = tunnel_filters(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+    domain = os.getenv('BASE_DOMAIN', 'localhost')
+    
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_tunnels(filters, domain), mimetype='application/x-ndjson')
+    
+    limit, cursor, error = page_args(request.args)
+    if error:
+        return jsonify({'error': error}), 400
     session = get_session()
     try:
-        domain = os.getenv('BASE_DOMAIN', 'localhost')
-        public_ip = domain.split('.')[0] if 'replit' in domain else 'localhost'
+        query = session.query(Tunnel).filter(*filters).order_by(Tunnel.id)
+        if limit is None and cursor is None:
+            return jsonify([serialize_tunnel(tunnel, domain) for tunnel in query])
         
-        tunnels = session.query(Tunnel).all()
-        result = []
-        for tunnel in tunnels:
-            result.append({
-                'id': tunnel.id,
-                'name': tunnel.name,
-                'local_port': tunnel.local_port,
-                'public_port': tunnel.public_port,
-                'protocol': getattr(tunnel, 'protocol', 'TCP'),
-                'public_ip': domain,
-                'status': tunnel.status,
-                'verified': tunnel.verified,
-                'created_at': tunnel.created_at.isoformat() if tunnel.created_at else None,
-                'last_connected': tunnel.last_connected.isoformat() if tunnel.last_connected else None,
-                'verification_url': f"/verify/{tunnel.verification_code}" if not tunnel.verified else None
-            })
-        return jsonify(result)
+        limit = limit or TUNNEL_PAGE_SIZE
+        if cursor is not None:
+            query = query.filter(Tunnel.id > cursor)
+        tunnels = query.limit(limit + 1).all()
+        has_more = len(tunnels) > limit
+        tunnels = tunnels[:limit]
+        return jsonify({
+            'tunnels': [serialize_tunnel(tunnel, domain) for tunnel in tunnels],
+            'next_cursor': tunnels[-1].id if has_more else None
+        })
     finally:
         session.close()
 
+def check_tunnel_spec(data):
+    if not data.get('name') or not data.get('local_port'):
+        return 'Name and local_port are required'
+    if data.get('protocol', 'TCP') not in PROTOCOLS:
+        return 'Protocol must be TCP, UDP, BOTH, or HTTP'
+    return check_socket_profile(data.get('socket_profile', 'auto'), data.get('socket_options'))
+
+def new_tunnel(data, public_port):
+    tunnel = Tunnel(
+        name=data['name'],
+        local_port=data['local_port'],
+        protocol=data.get('protocol', 'TCP'),
+        socket_profile=data.get('socket_profile', 'auto')
+    )
+    socket_options = data.get('socket_options')
+    tunnel.socket_options = json.dumps(socket_options) if socket_options else None
+    tunnel.public_port = public_port
+    return tunnel
+
+def created_tunnel(tunnel):
+    return {
+        'id': tunnel.id,
+        'name': tunnel.name,
+        'token': tunnel.token,
+        'local_port': tunnel.local_port,
+        'public_port': tunnel.public_port,
+        'protocol': tunnel.protocol,
+        'socket_profile': tunnel.socket_profile,
+        'verification_code': tunnel.verification_code,
+        'verification_url': f"/verify/{tunnel.verification_code}"
+    }
+
+def allocate_public_ports(session, count):
+    """Pick `count` unused public ports with one query; None if the range is full."""
+    used = {port for (port,) in session.query(Tunnel.public_port).filter(Tunnel.public_port.isnot(None))}
+    low, high = PUBLIC_PORT_RANGE
+    free = high - low + 1 - len(used)
+    if count > free:
+        return None
+    # Rejection sampling is fastest while the range is sparse; near full,
+    # sample from the explicit list of free ports instead.
+    if count + len(used) > free // 2:
+        return random.sample([port for port in range(low, high + 1) if port not in used], count)
+    ports = set()
+    while len(ports) < count:
+        port = random.randint(low, high)
+        if port not in used:
+            ports.add(port)
+    return list(ports)
+
 @app.route('/api/tunnels', methods=['POST'])
 def create_tunnel():
     session = get_session()
     try:
-        data = request.json
-        name = data.get('name')
-        local_port = data.get('local_port')
-        protocol = data.get('protocol', 'TCP')
-        
-        if not name or not local_port:
-            return jsonify({'error': 'Name and local_port are required'}), 400
+        data = request.json or {}
+        error = check_tunnel_spec(data)
+        if error:
+            return jsonify({'error': error}), 400
         
-        if protocol not in ['TCP', 'UDP', 'BOTH']:
-            return jsonify({'error': 'Protocol must be TCP, UDP, or BOTH'}), 400
-        
-        public_port = random.randint(10000, 60000)
+        public_port = random.randint(*PUBLIC_PORT_RANGE)
         while session.query(Tunnel).filter_by(public_port=public_port).first():
-            public_port = random.randint(10000, 60000)
+            public_port = random.randint(*PUBLIC_PORT_RANGE)
         
-        tunnel = Tunnel(name=name, local_port=local_port, protocol=protocol)
-        tunnel.public_port = public_port
+        tunnel = new_tunnel(data, public_port)
         session.add(tunnel)
         session.commit()
         
-        return jsonify({
-            'id': tunnel.id,
-            'name': tunnel.name,
-            'token': tunnel.token,
-            'local_port': tunnel.local_port,
-            'public_port': tunnel.public_port,
-            'protocol': tunnel.protocol,
-            'verification_code': tunnel.verification_code,
-            'verification_url': f"/verify/{tunnel.verification_code}"
-        }), 201
+        return jsonify(created_tunnel(tunnel)), 201
+    finally:
+        session.close()
+
+@app.route('/api/tunnels/bulk', methods=['POST'])
+def create_tunnels_bulk():
+    """Create many tunnels in one transaction; all or none are created."""
+    specs = (request.json or {}).get('tunnels')
+    if not isinstance(specs, list) or not specs:
+        return jsonify({'error': 'tunnels must be a non-empty list'}), 400
+    if len(specs) > BULK_MAX_TUNNELS:
+        return jsonify({'error': f'At most {BULK_MAX_TUNNELS} tunnels per request'}), 400
+    for index, spec in enumerate(specs):
+        error = check_tunnel_spec(spec) if isinstance(spec, dict) else 'must be an object'
+        if error:
+            return jsonify({'error': f'tunnels[{index}]: {error}'}), 400
+    
+    session = get_session()
+    try:
+        ports = allocate_public_ports(session, len(specs))
+        if ports is None:
+            return jsonify({'error': 'Not enough free public ports'}), 409
+        tunnels = [new_tunnel(spec, port) for spec, port in zip(specs, ports)]
+        session.add_all(tunnels)
+        try:
+            session.commit()
+        except IntegrityError:
+            # Another request took one of the ports first.
+            session.rollback()
+            return jsonify({'error': 'Public port allocation conflicted with a concurrent request; retry'}), 409
+        return jsonify({'tunnels': [created_tunnel(tunnel) for tunnel in tunnels]}), 201
+    finally:
+        session.close()
+
+@app.route('/api/tunnels/bulk', methods=['DELETE'])
+def delete_tunnels_bulk():
+    ids = (request.json or {}).get('ids')
+    if not isinstance(ids, list) or not all(
+            isinstance(tunnel_id, int) and not isinstance(tunnel_id, bool) for tunnel_id in ids):
+        return jsonify({'error': 'ids must be a list of tunnel ids'}), 400
+    if len(ids) > BULK_MAX_TUNNELS:
+        return jsonify({'error': f'At most {BULK_MAX_TUNNELS} tunnels per request'}), 400
+    
+    ids = set(ids)
+    session = get_session()
+    try:
+        deleted = set()
+        # Chunked to stay under SQLite's bound-parameter limit.
+        ordered = sorted(ids)
+        for chunk in (ordered[i:i + 500] for i in range(0, len(ordered), 500)):
+            deleted.update(tunnel_id for (tunnel_id,) in session.query(Tunnel.id).filter(Tunnel.id.in_(chunk)))
+            session.query(Tunnel).filter(Tunnel.id.in_(chunk)).delete(synchronize_session=False)
+        session.commit()
+        
+        for tunnel_id in deleted:
+            connected_tunnels.pop(tunnel_id, None)
+            if traffic_proxy:
+                traffic_proxy.stop_recording(tunnel_id)
+        return jsonify({'deleted': sorted(deleted), 'not_found': sorted(ids - deleted)})
     finally:
         session.close()
 
@@ -131,6 +350,8 @@ def delete_tunnel(tunnel_id):
         
         if tunnel_id in connected_tunnels:
             del connected_tunnels[tunnel_id]
+        if traffic_proxy:
+            traffic_proxy.stop_recording(tunnel_id)
         
         session.delete(tunnel)
         session.commit()
@@ -138,6 +359,160 @@ def delete_tunnel(tunnel_id):
     finally:
         session.close()
 
+@app.route('/api/tunnels/<int:tunnel_id>', methods=['PATCH'])
+def update_tunnel(tunnel_id):
+    session = get_session()
+    try:
+        tunnel = session.query(Tunnel).filter_by(id=tunnel_id).first()
+        if not tunnel:
+            return jsonify({'error': 'Tunnel not found'}), 404
+        
+        data = request.json or {}
+        socket_profile = data.get('socket_profile', tunnel.socket_profile or 'auto')
+        # Stored options belong to the custom profile; switching away drops them.
+        socket_options = data.get('socket_options', load_socket_options(tunnel) if socket_profile == 'custom' else None)
+        
+        error = check_socket_profile(socket_profile, socket_options)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        tunnel.socket_profile = socket_profile
+        tunnel.socket_options = json.dumps(socket_options) if socket_options else None
+        session.commit()
+        
+        # Takes effect for new listeners, i.e. the next time the client connects.
+        return jsonify({
+            'id': tunnel.id,
+            'socket_profile': tunnel.socket_profile,
+            'socket_options': resolve_profile(socket_profile, socket_options)
+        })
+    finally:
+        session.close()
+
+def check_socket_profile(socket_profile, socket_options):
+    if socket_profile not in PROFILE_NAMES:
+        return f"socket_profile must be one of {', '.join(PROFILE_NAMES)}"
+    if socket_profile != 'custom':
+        return 'socket_options are only accepted with the custom profile' if socket_options is not None else None
+    if socket_options is None:
+        return 'socket_options are required for the custom profile'
+    return validate_custom_options(socket_options)
+
+def load_socket_options(tunnel):
+    return json.loads(tunnel.socket_options) if tunnel.socket_options else None
+
+@app.route('/api/tunnels/<int:tunnel_id>/traffic', methods=['GET'])
+def get_tunnel_traffic(tunnel_id):
+    resolution = request.args.get('resolution')
+    if resolution is not None and resolution not in RESOLUTIONS:
+        return jsonify({'error': f"Resolution must be one of {', '.join(RESOLUTIONS)}"}), 400
+    
+    since = request.args.get('since', type=int)
+    until = request.args.get('until', type=int)
+    
+    return jsonify(traffic_accountant.query_series(
+        tunnel_id,
+        resolution=RESOLUTIONS[resolution] if resolution else None,
+        since=since,
+        until=until
+    ))
+
+@app.route('/api/traffic/summary', methods=['GET'])
+def get_traffic_summary():
+    since = request.args.get('since', type=int)
+    until = request.args.get('until', type=int)
+    return jsonify(traffic_accountant.query_totals(since=since, until=until))
+
+@app.route('/admin/profile', methods=['GET', 'POST'])
+@admin_required
+def admin_profile():
+    seconds = request.args.get('seconds', 10, type=float)
+    interval_ms = request.args.get('interval_ms', 5, type=float)
+    
+    try:
+        result = profiler.profile(seconds, interval_ms / 1000)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    if request.args.get('format') == 'json':
+        return jsonify({'samples': result['samples'], 'stacks': dict(result['stacks'].most_common())})
+    return Response(collapsed(result['stacks']), mimetype='text/plain')
+
+@app.route('/admin/threads', methods=['GET'])
+@admin_required
+def admin_threads():
+    describe = traffic_proxy.describe_thread if traffic_proxy else None
+    return jsonify({
+        'threads': dump_threads(describe),
+        'proxy': traffic_proxy.snapshot() if traffic_proxy else None,
+        'connected_tunnels': len(connected_tunnels)
+    })
+
+@app.route('/admin/locks', methods=['GET'])
+@admin_required
+def admin_locks():
+    stats = connection_lock.stats()
+    if request.args.get('reset'):
+        connection_lock.reset()
+    return jsonify({'locks': [stats]})
+
+@app.route('/admin/tunnels/<int:tunnel_id>/recording', methods=['GET', 'POST', 'DELETE'])
+@admin_required
+def admin_recording(tunnel_id):
+    proxy = ensure_traffic_proxy()
+    if request.method == 'GET':
+        recorder = proxy.recorders.get(tunnel_id)
+        return jsonify({'recording': recorder is not None, 'status': recorder.status() if recorder else None})
+    
+    if request.method == 'DELETE':
+        recorder = proxy.stop_recording(tunnel_id)
+        if recorder is None:
+            return jsonify({'error': 'Tunnel is not being recorded'}), 404
+        return jsonify({'recording': False, 'status': recorder.status()})
+    
+    session = get_session()
+    try:
+        if not session.query(Tunnel).filter_by(id=tunnel_id).first():
+            return jsonify({'error': 'Tunnel not found'}), 404
+    finally:
+        session.close()
+    
+    data = request.json or {}
+    for key in ('max_bytes', 'payload_bytes'):
+        if data.get(key) is not None and (not isinstance(data[key], int) or isinstance(data[key], bool)):
+            return jsonify({'error': f'{key} must be an integer'}), 400
+    # RECORDING_MAX_BYTES is the ceiling: the whole ring is allocated on disk up front.
+    if data.get('max_bytes') is not None and not 0 < data['max_bytes'] <= RECORDING_MAX_BYTES:
+        return jsonify({'error': f'max_bytes must be between 1 and {RECORDING_MAX_BYTES}'}), 400
+    if data.get('payload_bytes') is not None and data['payload_bytes'] < -1:
+        return jsonify({'error': 'payload_bytes must be -1 or more'}), 400
+    try:
+        recorder = proxy.start_recording(tunnel_id, data.get('max_bytes'), data.get('payload_bytes'))
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return jsonify({'recording': True, 'status': recorder.status()}), 201
+
+@app.route('/admin/tunnels/<int:tunnel_id>/recording/file', methods=['GET'])
+@admin_required
+def admin_recording_file(tunnel_id):
+    """Download the newest recording of a tunnel, finished or in progress."""
+    prefix = f'tunnel_{tunnel_id}_'
+    names = sorted(
+        name for name in (os.listdir(RECORDING_DIR) if os.path.isdir(RECORDING_DIR) else [])
+        if name.startswith(prefix) and name.endswith('.rec')
+    )
+    if not names:
+        return jsonify({'error': 'No recording for this tunnel'}), 404
+    return send_file(os.path.abspath(os.path.join(RECORDING_DIR, names[-1])), mimetype='application/octet-stream', as_attachment=True)
+
+@app.route('/api/metrics/admission', methods=['GET'])
+def get_admission_metrics():
+    return jsonify(admission.metrics())
+
+@app.route('/api/metrics/qos', methods=['GET'])
+def get_qos_metrics():
+    return jsonify(ensure_traffic_proxy().qos_metrics())
+
 @app.route('/client/<int:tunnel_id>')
 def download_client(tunnel_id):
     session = get_session()
@@ -263,6 +638,17 @@ def verify_tunnel(verification_code):
     finally:
         session.close()
 
+def close_tunnel_sessions(client_id=None):
+    session = get_session()
+    try:
+        query = session.query(TunnelSession).filter_by(is_active=True)
+        if client_id is not None:
+            query = query.filter_by(client_id=client_id)
+        query.update({'is_active': False, 'disconnected_at': datetime.utcnow()}, synchronize_session=False)
+        session.commit()
+    finally:
+        session.close()
+
 @socketio.on('connect')
 def handle_connect():
     print(f'Client connected: {request.sid}')
@@ -272,80 +658,242 @@ def handle_connect():
 def handle_disconnect():
     global traffic_proxy
     print(f'Client disconnected: {request.sid}')
-    for tunnel_id, data in list(connected_tunnels.items()):
-        if data.get('sid') == request.sid:
-            session = get_session()
-            try:
-                tunnel = session.query(Tunnel).filter_by(id=tunnel_id).first()
-                if tunnel:
-                    tunnel.status = 'inactive'
-                    session.commit()
-                    
-                    if traffic_proxy:
-                        traffic_proxy.stop_proxy_for_tunnel(tunnel_id, tunnel.public_port)
-            finally:
-                session.close()
+    close_tunnel_sessions(client_id=request.sid)
+    inbound_batches.pop(request.sid, None)
+    if traffic_proxy:
+        traffic_proxy.close_batcher(request.sid)
+    # A client serving several tunnels takes all of them down with it.
+    tunnel_ids = [tunnel_id for tunnel_id, data in list(connected_tunnels.items()) if data.get('sid') == request.sid]
+    if not tunnel_ids:
+        return
+    session = get_session()
+    try:
+        tunnels = session.query(Tunnel).filter(Tunnel.id.in_(tunnel_ids)).all()
+        for tunnel in tunnels:
+            tunnel.status = 'inactive'
+        session.commit()
+        
+        if traffic_proxy:
+            for tunnel in tunnels:
+                traffic_proxy.stop_proxy_for_tunnel(tunnel.id, tunnel.public_port)
+    finally:
+        session.close()
+    for tunnel_id in tunnel_ids:
+        if connected_tunnels.get(tunnel_id, {}).get('sid') == request.sid:
             del connected_tunnels[tunnel_id]
-            break
+
+def valid_auth_entry(entry):
+    tunnel_id = entry.get('tunnel_id') if isinstance(entry, dict) else None
+    return isinstance(tunnel_id, int) and not isinstance(tunnel_id, bool)
 
 @socketio.on('tunnel_auth')
 def handle_tunnel_auth(data):
     global traffic_proxy
-    token = data.get('token')
-    tunnel_id = data.get('tunnel_id')
-    local_port = data.get('local_port')
+    # Older clients send no capabilities and get one stream_data event per chunk.
+    capabilities = data.get('capabilities') or []
+    batching = BATCH_ENABLED and BATCH_CAPABILITY in capabilities
+    # Clients that acknowledge batches get a bounded send window (see batching.py).
+    window = WINDOW_BYTES if ACK_CAPABILITY in capabilities else None
+    # A client serving several tunnels sends their credentials as one list and
+    # gets one result per tunnel back; a single tunnel uses the flat form.
+    multi = 'tunnels' in data
+    requested = data.get('tunnels') if multi else [data]
+    if not isinstance(requested, list) or not requested or len(requested) > CLIENT_MAX_TUNNELS:
+        emit('auth_response', {'success': False, 'error': f'Send between 1 and {CLIENT_MAX_TUNNELS} tunnels'})
+        return
     
+    results = []
+    accepted = []
     session = get_session()
+    # The tunnels are read again below; without this each would be refreshed by its own query.
+    session.expire_on_commit = False
     try:
-        tunnel = session.query(Tunnel).filter_by(id=tunnel_id, token=token).first()
-        
-        if not tunnel:
-            emit('auth_response', {'success': False, 'error': 'Invalid tunnel credentials'})
-            return
-        
-        if not tunnel.verified:
-            emit('auth_response', {
-                'success': False, 
-                'error': 'Tunnel not verified',
-                'verification_url': f'/verify/{tunnel.verification_code}'
-            })
-            return
-        
-        tunnel.status = 'active'
-        tunnel.last_connected = datetime.utcnow()
+        ids = {entry.get('tunnel_id') for entry in requested if valid_auth_entry(entry)}
+        found = {tunnel.id: tunnel for tunnel in session.query(Tunnel).filter(Tunnel.id.in_(ids))}
+        for entry in requested:
+            if not valid_auth_entry(entry):
+                results.append({'success': False, 'tunnel_id': None, 'error': 'tunnel_id must be an integer'})
+                continue
+            tunnel_id = entry['tunnel_id']
+            tunnel = found.get(tunnel_id)
+            if not tunnel or not hmac.compare_digest(str(entry.get('token') or '').encode(), tunnel.token.encode()):
+                results.append({'success': False, 'tunnel_id': tunnel_id, 'error': 'Invalid tunnel credentials'})
+            elif not tunnel.verified:
+                results.append({
+                    'success': False,
+                    'tunnel_id': tunnel_id,
+                    'error': 'Tunnel not verified',
+                    'verification_url': f'/verify/{tunnel.verification_code}'
+                })
+            else:
+                tunnel.status = 'active'
+                tunnel.last_connected = datetime.utcnow()
+                session.add(TunnelSession(tunnel_id=tunnel_id, client_id=request.sid))
+                results.append(None)
+                accepted.append((len(results) - 1, tunnel, entry.get('local_port')))
         session.commit()
         
-        connected_tunnels[tunnel_id] = {
-            'sid': request.sid,
-            'local_port': local_port,
-            'public_port': tunnel.public_port,
-            'tunnel': tunnel
-        }
-        
-        tunnel_session = TunnelSession(
-            tunnel_id=tunnel_id,
-            client_id=request.sid
-        )
-        session.add(tunnel_session)
-        session.commit()
-        
-        if traffic_proxy is None:
-            traffic_proxy = get_proxy_instance(socketio, connected_tunnels)
-        
-        protocol = getattr(tunnel, 'protocol', 'TCP')
-        traffic_proxy.start_proxy_for_tunnel(tunnel_id, tunnel.public_port, protocol)
-        
+        if accepted:
+            traffic_proxy = ensure_traffic_proxy()
+            batcher = traffic_proxy.open_batcher(request.sid, window) if batching else None
+        for index, tunnel, local_port in accepted:
+            connected_tunnels[tunnel.id] = {
+                'sid': request.sid,
+                'local_port': local_port,
+                'public_port': tunnel.public_port,
+                'tunnel': tunnel,
+                'batcher': batcher,
+                'early_data': EARLY_DATA_CAPABILITY in capabilities,
+                'http_requests': HTTP_CAPABILITY in capabilities,
+                'stream_pause': PAUSE_CAPABILITY in capabilities,
+                # None until the client reports on its local service
+                'service_healthy': None,
+                'service_error': None
+            }
+            
+            protocol = getattr(tunnel, 'protocol', 'TCP')
+            socket_profile = tunnel.socket_profile or 'auto'
+            socket_options = load_socket_options(tunnel)
+            traffic_proxy.start_proxy_for_tunnel(tunnel.id, tunnel.public_port, protocol, socket_profile, socket_options)
+            
+            results[index] = {
+                'success': True,
+                'tunnel_id': tunnel.id,
+                'public_port': tunnel.public_port,
+                'protocol': protocol,
+                'socket_profile': socket_profile,
+                'socket_options': resolve_profile(socket_profile, socket_options),
+                'message': f'Tunnel active! {protocol} traffic on port {tunnel.public_port} will forward to your local port {local_port}'
+            }
+            print(f'Tunnel {tunnel.name} (ID: {tunnel.id}) connected. Public port: {tunnel.public_port} -> Local port: {local_port}')
+    finally:
+        session.close()
+    
+    capabilities = ([BATCH_CAPABILITY, ACK_CAPABILITY] if BATCH_ENABLED else []) + [
+        EARLY_DATA_CAPABILITY, HTTP_CAPABILITY, PAUSE_CAPABILITY
+    ]
+    if multi:
         emit('auth_response', {
-            'success': True,
-            'public_port': tunnel.public_port,
-            'protocol': protocol,
-            'message': f'Tunnel active! {protocol} traffic on port {tunnel.public_port} will forward to your local port {local_port}'
+            'success': bool(accepted),
+            'tunnels': results,
+            'capabilities': capabilities
         })
-        
-        print(f'Tunnel {tunnel.name} (ID: {tunnel_id}) connected. Public port: {tunnel.public_port} -> Local port: {local_port}')
-        
+    elif accepted:
+        emit('auth_response', dict(results[0], capabilities=capabilities))
+    else:
+        emit('auth_response', results[0])
+
+def ensure_traffic_proxy():
+    global traffic_proxy
+    if traffic_proxy is None:
+        traffic_proxy = get_proxy_instance(socketio, connected_tunnels)
+    return traffic_proxy
+
+def adopt_listeners(inherited_listeners):
+    proxy = ensure_traffic_proxy()
+    by_port = {}
+    for meta, listener in inherited_listeners:
+        entry = by_port.setdefault(meta['public_port'], {'meta': meta, 'sockets': {}})
+        entry['sockets'][meta['kind']] = listener
+    
+    for public_port, entry in by_port.items():
+        meta = entry['meta']
+        proxy.start_proxy_for_tunnel(
+            meta['tunnel_id'], public_port, meta['protocol'],
+            meta['socket_profile'], meta['socket_options'], inherited=entry['sockets']
+        )
+    return {entry['meta']['tunnel_id'] for entry in by_port.values()}
+
+def prewarm_tunnels(skip_tunnel_ids=()):
+    proxy = ensure_traffic_proxy()
+    session = get_session()
+    try:
+        tunnels = session.query(Tunnel).filter(
+            Tunnel.verified == True,
+            Tunnel.public_port.isnot(None),
+            Tunnel.last_connected >= datetime.utcnow() - timedelta(seconds=PREWARM_WINDOW)
+        ).all()
+        warmed = set(skip_tunnel_ids)
+        bound = 0
+        for tunnel in tunnels:
+            if tunnel.id in warmed:
+                continue
+            proxy.start_proxy_for_tunnel(
+                tunnel.id, tunnel.public_port, tunnel.protocol or 'TCP',
+                tunnel.socket_profile or 'auto', load_socket_options(tunnel)
+            )
+            warmed.add(tunnel.id)
+            bound += 1
     finally:
         session.close()
+    
+    if warmed:
+        print(f'[*] Pre-warmed listeners for {bound} recently active tunnels')
+        timer = threading.Timer(PREWARM_TIMEOUT, release_prewarmed_tunnels, args=(warmed,))
+        timer.daemon = True
+        timer.start()
+
+def release_prewarmed_tunnels(tunnel_ids):
+    for public_port, port_info in list(traffic_proxy.active_ports.items()):
+        if port_info['tunnel_id'] in tunnel_ids and port_info['tunnel_id'] not in connected_tunnels:
+            traffic_proxy.stop_proxy_for_tunnel(port_info['tunnel_id'], public_port)
+
+def begin_drain():
+    """Runs in the old process once a successor has taken over the listeners."""
+    traffic_proxy.begin_drain()
+    http_server.stop_accepting()
+    if DRAIN_TIMEOUT > 0:
+        print(f'[*] Draining in-flight streams (up to {DRAIN_TIMEOUT:.0f}s)')
+    else:
+        print('[*] Draining in-flight streams (until the last one closes)')
+    
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    released = set()
+    while DRAIN_TIMEOUT <= 0 or time.monotonic() < deadline:
+        # A client is told to reconnect, and re-authenticates against the new
+        # process, as soon as none of its tunnels has a stream left here.
+        busy = set()
+        for tunnel_id, data in list(connected_tunnels.items()):
+            if traffic_proxy.active_stream_count(tunnel_id):
+                busy.add(data.get('sid'))
+        for tunnel_id, data in list(connected_tunnels.items()):
+            sid = data.get('sid')
+            if sid not in released and sid not in busy:
+                socketio.emit('reconnect_required', {'reason': 'server restart'}, to=sid)
+                released.add(sid)
+        if traffic_proxy.active_stream_count() == 0 and not connected_tunnels:
+            break
+        time.sleep(0.2)
+    
+    remaining = traffic_proxy.active_stream_count()
+    if remaining:
+        cut = sorted(tunnel_id for tunnel_id in list(connected_tunnels) if traffic_proxy.active_stream_count(tunnel_id))
+        print(f'[!] DRAIN_TIMEOUT reached: exiting cuts {remaining} open streams (tunnels {cut})')
+    else:
+        print('[-] Drain finished; exiting')
+    traffic_accountant.stop()
+    os._exit(0)
+
+def run_graceful(port):
+    global http_server
+    inherited = take_over()
+    if inherited is None:
+        close_tunnel_sessions()
+    
+    listener = inherited.http_listener if inherited and inherited.http_listener else HttpServer.bind('0.0.0.0', port)
+    http_server = HttpServer(app, socketio.async_mode, listener)
+    adopted = adopt_listeners(inherited.listeners) if inherited else set()
+    prewarm_tunnels(skip_tunnel_ids=adopted)
+    if inherited:
+        inherited.confirm()
+    
+    HandoffServer(
+        export=lambda: (http_server.listener, ensure_traffic_proxy().export_listeners()),
+        on_handoff=begin_drain
+    ).start()
+    http_server.serve_forever()
+    # serve_forever returns once a successor took over; begin_drain exits the process.
+    threading.Event().wait()
 
 @socketio.on('stream_response')
 def handle_stream_response(data):
@@ -353,24 +901,99 @@ def handle_stream_response(data):
     conn_id = data.get('conn_id')
     response_data = data.get('data')
     
-    if conn_id and response_data:
+    if conn_id and response_data and owns_stream(request.sid, conn_id):
         proxy_handle_stream_response(conn_id, response_data)
 
+def apply_stream_batch(data, sid):
+    from proxy_server import handle_stream_response as proxy_handle_stream_response
+    # Runs on whichever handler thread drains the sequencer, so the
+    # client's sid is passed in rather than read from the request.
+    owned = {}
+    for conn_id, chunk in iter_batch(data):
+        if conn_id not in owned:
+            owned[conn_id] = owns_stream(sid, conn_id)
+        if not owned[conn_id]:
+            continue
+        if chunk is None:
+            close_connection(conn_id)
+        elif chunk:
+            proxy_handle_stream_response(conn_id, chunk)
+
+@socketio.on('stream_batch')
+def handle_stream_batch(data):
+    sid = request.sid
+    sequencer = inbound_batches.get(sid)
+    if sequencer is None:
+        sequencer = inbound_batches.setdefault(sid, BatchSequencer(
+            lambda payload: apply_stream_batch(payload, sid),
+            ack=lambda seq: socketio.emit('stream_batch_ack', {'seq': seq}, to=sid)
+        ))
+    sequencer.submit(data)
+
+@socketio.on('stream_batch_ack')
+def handle_stream_batch_ack(data):
+    batcher = traffic_proxy.batchers.get(request.sid) if traffic_proxy else None
+    if batcher is not None:
+        batcher.ack(data.get('seq', -1))
+
 @socketio.on('udp_response')
 def handle_udp_response(data):
     from proxy_server import handle_udp_response as proxy_handle_udp_response
     session_id = data.get('session_id')
     response_data = data.get('data')
     
-    if session_id and response_data:
+    if session_id and response_data and owns_stream(request.sid, session_id):
         proxy_handle_udp_response(session_id, response_data)
 
+@socketio.on('service_health')
+def handle_service_health(data):
+    healthy = bool(data.get('healthy'))
+    # Multi-tunnel clients name the tunnel; older clients serve only one.
+    only = data.get('tunnel_id')
+    error = None if healthy else str(data.get('error') or 'unreachable')[:SERVICE_ERROR_MAX]
+    for tunnel_id, tunnel_info in list(connected_tunnels.items()):
+        if tunnel_info.get('sid') == request.sid and only in (None, tunnel_id):
+            if tunnel_info.get('service_healthy') is not healthy:
+                print(f'[*] Tunnel {tunnel_id} local service is {"up" if healthy else "down"}'
+                      + ('' if healthy else f': {error}'))
+            tunnel_info['service_error'] = error
+            tunnel_info['service_healthy'] = healthy
+
+def owns_stream(sid, conn_id):
+    """Whether a stream, UDP session or HTTP request id belongs to one of this client's tunnels.
+
+    Ids come from one server-wide counter, so every event that names one is
+    checked; otherwise a client could write to or close other tunnels' streams.
+    """
+    if not isinstance(conn_id, int):
+        return False
+    tunnel_info = connected_tunnels.get(stream_tunnel(conn_id)) or {}
+    return tunnel_info.get('sid') == sid
+
+@socketio.on('pause_stream')
+def handle_pause_stream(data):
+    conn_id = data.get('conn_id')
+    if owns_stream(request.sid, conn_id):
+        pause_stream(conn_id)
+
+@socketio.on('resume_stream')
+def handle_resume_stream(data):
+    conn_id = data.get('conn_id')
+    if owns_stream(request.sid, conn_id):
+        resume_stream(conn_id)
+
+@socketio.on('connection_ready')
+def handle_connection_ready(data):
+    conn_id = data.get('conn_id')
+    if conn_id and owns_stream(request.sid, conn_id):
+        mark_connection_ready(conn_id)
+
 @socketio.on('close_connection')
 def handle_close_connection_from_client(data):
 
     conn_id = data.get('conn_id')
     
-    if conn_id:
+    if conn_id and owns_stream(request.sid, conn_id):
         close_connection(conn_id)
         print(f'[*] Client closed connection {conn_id}')
 
@@ -383,4 +1006,18 @@ if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_DEBUG', 'False').lower() in ('1', 'true', 'yes')
 
-    socketio.run(app, host='0.0.0.0', port=port, debug=debug)
+    graceful = os.environ.get('GRACEFUL_RESTART', 'False').lower() in ('1', 'true', 'yes')
+
+    traffic_accountant.start()
+
+    if graceful and not debug and handoff_supported() and socketio.async_mode in ('threading', 'eventlet'):
+        run_graceful(port)
+    else:
+        if graceful:
+            print('[!] Graceful restart needs a POSIX host, FLASK_DEBUG off and threading or eventlet mode; starting normally')
+        # Sessions left open by a previous run can never be closed by a disconnect.
+        close_tunnel_sessions()
+        # With the debug reloader only the child process serves traffic.
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            prewarm_tunnels()
+        socketio.run(app, host='0.0.0.0', port=port, debug=debug)
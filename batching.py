@@ -0,0 +1,530 @@
+import base64
+import collections
+import os
+import socket
+import threading
+import time
+
+from socket_profiles import QOS_CLASSES
+
+# Stream chunks for the same Socket.IO client are coalesced into one
+# 'stream_batch' event, flushed when BATCH_MAX_BYTES are queued or
+# BATCH_MAX_DELAY seconds after the first chunk, whichever comes first.
+BATCH_ENABLED = os.getenv('STREAM_BATCHING', 'True').lower() in ('1', 'true', 'yes')
+BATCH_MAX_BYTES = int(os.getenv('STREAM_BATCH_BYTES', '65536'))
+BATCH_MAX_DELAY = float(os.getenv('STREAM_BATCH_DELAY', '0.0005'))
+BATCH_CAPABILITY = 'stream_batch'
+ACK_CAPABILITY = 'batch_ack'
+
+# QoS: interactive frames (keystrokes, RDP updates) jump ahead of bulk ones.
+INTERACTIVE, BULK = QOS_CLASSES
+CHUNK_BYTES = int(os.getenv('QOS_CHUNK_BYTES', '16384'))
+BULK_MIN_SHARE = float(os.getenv('QOS_BULK_MIN_SHARE', '0.25'))
+# Bytes a peer may have received but not yet applied. Everything past the
+# batcher (Socket.IO queues, socket buffers) is FIFO, so this bounds how
+# long an interactive frame can wait behind bulk data; it should stay above
+# the link's bandwidth-delay product or it caps bulk throughput.
+WINDOW_BYTES = int(os.getenv('QOS_WINDOW_BYTES', str(512 * 1024)))
+
+# Frame length marking "this stream is closed" rather than a data chunk; it
+# travels in the batch so it can never overtake data queued before it.
+CLOSE_FRAME = -1
+
+# Applied frames are written to their sockets by per-stream StreamWriters, so
+# one peer that stops reading never holds up the other streams of a batch.
+# A writer asks the sender to pause its stream once STREAM_BUFFER_HIGH bytes
+# are waiting and to resume below a quarter of that. Data the sender had
+# already queued still arrives after a pause, so writes for a peer that
+# honours pauses never block (that would stall every stream behind it);
+# only a peer without PAUSE_CAPABILITY is held up past STREAM_BUFFER_MAX.
+PAUSE_CAPABILITY = 'stream_pause'
+STREAM_BUFFER_HIGH = int(os.getenv('STREAM_BUFFER_HIGH', str(1024 * 1024)))
+STREAM_BUFFER_LOW = STREAM_BUFFER_HIGH // 4
+STREAM_BUFFER_MAX = int(os.getenv('STREAM_BUFFER_MAX', str(8 * 1024 * 1024)))
+# Seconds a writer thread waits for more data before exiting.
+WRITER_IDLE = 2.0
+
+
+
+class OutboundBatcher:
+    """Coalesces stream chunks bound for one peer into batched emits.
+
+    Payload: {'seq': n, 'frames': [[conn_id, length], ...], 'data': base64}. The data
+    of every frame is concatenated and encoded once, so a batch is a single
+    websocket message however many streams it carries. (Binary attachments
+    would be sent as separate messages that other threads' emits can land
+    between.) One flush thread per peer emits batches in order; `seq` lets
+    the receiver apply them in that order (see BatchSequencer).
+
+    Frames queue per QoS class. Each batch is filled with interactive frames
+    first, except that queued bulk data always gets BULK_MIN_SHARE of it so
+    it cannot starve. Chunks are split at CHUNK_BYTES so one large read
+    never sits in front of a keystroke. Bulk data is held back while more
+    than `window` bytes are unacknowledged by a peer that sends
+    stream_batch_ack, so priority is decided here rather than in the FIFO
+    queues and socket buffers further down. Peers without acks get no
+    window: everything is handed to Socket.IO as soon as it is batched.
+
+    `on_flushed` receives {account: bytes} for each batch once the peer has
+    acknowledged it (once it has been handed to Socket.IO when there is no
+    window), or when it is dropped, so callers can release buffer budgets.
+    """
+
+    def __init__(self, emit, name, max_bytes=BATCH_MAX_BYTES, max_delay=BATCH_MAX_DELAY, on_flushed=None,
+                 window=None):
+        self._emit = emit
+        self.name = name
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._on_flushed = on_flushed
+        self.window = window
+        # (seq, bytes sent up to and including it, accounts) for unacknowledged batches
+        self._unacked = collections.deque()
+        self._sent_total = 0
+        self._acked_total = 0
+        self._cond = threading.Condition(threading.Lock())
+        # class -> [(conn_id, data or None for a close, account, queued_at)]
+        self._queues = {qos: [] for qos in QOS_CLASSES}
+        # conn_id -> [class, frames queued]; a stream stays in its class until
+        # those frames are sent so reclassifying it never reorders its data.
+        self._streams = {}
+        self._size = 0
+        self._deadline = 0.0
+        self._closed = False
+        # the flusher is waiting for the window to open
+        self._window_wait = False
+        self._seq = 0
+        self.batches = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.size_flushes = 0
+        self.transport_waits = 0
+        self.class_stats = {qos: _ClassStats() for qos in QOS_CLASSES}
+        self._thread = threading.Thread(target=self._run, name=f'batch-flush-{name}', daemon=True)
+        self._thread.start()
+
+    def send(self, conn_id, data, account=None, qos=INTERACTIVE):
+        if len(data) <= CHUNK_BYTES:
+            return self._put(conn_id, [data], account, qos)
+        view = memoryview(data)
+        return self._put(conn_id, [bytes(view[i:i + CHUNK_BYTES]) for i in range(0, len(data), CHUNK_BYTES)], account, qos)
+
+    def send_close(self, conn_id, qos=INTERACTIVE):
+        return self._put(conn_id, [None], None, qos)
+
+    def _put(self, conn_id, chunks, account, qos):
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                return False
+            stream = self._streams.get(conn_id)
+            if stream is None:
+                stream = self._streams[conn_id] = [qos, 0]
+            stream[1] += len(chunks)
+            queue = self._queues[stream[0]]
+            was_empty = self._size == 0 and not any(self._queues.values())
+            added = 0
+            for chunk in chunks:
+                queue.append((conn_id, chunk, account, now))
+                added += len(chunk) if chunk else 0
+            self._size += added
+            # Only wake the flusher when its decision changes: the first frame
+            # starts the deadline, crossing max_bytes ends it early.
+            if was_empty:
+                self._deadline = now + self.max_delay
+                self._cond.notify()
+            elif self._size >= self.max_bytes > self._size - added:
+                self._cond.notify()
+            elif self._window_wait and stream[0] == INTERACTIVE:
+                self._cond.notify()
+            return True
+
+    def close(self):
+        """Stop the flush thread; anything still queued is dropped."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _pop(self, qos, limit, batch, now):
+        queue = self._queues[qos]
+        stats = self.class_stats[qos]
+        taken = count = 0
+        while count < len(queue) and taken < limit:
+            conn_id, data, account, queued_at = queue[count]
+            size = len(data) if data else 0
+            taken += size
+            count += 1
+            stats.record(size, now - queued_at)
+            stream = self._streams[conn_id]
+            stream[1] -= 1
+            if stream[1] == 0:
+                del self._streams[conn_id]
+            batch.append((conn_id, data, account))
+        del queue[:count]
+        return taken
+
+    def _take(self, bulk_allowed):
+        with self._cond:
+            while not any(self._queues.values()) and not self._closed:
+                self._cond.wait()
+            while not self._closed and self._size < self.max_bytes:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._closed:
+                batch = [entry[:3] for queue in self._queues.values() for entry in queue]
+                for queue in self._queues.values():
+                    queue.clear()
+                self._streams.clear()
+                self._size = 0
+                return batch, True
+
+            batch = []
+            now = time.monotonic()
+            if bulk_allowed:
+                bulk_share = int(self.max_bytes * BULK_MIN_SHARE) if self._queues[BULK] else 0
+                size = self._pop(INTERACTIVE, self.max_bytes - bulk_share, batch, now)
+                size += self._pop(BULK, self.max_bytes - size, batch, now)
+                size += self._pop(INTERACTIVE, self.max_bytes - size, batch, now)
+            else:
+                size = self._pop(INTERACTIVE, self.max_bytes, batch, now)
+            self._size -= size
+            if size >= self.max_bytes:
+                self.size_flushes += 1
+            if any(self._queues.values()):
+                self._deadline = now
+            return batch, False
+
+    def ack(self, seq):
+        """The peer applied every batch up to `seq`."""
+        acked = []
+        with self._cond:
+            while self._unacked and self._unacked[0][0] <= seq:
+                _, self._acked_total, accounts = self._unacked.popleft()
+                if accounts:
+                    acked.append(accounts)
+            if self._window_wait:
+                self._cond.notify()
+        if self._on_flushed is not None:
+            for accounts in acked:
+                self._on_flushed(accounts)
+
+    @property
+    def in_flight(self):
+        return self._sent_total - self._acked_total
+
+    def _window_full(self):
+        return self.window is not None and self.in_flight >= self.window
+
+    def _wait_for_transport(self):
+        """Wait until bulk data may be sent; returns False if interactive frames cut in."""
+        # Batches handed to Socket.IO are written in FIFO order; keeping at
+        # most a window of them unacknowledged bounds how long a new
+        # interactive frame can be stuck behind bulk data already emitted.
+        # Interactive-only batches are small and are never held back. ack()
+        # and interactive send()s wake this wait.
+        with self._cond:
+            if self._closed or not self._window_full():
+                return True
+            self.transport_waits += 1
+            self._window_wait = True
+            try:
+                while not self._closed and self._window_full():
+                    if self._queues[INTERACTIVE]:
+                        return False
+                    self._cond.wait()
+                return True
+            finally:
+                self._window_wait = False
+
+    def _run(self):
+        while True:
+            bulk_allowed = self._wait_for_transport()
+            batch, closed = self._take(bulk_allowed)
+            accounts = {}
+            for _, data, account in batch:
+                if account is not None:
+                    accounts[account] = accounts.get(account, 0) + len(data)
+            try:
+                if batch and not closed:
+                    frames = [[conn_id, CLOSE_FRAME if data is None else len(data)] for conn_id, data, _ in batch]
+                    data = b''.join(data for _, data, _ in batch if data)
+                    self._emit({
+                        'seq': self._seq,
+                        'frames': frames,
+                        'data': base64.b64encode(data).decode('ascii')
+                    })
+                    if self.window is not None:
+                        # Budgets are released by ack() once the peer has the batch.
+                        with self._cond:
+                            self._sent_total += len(data)
+                            self._unacked.append((self._seq, self._sent_total, accounts))
+                        accounts = None
+                    self._seq += 1
+                    self.batches += 1
+                    self.frames_sent += len(frames)
+                    self.bytes_sent += len(data)
+            except Exception as e:
+                print(f'[!] Error flushing stream batch for {self.name}: {e}')
+            finally:
+                if accounts and self._on_flushed is not None:
+                    self._on_flushed(accounts)
+            if closed:
+                with self._cond:
+                    unacked = [accounts for _, _, accounts in self._unacked if accounts]
+                    self._unacked.clear()
+                if self._on_flushed is not None:
+                    for accounts in unacked:
+                        self._on_flushed(accounts)
+                return
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'frames': self.frames_sent,
+            'bytes': self.bytes_sent,
+            'frames_per_batch': self.frames_sent / self.batches if self.batches else 0.0,
+            'size_flushes': self.size_flushes,
+            'transport_waits': self.transport_waits,
+            'in_flight_bytes': self.in_flight,
+            'queued_frames': {qos: len(queue) for qos, queue in self._queues.items()},
+            'classes': {qos: stats.snapshot() for qos, stats in self.class_stats.items()},
+        }
+
+
+class _ClassStats:
+    """Queueing delay for one QoS class: time from send() to the batch."""
+
+    __slots__ = ('frames', 'bytes', 'total_delay', 'max_delay', 'recent_delay')
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+        self.recent_delay = 0.0
+
+    def record(self, nbytes, delay):
+        self.frames += 1
+        self.bytes += nbytes
+        self.total_delay += delay
+        if delay > self.max_delay:
+            self.max_delay = delay
+        # Exponentially weighted so the metric reflects the last few hundred frames.
+        self.recent_delay += (delay - self.recent_delay) * 0.01
+
+    def merge(self, other):
+        self.frames += other.frames
+        self.bytes += other.bytes
+        self.total_delay += other.total_delay
+        self.max_delay = max(self.max_delay, other.max_delay)
+        self.recent_delay = max(self.recent_delay, other.recent_delay)
+
+    def snapshot(self):
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'avg_delay_ms': self.total_delay * 1000 / self.frames if self.frames else 0.0,
+            'recent_delay_ms': self.recent_delay * 1000,
+            'max_delay_ms': self.max_delay * 1000,
+        }
+
+
+def qos_summary(batchers):
+    """Per-class queueing delay across every client's batcher."""
+    totals = {qos: _ClassStats() for qos in QOS_CLASSES}
+    for batcher in batchers:
+        for qos, stats in batcher.class_stats.items():
+            totals[qos].merge(stats)
+    return {qos: stats.snapshot() for qos, stats in totals.items()}
+
+
+class BatchSequencer:
+    """Applies one peer's batches in `seq` order.
+
+    Socket.IO runs every incoming event on its own handler thread, so two
+    batches can reach their handlers in either order. Whichever handler
+    finds the next expected batch applies it and any that queued up behind
+    it; the others just leave their batch and return.
+
+    `ack(seq)` is called once at least ack_bytes have been applied since the
+    last acknowledgement, which is what opens the sender's window again.
+    """
+
+    def __init__(self, apply, ack=None, ack_bytes=WINDOW_BYTES // 4):
+        self._apply = apply
+        self._ack = ack
+        self.ack_bytes = ack_bytes
+        self._unacked_bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next = 0
+        self._draining = False
+
+    def submit(self, payload):
+        with self._lock:
+            self._pending[payload.get('seq', self._next)] = payload
+            if self._draining:
+                return
+            self._draining = True
+        while True:
+            with self._lock:
+                payload = self._pending.pop(self._next, None)
+                if payload is None:
+                    self._draining = False
+                    return
+                self._next += 1
+            try:
+                self._apply(payload)
+            except Exception as e:
+                print(f'[!] Error applying stream batch: {e}')
+            if self._ack is not None:
+                self._unacked_bytes += sum(length for _, length in payload.get('frames') or () if length > 0)
+                if self._unacked_bytes >= self.ack_bytes:
+                    self._unacked_bytes = 0
+                    self._ack(payload.get('seq', self._next - 1))
+
+
+class StreamWriter:
+    """Writes one stream's data to its socket from a thread of its own.
+
+    `write` queues the data and returns; the thread is started on demand
+    and exits after WRITER_IDLE seconds without work. `on_pause` and
+    `on_resume` are called as the queue crosses the buffer marks, and
+    `on_error(exc)` once if a write fails, after which data is dropped.
+    `on_drained(nbytes)` is called as queued bytes are written or dropped.
+    """
+
+    def __init__(self, sock, name, on_pause=None, on_resume=None, on_error=None, on_drained=None):
+        self.sock = sock
+        self.name = name
+        self._on_pause = on_pause
+        self._on_resume = on_resume
+        self._on_error = on_error
+        self._on_drained = on_drained
+        self._cond = threading.Condition(threading.Lock())
+        # bytes to write, or callables to run once everything before them is written
+        self._queue = collections.deque()
+        self._size = 0
+        self._running = False
+        self._busy = False
+        self._paused = False
+        self.failed = False
+
+    def write(self, data, block=True, pause=False):
+        """Queue data for the socket; False once the stream has failed.
+
+        `pause` asks the sender to pause even below STREAM_BUFFER_HIGH.
+        """
+        with self._cond:
+            while block and self._size >= STREAM_BUFFER_MAX and not self.failed:
+                self._cond.wait()
+            if self.failed:
+                return False
+            self._queue.append(data)
+            self._size += len(data)
+            pause = not self._paused and (pause or self._size >= STREAM_BUFFER_HIGH)
+            if pause:
+                self._paused = True
+            self._wake()
+        if pause and self._on_pause is not None:
+            self._on_pause()
+        return True
+
+    def finish(self, callback):
+        """Run `callback` once everything queued so far is written or dropped."""
+        with self._cond:
+            if self._queue or self._busy:
+                self._queue.append(callback)
+                self._wake()
+                return
+        callback()
+
+    def abort(self, callback):
+        """Drop queued data and run `callback` once the socket is no longer being written."""
+        with self._cond:
+            self.failed = True
+            self._size = 0
+            dropped = sum(len(item) for item in self._queue if not callable(item))
+            self._queue = collections.deque(item for item in self._queue if callable(item))
+            resume = self._paused
+            self._paused = False
+            self._cond.notify_all()
+            if self._busy:
+                # Wake a sendall blocked on a peer that stopped reading.
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._queue.append(callback)
+                callbacks = ()
+            else:
+                callbacks = list(self._queue) + [callback]
+                self._queue.clear()
+        if dropped and self._on_drained is not None:
+            self._on_drained(dropped)
+        if resume and self._on_resume is not None:
+            self._on_resume()
+        for item in callbacks:
+            item()
+
+    def _wake(self):
+        if self._running:
+            self._cond.notify_all()
+        else:
+            self._running = True
+            threading.Thread(target=self._run, name=f'stream-writer-{self.name}', daemon=True).start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    if not self._cond.wait(WRITER_IDLE) and not self._queue:
+                        self._running = False
+                        return
+                item = self._queue.popleft()
+                self._busy = True
+                failed = self.failed
+            error = None
+            try:
+                if callable(item):
+                    item()
+                elif not failed:
+                    self.sock.sendall(item)
+            except Exception as e:
+                error = e
+            report = resume = False
+            with self._cond:
+                self._busy = False
+                if not callable(item) and not self.failed:
+                    self._size -= len(item)
+                    if error is not None:
+                        self.failed = report = True
+                        self._size = 0
+                    if self._paused and self._size <= STREAM_BUFFER_LOW:
+                        self._paused = False
+                        resume = True
+                self._cond.notify_all()
+            if callable(item) and error is not None:
+                print(f'[!] Error closing stream {self.name}: {error}')
+            if not callable(item) and self._on_drained is not None:
+                self._on_drained(len(item))
+            if report and self._on_error is not None:
+                self._on_error(error)
+            if resume and self._on_resume is not None:
+                self._on_resume()
+
+
+def iter_batch(payload):
+    """Yield (conn_id, data) for each frame of a batch; data is None for a close."""
+    data = payload.get('data') or b''
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    offset = 0
+    for conn_id, length in payload.get('frames') or ():
+        if length == CLOSE_FRAME:
+            yield conn_id, None
+            continue
+        yield conn_id, data[offset:offset + length]
+        offset += length
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Memory and wire cost of the connection table.
+
+Compares the old registry (uuid4 string ids, one five-key dict per connection) with
+integer ids from StreamIds and __slots__ Connection records: bytes each
+stream frame costs on the wire, and memory held per 10k connections.
+Sockets are left out; both layouts point at the same objects.
+
+Memory is the growth in peak RSS (resource.getrusage) while the table is
+built, in a forked process per layout so one does not reuse the other's
+freed pages, next to the Python heap growth tracemalloc sees. POSIX only.
+
+Usage: python benchmarks/bench_connection_table.py [connections]
+"""
+import gc
+import json
+import os
+import resource
+import sys
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from proxy_server import Connection, StreamIds
+
+FRAME_PAYLOAD = b'x' * 64
+
+
+def old_table(count, sock):
+    table = {}
+    for _ in range(count):
+        table[str(uuid.uuid4())] = {
+            'socket': sock,
+            'tunnel_id': 1,
+            'type': 'TCP',
+            'active': True,
+            'buffer': []
+        }
+    return table
+
+
+def new_table(count, sock):
+    ids = StreamIds()
+    table = {}
+    for _ in range(count):
+        table[ids.allocate()] = Connection(sock, 1, 'TCP', read_size=8192, qos_class='interactive')
+    return table
+
+
+def peak_rss():
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def in_child(work):
+    """Run work() in a forked process and return its JSON result."""
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        with os.fdopen(write_end, 'w') as out:
+            json.dump(work(), out)
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as result:
+        data = json.load(result)
+    os.waitpid(pid, 0)
+    return data
+
+
+def measure(build, count):
+    """(RSS growth, traced heap growth, ids) for a table of count connections."""
+    def rss():
+        gc.collect()
+        before = peak_rss()
+        table = build(count, object())
+        return peak_rss() - before, list(table)
+
+    def heap():
+        gc.collect()
+        tracemalloc.start()
+        table = build(count, object())
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del table
+        return size
+
+    rss_bytes, ids = in_child(rss)
+    return rss_bytes, in_child(heap), ids
+
+
+def frame_bytes(ids):
+    """Bytes per frame in a 64-frame stream_batch header and per stream_data event."""
+    frames = [[conn_id, len(FRAME_PAYLOAD)] for conn_id in ids[:64]]
+    batch = len(json.dumps(frames, separators=(',', ':'))) / len(frames)
+    event = len(json.dumps({'conn_id': ids[-1], 'data': '', 'protocol': 'TCP'}, separators=(',', ':')))
+    return batch, event
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print(f'{count} connections; memory per 10k connections')
+    print(f'{"layout":<12} {"RSS KiB":>9} {"heap KiB":>9} {"RSS B/conn":>11} {"batch B/frame":>14} {"event hdr B":>12}')
+    for name, build in (('uuid+dict', old_table), ('int+slots', new_table)):
+        rss, heap, ids = measure(build, count)
+        batch, event = frame_bytes(ids)
+        scale = 10000 / count
+        print(f'{name:<12} {rss * scale / 1024:>9.0f} {heap * scale / 1024:>9.0f} {rss / count:>11.0f} '
+              f'{batch:>14.1f} {event:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Head-of-line benchmark for the QoS classes in batching.py.
+
+Runs a Socket.IO server and client on loopback. One stream pushes bulk data
+to the client as fast as the link allows while another does 64 byte
+request/response round trips, like keystrokes over SSH during a download.
+Compares FIFO batching (every frame in one class, no window) with the
+interactive/bulk priority queues plus the acknowledged window.
+
+An rtt of inf means a ping got no reply within 10 seconds.
+
+Usage: python benchmarks/bench_qos.py [seconds] [bulk_streams]
+"""
+import base64
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socketio
+from werkzeug.serving import make_server
+
+from batching import BULK, INTERACTIVE, WINDOW_BYTES, BatchSequencer, OutboundBatcher, iter_batch
+
+PING = b'p' * 64
+BULK_CHUNK = b'b' * 65536
+BULK_BUDGET = 4 * 1024 * 1024
+
+
+def run(seconds, bulk_streams, qos):
+    server = socketio.Server(async_mode='threading')
+    http = make_server('127.0.0.1', 0, socketio.WSGIApp(server), threaded=True)
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    connected = threading.Event()
+    sids = []
+    pong = threading.Event()
+    received = [0]
+
+    server.on('connect', lambda sid, environ: (sids.append(sid), connected.set()))
+    server.on('stream_response', lambda sid, data: pong.set())
+
+    client = socketio.Client()
+
+    def client_batch(data):
+        for conn_id, chunk in iter_batch(data):
+            if conn_id == 0:
+                client.emit('stream_response', {'conn_id': 0, 'data': base64.b64encode(chunk).decode('ascii')})
+            else:
+                received[0] += len(chunk)
+
+    ack = (lambda seq: client.emit('stream_batch_ack', {'seq': seq})) if qos else None
+    sequencer = BatchSequencer(client_batch, ack=ack)
+    client.on('stream_batch', sequencer.submit)
+    client.connect(f'http://127.0.0.1:{http.server_port}', transports=['websocket'])
+    connected.wait(5)
+    sid = sids[0]
+
+    # Bulk senders may only run this far ahead of the wire, as admission
+    # control's buffer budget does in the proxy.
+    budget = threading.Condition()
+    buffered = [0]
+
+    def release(accounts):
+        with budget:
+            buffered[0] -= accounts.get('bulk', 0)
+            budget.notify_all()
+
+    batcher = OutboundBatcher(
+        lambda payload: server.emit('stream_batch', payload, to=sid), 'bench',
+        on_flushed=release, window=WINDOW_BYTES if qos else None
+    )
+    server.on('stream_batch_ack', lambda sid, data: batcher.ack(data['seq']))
+    deadline = time.monotonic() + seconds
+
+    def bulk(conn_id):
+        while time.monotonic() < deadline:
+            with budget:
+                while buffered[0] >= BULK_BUDGET:
+                    budget.wait(0.1)
+                buffered[0] += len(BULK_CHUNK)
+            batcher.send(conn_id, BULK_CHUNK, account='bulk', qos=BULK if qos else INTERACTIVE)
+
+    threads = [threading.Thread(target=bulk, args=(i + 1,), daemon=True) for i in range(bulk_streams)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    time.sleep(0.5)
+
+    samples = []
+    while time.monotonic() < deadline:
+        pong.clear()
+        start = time.perf_counter()
+        batcher.send(0, PING, qos=INTERACTIVE)
+        if not pong.wait(10):
+            samples.append(float('inf'))
+            break
+        samples.append(time.perf_counter() - start)
+        time.sleep(0.02)
+
+    # A ping that times out keeps this loop running past the deadline, so
+    # throughput is taken over the time actually elapsed.
+    start_bytes = received[0]
+    elapsed = time.monotonic() - started
+    time.sleep(0.5)
+    for thread in threads:
+        thread.join(timeout=5)
+    batcher.close()
+    client.disconnect()
+    http.shutdown()
+
+    samples.sort()
+    stats = batcher.class_stats
+    return {
+        'rtt_p50': samples[len(samples) // 2] * 1000,
+        'rtt_p99': samples[max(0, int(len(samples) * 0.99) - 1)] * 1000,
+        'bulk_mbps': start_bytes / elapsed / (1024 * 1024),
+        'interactive_delay': stats[INTERACTIVE].snapshot()['avg_delay_ms'],
+        'bulk_delay': stats[BULK].snapshot()['avg_delay_ms'],
+    }
+
+
+def main():
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    bulk_streams = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    print(f'{bulk_streams} bulk streams, one interactive stream, {seconds:.0f}s per mode')
+    print(f'{"mode":<6} {"rtt p50 ms":>11} {"rtt p99 ms":>11} {"bulk MiB/s":>11} {"int. queue ms":>14} {"bulk queue ms":>14}')
+    for name, qos in (('fifo', False), ('qos', True)):
+        r = run(seconds, bulk_streams, qos)
+        print(f'{name:<6} {r["rtt_p50"]:>11.2f} {r["rtt_p99"]:>11.2f} {r["bulk_mbps"]:>11.1f} '
+              f'{r["interactive_delay"]:>14.2f} {r["bulk_delay"]:>14.2f}')
+
+
+if __name__ == '__main__':
+    main()
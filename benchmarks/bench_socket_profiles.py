@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Loopback benchmark for the socket tuning profiles.
+
+Measures request/response latency with a write-write-read pattern (the case
+where Nagle's algorithm and delayed ACKs stall interactive traffic) and bulk
+throughput with the read size each profile uses.
+
+Usage: python benchmarks/bench_socket_profiles.py [rounds] [bulk_megabytes]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from socket_profiles import apply_listener_options, apply_stream_options, resolve_profile
+
+BASELINE = {
+    'backlog': 50,
+    'nodelay': False,
+    'sndbuf': None,
+    'rcvbuf': None,
+    'keepalive': False,
+    'keepidle': 60,
+    'keepintvl': 15,
+    'keepcnt': 4,
+    'read_size': 8192,
+}
+
+
+def socket_pair(options):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    backlog = apply_listener_options(listener, options)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(backlog)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    apply_stream_options(client, options)
+    client.connect(listener.getsockname())
+    server, _ = listener.accept()
+    apply_stream_options(server, options)
+    listener.close()
+    return client, server
+
+
+def recv_exact(sock, n, read_size):
+    received = 0
+    while received < n:
+        chunk = sock.recv(min(read_size, n - received))
+        if not chunk:
+            raise ConnectionError('peer closed')
+        received += len(chunk)
+
+
+def bench_latency(options, rounds):
+    client, server = socket_pair(options)
+
+    def echo():
+        try:
+            for _ in range(rounds):
+                recv_exact(server, 128, options['read_size'])
+                server.sendall(b'r' * 64)
+        except ConnectionError:
+            pass
+
+    thread = threading.Thread(target=echo, daemon=True)
+    thread.start()
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        client.sendall(b'h' * 64)
+        client.sendall(b'b' * 64)
+        recv_exact(client, 64, options['read_size'])
+        samples.append(time.perf_counter() - start)
+    thread.join()
+    client.close()
+    server.close()
+    samples.sort()
+    return sum(samples) / len(samples) * 1000, samples[int(len(samples) * 0.99) - 1] * 1000
+
+
+def bench_throughput(options, total_bytes):
+    client, server = socket_pair(options)
+    payload = b'x' * 65536
+
+    def send():
+        sent = 0
+        while sent < total_bytes:
+            client.sendall(payload)
+            sent += len(payload)
+        client.shutdown(socket.SHUT_WR)
+
+    thread = threading.Thread(target=send, daemon=True)
+    start = time.perf_counter()
+    thread.start()
+    received = 0
+    reads = 0
+    while True:
+        chunk = server.recv(options['read_size'])
+        if not chunk:
+            break
+        received += len(chunk)
+        reads += 1
+    elapsed = time.perf_counter() - start
+    thread.join()
+    client.close()
+    server.close()
+    return received / elapsed / (1024 * 1024), reads
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    bulk_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    profiles = [
+        ('baseline', BASELINE),
+        ('auto', resolve_profile('auto')),
+        ('interactive', resolve_profile('interactive')),
+        ('bulk', resolve_profile('bulk')),
+    ]
+
+    print(f'{"profile":<12} {"rtt avg ms":>11} {"rtt p99 ms":>11} {"bulk MiB/s":>11} {"reads":>9}')
+    for name, options in profiles:
+        avg, p99 = bench_latency(options, rounds)
+        mbps, reads = bench_throughput(options, bulk_mb * 1024 * 1024)
+        print(f'{name:<12} {avg:>11.3f} {p99:>11.3f} {mbps:>11.1f} {reads:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Small-packet request/response benchmark for stream batching.
+
+Runs a Socket.IO server and client on loopback. Each of N streams sends a
+small request from the server side, the client echoes it back, and the
+stream waits for the reply before sending again -- the pattern of many
+chatty connections sharing one tunnel client. Compares one event per chunk
+(stream_data / stream_response) with coalesced stream_batch events.
+
+Usage: python benchmarks/bench_stream_batching.py [streams] [seconds] [payload_bytes]
+"""
+import base64
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import socketio
+from werkzeug.serving import make_server
+
+from batching import BatchSequencer, OutboundBatcher, iter_batch
+
+
+class Bench:
+    def __init__(self, streams, payload_size, batched):
+        self.streams = streams
+        self.payload = os.urandom(payload_size)
+        self.batched = batched
+        self.replies = [threading.Event() for _ in range(streams)]
+        self.events_sent = 0
+        self.count_lock = threading.Lock()
+
+        self.server = socketio.Server(async_mode='threading')
+        self.server.on('connect', self._server_connect)
+        self.server.on('stream_response', self._server_response)
+        self.server.on('stream_batch', lambda sid, data: self.server_sequencer.submit(data))
+        self.server_sequencer = BatchSequencer(self._server_batch)
+        self.http = make_server('127.0.0.1', 0, socketio.WSGIApp(self.server), threaded=True)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.sid = None
+        self.connected = threading.Event()
+
+        self.client = socketio.Client()
+        self.client.on('stream_data', self._client_data)
+        self.client.on('stream_batch', lambda data: self.client_sequencer.submit(data))
+        self.client_sequencer = BatchSequencer(self._client_batch)
+        self.client.connect(f'http://127.0.0.1:{self.http.server_port}', transports=['websocket'])
+        self.connected.wait(5)
+
+        self.server_batcher = self.client_batcher = None
+        if batched:
+            self.server_batcher = OutboundBatcher(self._count(lambda p: self.server.emit('stream_batch', p, to=self.sid)), 'server')
+            self.client_batcher = OutboundBatcher(self._count(lambda p: self.client.emit('stream_batch', p)), 'client')
+
+    def _count(self, emit):
+        def counted(payload):
+            with self.count_lock:
+                self.events_sent += 1
+            emit(payload)
+        return counted
+
+    def _server_connect(self, sid, environ):
+        self.sid = sid
+        self.connected.set()
+
+    def _server_response(self, sid, data):
+        self.replies[data['conn_id']].set()
+
+    def _server_batch(self, data):
+        for conn_id, _ in iter_batch(data):
+            self.replies[conn_id].set()
+
+    def _client_data(self, data):
+        self._client_reply(data['conn_id'], base64.b64decode(data['data']))
+
+    def _client_batch(self, data):
+        for conn_id, chunk in iter_batch(data):
+            self._client_reply(conn_id, chunk)
+
+    def _client_reply(self, conn_id, chunk):
+        if self.client_batcher is not None:
+            self.client_batcher.send(conn_id, chunk)
+        else:
+            self._count(lambda p: self.client.emit('stream_response', p))(
+                {'conn_id': conn_id, 'data': base64.b64encode(chunk).decode('ascii')})
+
+    def _stream(self, conn_id, deadline, results):
+        done = 0
+        latencies = []
+        reply = self.replies[conn_id]
+        while time.monotonic() < deadline:
+            reply.clear()
+            start = time.perf_counter()
+            if self.server_batcher is not None:
+                self.server_batcher.send(conn_id, self.payload)
+            else:
+                self._count(lambda p: self.server.emit('stream_data', p, to=self.sid))(
+                    {'conn_id': conn_id, 'data': base64.b64encode(self.payload).decode('ascii')})
+            if not reply.wait(5):
+                break
+            latencies.append(time.perf_counter() - start)
+            done += 1
+        results[conn_id] = (done, latencies)
+
+    def run(self, seconds):
+        results = {}
+        deadline = time.monotonic() + seconds
+        threads = [threading.Thread(target=self._stream, args=(i, deadline, results)) for i in range(self.streams)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        self.client.disconnect()
+        self.http.shutdown()
+        for batcher in (self.server_batcher, self.client_batcher):
+            if batcher is not None:
+                batcher.close()
+
+        total = sum(done for done, _ in results.values())
+        latencies = sorted(l for _, ls in results.values() for l in ls)
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0.0
+        p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0
+        return total / elapsed, self.events_sent / max(total * 2, 1), p50, p99
+
+
+def main():
+    logging.getLogger('werkzeug').setLevel(logging.CRITICAL)
+    streams = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    payload_size = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+
+    print(f'{streams} streams, {payload_size} byte requests, {seconds:.0f}s per mode')
+    print(f'{"mode":<10} {"req/s":>10} {"events/msg":>11} {"p50 ms":>9} {"p99 ms":>9}')
+    for name, batched in (('per-chunk', False), ('batched', True)):
+        rps, events_per_message, p50, p99 = Bench(streams, payload_size, batched).run(seconds)
+        print(f'{name:<10} {rps:>10.0f} {events_per_message:>11.3f} {p50:>9.2f} {p99:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import json
+import os
+import socket
+import struct
+import threading
+
+# Graceful restart: a new server process connects to the old one over this
+# Unix socket, receives every bound listener (the HTTP port plus each tunnel's
+# public TCP/UDP sockets) as file descriptors, and starts accepting on them
+# while the old process stops accepting and drains its in-flight streams.
+HANDOFF_SOCKET = os.getenv('HANDOFF_SOCKET', 'tunnel_handoff.sock')
+# Streams still open after DRAIN_TIMEOUT seconds are cut when the old process
+# exits; 0 waits for every stream to close instead.
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '30'))
+MAX_FDS_PER_MESSAGE = 64
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def _send_frame(sock, payload):
+    sock.sendall(struct.pack('!I', len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('handoff peer closed the connection')
+        data += chunk
+    return data
+
+
+def _recv_frame(sock):
+    (size,) = struct.unpack('!I', _recv_exact(sock, 4))
+    return _recv_exact(sock, size)
+
+
+class InheritedListeners:
+    """Listeners received from the previous server process.
+
+    The previous process keeps accepting until confirm() is called, so the
+    successor must have started its accept loops before confirming.
+    """
+
+    def __init__(self, conn, pid, http_listener, listeners):
+        self._conn = conn
+        self.pid = pid
+        self.http_listener = http_listener
+        self.listeners = listeners
+
+    def confirm(self):
+        try:
+            _send_frame(self._conn, b'READY')
+            if _recv_frame(self._conn) != b'DRAINING':
+                raise ConnectionError('previous process did not start draining')
+        finally:
+            self._conn.close()
+        print(f'[*] Took over {len(self.listeners)} tunnel listeners from process {self.pid}')
+
+
+def take_over(path=HANDOFF_SOCKET, timeout=10.0):
+    """Ask a running server for its listeners; None when there is none."""
+    if not supported() or not os.path.exists(path):
+        return None
+
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(path)
+    except OSError:
+        # Stale socket file left by a process that is no longer running.
+        conn.close()
+        return None
+
+    try:
+        _send_frame(conn, b'HANDOFF')
+        manifest = json.loads(_recv_frame(conn))
+        fds = []
+        while len(fds) < manifest['fd_count']:
+            _, batch, _, _ = socket.recv_fds(conn, 1, MAX_FDS_PER_MESSAGE)
+            if not batch:
+                raise ConnectionError('handoff ended before all listeners were received')
+            fds.extend(batch)
+    except Exception:
+        conn.close()
+        raise
+
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    listeners = [(meta, sockets[meta['fd_index']]) for meta in manifest['listeners']]
+    http_index = manifest.get('http_fd_index')
+    http_listener = sockets[http_index] if http_index is not None else None
+    return InheritedListeners(conn, manifest['pid'], http_listener, listeners)
+
+
+class HandoffServer:
+    """Waits for a successor process and hands it this process's listeners.
+
+    `export` returns (http_listener, [(metadata, socket), ...]). Once the
+    successor confirms it is accepting, `on_handoff` is called on the handoff
+    thread to stop accepting and drain.
+    """
+
+    def __init__(self, export, on_handoff, path=HANDOFF_SOCKET):
+        self.export = export
+        self.on_handoff = on_handoff
+        self.path = path
+        self._server = None
+
+    def start(self):
+        if not supported():
+            print('[!] Graceful restart is not supported on this platform')
+            return False
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self._server.listen(1)
+        threading.Thread(target=self._serve, name='handoff-server', daemon=True).start()
+        print(f'[*] Graceful restart enabled on {self.path}')
+        return True
+
+    def _serve(self):
+        while True:
+            conn, _ = self._server.accept()
+            try:
+                conn.settimeout(30)
+                if _recv_frame(conn) != b'HANDOFF':
+                    continue
+                self._send_listeners(conn)
+                if _recv_frame(conn) != b'READY':
+                    raise ConnectionError('successor did not confirm the handoff')
+                _send_frame(conn, b'DRAINING')
+            except Exception as e:
+                # The successor failed; keep serving as if nothing happened.
+                print(f'[!] Listener handoff failed: {e}')
+                continue
+            finally:
+                conn.close()
+            break
+
+        # The successor has re-bound the path to its own handoff socket.
+        self._server.close()
+        self.on_handoff()
+
+    def _send_listeners(self, conn):
+        http_listener, listeners = self.export()
+        sockets = []
+        http_index = None
+        if http_listener is not None:
+            http_index = 0
+            sockets.append(http_listener)
+        entries = []
+        for meta, listener in listeners:
+            entries.append(dict(meta, fd_index=len(sockets)))
+            sockets.append(listener)
+
+        _send_frame(conn, json.dumps({
+            'pid': os.getpid(),
+            'fd_count': len(sockets),
+            'http_fd_index': http_index,
+            'listeners': entries
+        }).encode('utf-8'))
+        fds = [s.fileno() for s in sockets]
+        for i in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+            socket.send_fds(conn, [b'F'], fds[i:i + MAX_FDS_PER_MESSAGE])
+        print(f'[*] Handed {len(listeners)} tunnel listeners to successor process')
+
+
+class HttpServer:
+    """Serves the Flask app on a listener this process owns.
+
+    socketio.run() binds its own socket, which cannot be handed over, so in
+    graceful restart mode the listener is created (or inherited) here.
+    """
+
+    def __init__(self, app, async_mode, listener):
+        self.app = app
+        self.async_mode = async_mode
+        self.listener = listener
+        self._server = None
+
+    @staticmethod
+    def bind(host, port):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(128)
+        return listener
+
+    def serve_forever(self):
+        if self.async_mode == 'eventlet':
+            import eventlet.wsgi
+            from eventlet.greenio import GreenSocket
+            eventlet.wsgi.server(GreenSocket(self.listener), self.app, log_output=False)
+        else:
+            from werkzeug.serving import make_server
+            host, port = self.listener.getsockname()[:2]
+            self._server = make_server(host, port, self.app, threaded=True, fd=self.listener.fileno())
+            self._server.serve_forever()
+
+    def stop_accepting(self):
+        # Existing Socket.IO connections keep running on their own threads.
+        if self._server is not None:
+            self._server.shutdown()
+        else:
+            self.listener.close()
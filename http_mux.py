@@ -0,0 +1,203 @@
+import os
+
+# HTTP tunnels: the server splits each public connection into requests and
+# sends them to the client one at a time; the client replays them on a small
+# pool of keep-alive connections to the local service. Bytes are forwarded
+# untouched, the framing is only parsed to find where each message ends.
+HTTP_CAPABILITY = 'http_requests'
+MAX_HEAD_BYTES = int(os.getenv('HTTP_MAX_HEAD_BYTES', str(64 * 1024)))
+# Request bodies up to this size travel inside the request's open frame, so
+# the client knows the request is complete and can reuse its connection;
+# longer ones are streamed behind it.
+HTTP_BUFFER_BYTES = int(os.getenv('HTTP_BUFFER_BYTES', str(64 * 1024)))
+
+REASONS = {400: 'Bad Request', 431: 'Request Header Fields Too Large', 501: 'Not Implemented'}
+
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+    def response(self):
+        body = str(self).encode('utf-8')
+        return (f'HTTP/1.1 {self.status} {REASONS.get(self.status, "Error")}\r\nConnection: close\r\n'
+                f'Content-Length: {len(body)}\r\n\r\n').encode('ascii') + body
+
+
+class BodyFraming:
+    """Finds the end of an HTTP/1.1 message body in a byte stream.
+
+    `feed` returns how many of the given bytes belong to the body, so chunk
+    sizes and trailers pass through as they are. With neither a length nor
+    chunked encoding the body runs until the connection closes.
+    """
+
+    def __init__(self, length=None, chunked=False):
+        self.remaining = length
+        self.chunked = chunked
+        self.done = length == 0 and not chunked
+        self._state = 'size'
+        self._line = b''
+
+    def feed(self, data):
+        if self.done:
+            return 0
+        if not self.chunked:
+            if self.remaining is None:
+                return len(data)
+            taken = min(self.remaining, len(data))
+            self.remaining -= taken
+            self.done = not self.remaining
+            return taken
+
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self._state == 'data':
+                taken = min(self.remaining, len(data) - pos)
+                self.remaining -= taken
+                pos += taken
+                if not self.remaining:
+                    self._state = 'data_end'
+                continue
+            end = data.find(b'\n', pos)
+            if end < 0:
+                self._line += data[pos:]
+                if len(self._line) > MAX_HEAD_BYTES:
+                    raise HttpError(400, 'Chunk header too long')
+                return len(data)
+            line = (self._line + data[pos:end]).strip()
+            self._line = b''
+            pos = end + 1
+            if self._state == 'size':
+                try:
+                    size = int(line.split(b';', 1)[0], 16)
+                except ValueError:
+                    size = -1
+                if size < 0:
+                    raise HttpError(400, 'Invalid chunk size')
+                self.remaining = size
+                self._state = 'data' if size else 'trailer'
+            elif self._state == 'data_end':
+                self._state = 'size'
+            elif not line:
+                self.done = True
+        return pos
+
+
+class HttpRequest:
+    """Request line and headers of one request; header names are lowercased."""
+
+    def __init__(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise HttpError(400, 'Malformed request line')
+        self.method, self.target, self.version = parts
+        self.headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(':')
+            if not sep or not name or name != name.strip():
+                raise HttpError(400, 'Malformed header')
+            name = name.lower()
+            value = value.strip()
+            self.headers[name] = f'{self.headers[name]}, {value}' if name in self.headers else value
+        self.head = head
+
+    def _tokens(self, name):
+        return {token.strip().lower() for token in self.headers.get(name, '').split(',')}
+
+    @property
+    def keep_alive(self):
+        connection = self._tokens('connection')
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in connection
+        return 'close' not in connection
+
+    @property
+    def upgrade(self):
+        """WebSocket and other upgrades, and CONNECT, are tunnelled as raw streams."""
+        return self.method == 'CONNECT' or ('upgrade' in self.headers and 'upgrade' in self._tokens('connection'))
+
+    def local_head(self):
+        """The head as it is sent to the local service.
+
+        Connection is hop-by-hop: close is dropped (and keep-alive added for
+        HTTP/1.0) so the client can reuse its local connection even when
+        the public peer closes after every request. The server still
+        closes the public connection as the peer asked.
+        """
+        tokens = [token.strip() for token in self.headers.get('connection', '').split(',') if token.strip()]
+        kept = [token for token in tokens if token.lower() not in ('close', 'keep-alive')]
+        if self.version == 'HTTP/1.0':
+            kept.append('keep-alive')
+        if kept == tokens:
+            return self.head
+        lines = [line for line in self.head[:-4].split(b'\r\n') if line.split(b':', 1)[0].strip().lower() != b'connection']
+        if kept:
+            lines.append(b'Connection: ' + ', '.join(kept).encode('latin-1'))
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def framing(self):
+        # Requests with both headers, or conflicting lengths, are refused
+        # rather than guessed at: the local server might read them the
+        # other way and see a different request boundary.
+        encoding = self.headers.get('transfer-encoding')
+        length = self.headers.get('content-length')
+        if encoding is not None:
+            if length is not None:
+                raise HttpError(400, 'Both Transfer-Encoding and Content-Length')
+            if [token.strip().lower() for token in encoding.split(',')][-1] != 'chunked':
+                raise HttpError(501, 'Unsupported Transfer-Encoding')
+            return BodyFraming(chunked=True)
+        if length is not None:
+            values = {value.strip() for value in length.split(',')}
+            if len(values) != 1 or not next(iter(values)).isdigit():
+                raise HttpError(400, 'Invalid Content-Length')
+            return BodyFraming(int(values.pop()))
+        return BodyFraming(0)
+
+
+class HttpRequestReader:
+    """Reads requests one after another from a public connection.
+
+    `recv` returns the next bytes from the peer, or b'' once it has closed.
+    Bytes past the current request stay buffered for the next one, so
+    pipelined requests are served in order.
+    """
+
+    def __init__(self, recv):
+        self.recv = recv
+        self.buffer = b''
+
+    def read_head(self):
+        """Return the next HttpRequest, or None if the peer closed between requests."""
+        while True:
+            # Stray CRLFs between requests are allowed and ignored.
+            self.buffer = self.buffer.lstrip(b'\r\n')
+            end = self.buffer.find(b'\r\n\r\n')
+            if end >= 0:
+                head, self.buffer = self.buffer[:end + 4], self.buffer[end + 4:]
+                return HttpRequest(head)
+            if len(self.buffer) > MAX_HEAD_BYTES:
+                raise HttpError(431, 'Request head too large')
+            data = self.recv()
+            if not data:
+                if self.buffer:
+                    raise HttpError(400, 'Incomplete request head')
+                return None
+            self.buffer += data
+
+    def read_body(self, framing):
+        """Yield the request body as raw chunks until `framing` is done."""
+        while not framing.done:
+            if not self.buffer:
+                self.buffer = self.recv()
+                if not self.buffer:
+                    raise ConnectionError('Peer closed during request body')
+            taken = framing.feed(self.buffer)
+            chunk, self.buffer = self.buffer[:taken], self.buffer[taken:]
+            if chunk:
+                yield chunk
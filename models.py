@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, BigInteger, String, Text, DateTime, Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -14,17 +14,21 @@ class Tunnel(Base):
     token = Column(String(64), unique=True, nullable=False)
     local_port = Column(Integer, nullable=False)
     public_port = Column(Integer, unique=True, nullable=True)
-    protocol = Column(String(10), default='TCP')
-    status = Column(String(20), default='inactive')
+    # Indexed for the filtered, id-ordered listing in GET /api/tunnels.
+    protocol = Column(String(10), default='TCP', index=True)
+    status = Column(String(20), default='inactive', index=True)
     verification_code = Column(String(32), unique=True, nullable=True)
-    verified = Column(Boolean, default=False)
+    verified = Column(Boolean, default=False, index=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     last_connected = Column(DateTime, nullable=True)
+    socket_profile = Column(String(20), default='auto')
+    socket_options = Column(Text, nullable=True)
     
-    def __init__(self, name, local_port, protocol='TCP'):
+    def __init__(self, name, local_port, protocol='TCP', socket_profile='auto'):
         self.name = name
         self.local_port = local_port
         self.protocol = protocol
+        self.socket_profile = socket_profile
         self.token = secrets.token_hex(32)
         self.verification_code = secrets.token_hex(16)
 
@@ -38,8 +42,64 @@ class TunnelSession(Base):
     disconnected_at = Column(DateTime, nullable=True)
     is_active = Column(Boolean, default=True)
 
+class TrafficRollup(Base):
+    """Aggregated traffic for one tunnel over one time bucket.
+
+    `resolution` is the bucket width in seconds (60, 3600 or 86400) and
+    `bucket_start` the bucket's start as a unix timestamp, so every
+    dashboard query is a primary-key range scan.
+    """
+    __tablename__ = 'traffic_rollups'
+    
+    tunnel_id = Column(Integer, primary_key=True)
+    resolution = Column(Integer, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True)
+    bytes_in = Column(BigInteger, nullable=False, default=0)
+    bytes_out = Column(BigInteger, nullable=False, default=0)
+    connections = Column(Integer, nullable=False, default=0)
+    udp_packets = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+
 engine = create_engine('sqlite:///tunnels.db', echo=False)
+
+@event.listens_for(engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets the traffic flusher write while request handlers read.
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+def _add_missing_columns():
+    # create_all() never alters existing tables, so columns added to a model
+    # after the database was created are appended here.
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'
+                if column.default is not None and column.default.is_scalar:
+                    default = column.default.arg
+                    if isinstance(default, bool):
+                        default = int(default)
+                    elif isinstance(default, str):
+                        default = "'" + default.replace("'", "''") + "'"
+                    ddl += f' DEFAULT {default}'
+                connection.execute(text(ddl))
+
+def _add_missing_indexes():
+    # Likewise, indexes declared after a table exists are created here.
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
 Base.metadata.create_all(engine)
+_add_missing_columns()
+_add_missing_indexes()
 Session = sessionmaker(bind=engine)
 
 def get_session():
@@ -0,0 +1,163 @@
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+MAX_PROFILE_SECONDS = 120
+DEFAULT_INTERVAL = 0.005
+
+
+class InstrumentedLock:
+    """threading.Lock that records how long callers wait to acquire it.
+
+    Uncontended acquisitions take the non-blocking fast path and are only
+    counted; timing is recorded only when a caller actually has to wait, so
+    the overhead on the hot path is one extra acquire attempt.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._holder = None
+        self.reset()
+
+    def reset(self):
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(False):
+            self.acquisitions += 1
+            self._holder = threading.current_thread().name
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(True, timeout)
+        if acquired:
+            waited = time.perf_counter() - start
+            self.acquisitions += 1
+            self.contended += 1
+            self.total_wait += waited
+            if waited > self.max_wait:
+                self.max_wait = waited
+            self._holder = threading.current_thread().name
+        return acquired
+
+    def release(self):
+        self._holder = None
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'locked': self._lock.locked(),
+            'holder': self._holder,
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'contention_ratio': self.contended / self.acquisitions if self.acquisitions else 0.0,
+            'total_wait_ms': self.total_wait * 1000,
+            'avg_wait_ms': self.total_wait * 1000 / self.contended if self.contended else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+
+class SamplingProfiler:
+    """Wall-clock sampling profiler for all Python threads.
+
+    Every `interval` seconds it snapshots sys._current_frames() and counts
+    each stack; the result is in the collapsed format read by flamegraph.pl
+    and speedscope. Only one profile can run at a time.
+    """
+
+    def __init__(self):
+        self._running = threading.Lock()
+
+    def profile(self, seconds, interval=DEFAULT_INTERVAL):
+        seconds = max(0.1, min(float(seconds), MAX_PROFILE_SECONDS))
+        interval = max(0.001, float(interval))
+        if not self._running.acquire(False):
+            raise RuntimeError('A profile is already running')
+        try:
+            return self._sample(seconds, interval)
+        finally:
+            self._running.release()
+
+    def _sample(self, seconds, interval):
+        own_ident = threading.get_ident()
+        counts = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+                    frame = frame.f_back
+                stack.append(_thread_group(names.get(ident, str(ident))))
+                counts[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        return {'samples': samples, 'stacks': counts}
+
+    @property
+    def running(self):
+        return self._running.locked()
+
+
+def collapsed(stacks):
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+def dump_threads(describe=None, limit=12):
+    """Snapshot every thread's stack, innermost frame first.
+
+    `describe` maps a thread name to extra context (e.g. which tunnel or
+    connection a proxy thread serves).
+    """
+    frames = sys._current_frames()
+    result = []
+    for thread in threading.enumerate():
+        frame = frames.get(thread.ident)
+        stack = traceback.extract_stack(frame, limit=limit) if frame is not None else []
+        entry = {
+            'name': thread.name,
+            'ident': thread.ident,
+            'daemon': thread.daemon,
+            'blocked_in': f'{stack[-1].name} ({os.path.basename(stack[-1].filename)}:{stack[-1].lineno})' if stack else None,
+            'stack': [f'{f.name} ({os.path.basename(f.filename)}:{f.lineno}) {f.line or ""}'.rstrip() for f in reversed(stack)],
+        }
+        if describe is not None:
+            info = describe(thread.name)
+            if info:
+                entry['serves'] = info
+        result.append(entry)
+    return result
+
+
+def _thread_group(name):
+    # Collapse per-connection thread names so all stream threads aggregate
+    # into one flamegraph tower.
+    for prefix in ('tcp-stream-', 'udp-packet-', 'Thread-'):
+        if name.startswith(prefix):
+            return prefix.rstrip('-')
+    return name
+
+
+profiler = SamplingProfiler()
@@ -1,12 +1,100 @@
 import socket
+import select
 import threading
-import uuid
 import base64
+from collections import deque
 from models import get_session, Tunnel
+from traffic_stats import traffic_accountant
+from profiling import InstrumentedLock
+from admission import QUEUED, admission, reject_connection
+from batching import OutboundBatcher, StreamWriter, qos_summary
+from http_mux import HTTP_BUFFER_BYTES, HttpError, HttpRequestReader
+from recording import CLOSE, DATA_IN, DATA_OUT, OPEN, RECORDING_DIR, UDP_IN, UDP_OUT, TrafficRecorder
+from socket_profiles import (
+    DEFAULT_PROFILE, StreamClassifier, apply_listener_options, apply_stream_options, resolve_profile
+)
+import os
 import time
 
+# How long a public connection waits for its tunnel client to (re)connect,
+# e.g. after a graceful restart or for a listener pre-warmed at boot.
+RECONNECT_GRACE = float(os.getenv('RECONNECT_GRACE', '30'))
+# While a client reports its local service down, new public connections are
+# rejected at accept; with a grace period they wait this long for it to recover.
+SERVICE_DOWN_GRACE = float(os.getenv('SERVICE_DOWN_GRACE', '0'))
+# Clients advertising this accept the stream's first bytes inside
+# new_connection and buffer data that arrives before their local connect.
+EARLY_DATA_CAPABILITY = 'early_data'
+# How long a new stream waits for the peer's first bytes before the open is
+# sent without them; 0 only takes what has already arrived, which never
+# delays server-speaks-first protocols.
+OPEN_DATA_WAIT = float(os.getenv('OPEN_DATA_WAIT', '0'))
+
+# Stream ids are 32-bit integers; a released id is not handed out again for
+# this long, so late frames for a closed stream cannot reach its successor.
+STREAM_ID_REUSE_DELAY = float(os.getenv('STREAM_ID_REUSE_DELAY', '30'))
+MAX_STREAM_ID = 0xFFFFFFFF
+
+
+class StreamIds:
+    """Allocates stream ids from a free-list, oldest released id first.
+
+    Ids start at 1 (handlers treat a falsy id as missing) and only grow
+    past the number of concurrent streams when released ids are still
+    cooling down, so they stay short on the wire.
+    """
+    
+    def __init__(self, reuse_delay=STREAM_ID_REUSE_DELAY):
+        self.reuse_delay = reuse_delay
+        self._lock = threading.Lock()
+        self._next = 1
+        self._free = deque()
+    
+    def allocate(self):
+        with self._lock:
+            if self._free and (self._free[0][0] <= time.monotonic() or self._next > MAX_STREAM_ID):
+                return self._free.popleft()[1]
+            if self._next > MAX_STREAM_ID:
+                raise RuntimeError('stream ids exhausted')
+            self._next += 1
+            return self._next - 1
+    
+    def release(self, stream_id):
+        with self._lock:
+            self._free.append((time.monotonic() + self.reuse_delay, stream_id))
+
+
+class Connection:
+    """Registry entry for a public TCP stream or UDP session."""
+    
+    __slots__ = (
+        'socket', 'tunnel_id', 'type', 'addr', 'active', 'pending', 'writer',
+        'read_size', 'qos_class', 'classifier', 'last_activity'
+    )
+    
+    def __init__(self, sock, tunnel_id, conn_type, addr=None, pending=False, read_size=0, qos_class=None, classifier=None):
+        self.socket = sock
+        self.tunnel_id = tunnel_id
+        self.type = conn_type
+        self.addr = addr
+        self.active = True
+        self.pending = pending
+        # Writes the client's data to a TCP stream's public socket (see StreamWriter).
+        self.writer = None
+        self.read_size = read_size
+        self.qos_class = qos_class
+        self.classifier = classifier
+        self.last_activity = time.time()
+
+
+# stream id -> Connection, for every TCP stream and UDP session
 active_connections = {}
-connection_lock = threading.Lock()
+# request stream id -> (Event set when the client has finished its response, public Connection)
+http_requests = {}
+# stream id -> Event, for streams the client asked to pause; set on resume
+paused_streams = {}
+connection_lock = InstrumentedLock('connection_lock')
+stream_ids = StreamIds()
 
 class TrafficProxy:
     def __init__(self, socketio_instance, connected_tunnels):
@@ -15,29 +103,57 @@ class TrafficProxy:
         self.proxy_threads = {}
         self.active_ports = {}
         self.stop_flags = {}
+        # (public_port, 'tcp' | 'udp') -> bound listener socket, kept for handoff
+        self.listeners = {}
+        self.draining = False
+        # client sid -> OutboundBatcher for clients that accept stream_batch
+        self.batchers = {}
+        self.batcher_lock = threading.Lock()
+        # client sid -> {tunnel_id: bytes} emitted by _emit_reserved and not yet acknowledged
+        self.unacked_bytes = {}
+        # tunnel_id -> TrafficRecorder while that tunnel is being recorded
+        self.recorders = {}
+        # tunnel_id -> connections refused because the local service was down
+        self.service_rejections = {}
     
-    def start_proxy_for_tunnel(self, tunnel_id, public_port, protocol='TCP'):
+    def start_proxy_for_tunnel(self, tunnel_id, public_port, protocol='TCP', socket_profile=DEFAULT_PROFILE, socket_options=None, inherited=None):
+        """Start the public listeners for a tunnel.
+
+        `inherited` maps 'tcp'/'udp' to already-bound listener sockets handed
+        over by a previous server process; those are used instead of binding.
+        """
+        inherited = inherited or {}
         if public_port in self.active_ports:
             print(f'[*] Proxy already running on port {public_port}')
             return
         
+        options = resolve_profile(socket_profile, socket_options)
+        auto_tune = socket_profile == 'auto'
+        
         self.stop_flags[public_port] = False
-        self.active_ports[public_port] = {'tunnel_id': tunnel_id, 'protocol': protocol}
+        self.active_ports[public_port] = {
+            'tunnel_id': tunnel_id,
+            'protocol': protocol,
+            'socket_profile': socket_profile,
+            'socket_options': options
+        }
         
-        if protocol in ['TCP', 'BOTH']:
+        if protocol in ['TCP', 'BOTH', 'HTTP']:
             tcp_thread = threading.Thread(
                 target=self._tcp_proxy_worker,
-                args=(tunnel_id, public_port),
+                args=(tunnel_id, public_port, options, auto_tune, inherited.get('tcp'), protocol == 'HTTP'),
+                name=f'tcp-accept-{public_port}',
                 daemon=True
             )
             tcp_thread.start()
             self.proxy_threads[f'{tunnel_id}_tcp'] = tcp_thread
-            print(f'[+] Started TCP proxy on port {public_port} for tunnel {tunnel_id}')
+            print(f'[+] Started {"HTTP" if protocol == "HTTP" else "TCP"} proxy on port {public_port} for tunnel {tunnel_id} ({socket_profile} profile)')
         
         if protocol in ['UDP', 'BOTH']:
             udp_thread = threading.Thread(
                 target=self._udp_proxy_worker,
-                args=(tunnel_id, public_port),
+                args=(tunnel_id, public_port, options, inherited.get('udp')),
+                name=f'udp-listen-{public_port}',
                 daemon=True
             )
             udp_thread.start()
@@ -51,12 +167,13 @@ class TrafficProxy:
             del self.active_ports[public_port]
         
         with connection_lock:
-            for conn_id in list(active_connections.keys()):
-                if active_connections[conn_id].get('tunnel_id') == tunnel_id:
-                    conn_data = active_connections[conn_id]
-                    if 'socket' in conn_data and conn_data['socket']:
+            for conn_id, conn in list(active_connections.items()):
+                if conn.tunnel_id == tunnel_id:
+                    # UDP sessions share the listener socket, which the
+                    # listener thread closes itself.
+                    if conn.type == 'TCP':
                         try:
-                            conn_data['socket'].close()
+                            conn.socket.close()
                         except:
                             pass
                     del active_connections[conn_id]
@@ -67,24 +184,240 @@ class TrafficProxy:
         
         print(f'[-] Stopped traffic proxy on port {public_port} for tunnel {tunnel_id}')
     
-    def _tcp_proxy_worker(self, tunnel_id, public_port):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def open_batcher(self, client_sid, window=None):
+        with self.batcher_lock:
+            batcher = self.batchers.get(client_sid)
+            if batcher is None:
+                batcher = self.batchers[client_sid] = OutboundBatcher(
+                    lambda payload: self.socketio.emit('stream_batch', payload, to=client_sid),
+                    client_sid,
+                    on_flushed=_release_flushed_bytes,
+                    window=window
+                )
+            return batcher
+    
+    def qos_metrics(self):
+        batchers = list(self.batchers.values())
+        return {
+            'classes': qos_summary(batchers),
+            'clients': {batcher.name: batcher.stats() for batcher in batchers}
+        }
+    
+    def close_batcher(self, client_sid):
+        with self.batcher_lock:
+            batcher = self.batchers.pop(client_sid, None)
+            unacked = self.unacked_bytes.pop(client_sid, {})
+        if batcher is not None:
+            batcher.close()
+        for tunnel_id, nbytes in unacked.items():
+            admission.release_bytes(tunnel_id, nbytes)
+    
+    def _send_stream_data(self, tunnel_info, tunnel_id, conn_id, data, qos):
+        """Hand a chunk to the client; its reserved bytes are released once the client has it."""
+        batcher = tunnel_info.get('batcher')
+        if batcher is not None:
+            if batcher.send(conn_id, data, account=tunnel_id, qos=qos):
+                return True
+            # The client disconnected and its batcher is closed.
+            admission.release_bytes(tunnel_id, len(data))
+            return False
+        data_b64 = base64.b64encode(data).decode('ascii')
+        self._emit_reserved('stream_data', {
+            'conn_id': conn_id,
+            'data': data_b64,
+            'protocol': 'TCP'
+        }, tunnel_info['sid'], tunnel_id, len(data))
+        return True
+    
+    def _emit_reserved(self, event, payload, sid, tunnel_id, nbytes):
+        """Emit data whose nbytes stay reserved until the client acknowledges the event.
+
+        Socket.IO queues emits without bound, so releasing the reservation
+        any earlier would not limit what is buffered on the way to the client.
+        """
+        with self.batcher_lock:
+            unacked = self.unacked_bytes.setdefault(sid, {})
+            unacked[tunnel_id] = unacked.get(tunnel_id, 0) + nbytes
+        try:
+            self.socketio.emit(event, payload, to=sid, callback=lambda *_: self._emit_acked(sid, tunnel_id, nbytes))
+        except Exception:
+            self._emit_acked(sid, tunnel_id, nbytes)
+            raise
+    
+    def _emit_acked(self, sid, tunnel_id, nbytes):
+        with self.batcher_lock:
+            unacked = self.unacked_bytes.get(sid)
+            # Already released if the client disconnected in the meantime.
+            if unacked is None or unacked.get(tunnel_id, 0) < nbytes:
+                return
+            unacked[tunnel_id] -= nbytes
+        admission.release_bytes(tunnel_id, nbytes)
+    
+    def _signal_flow(self, tunnel_id, event, conn_id):
+        """Ask the client to pause or resume reading a stream whose public peer is slow."""
+        tunnel_info = self.connected_tunnels.get(tunnel_id)
+        if tunnel_info is not None and tunnel_info.get('stream_pause'):
+            self.socketio.emit(event, {'conn_id': conn_id}, to=tunnel_info['sid'])
+    
+    def _send_close(self, tunnel_info, conn_id, qos):
+        batcher = tunnel_info.get('batcher')
+        if batcher is not None:
+            batcher.send_close(conn_id, qos)
+        else:
+            self.socketio.emit('close_connection', {
+                'conn_id': conn_id
+            }, to=tunnel_info['sid'])
+    
+    def start_recording(self, tunnel_id, max_bytes=None, payload_bytes=None):
+        if tunnel_id in self.recorders:
+            raise RuntimeError(f'Tunnel {tunnel_id} is already being recorded')
+        path = os.path.join(RECORDING_DIR, f'tunnel_{tunnel_id}_{time.strftime("%Y%m%d-%H%M%S")}.rec')
+        options = {}
+        if max_bytes is not None:
+            options['max_bytes'] = max_bytes
+        if payload_bytes is not None:
+            options['payload_limit'] = payload_bytes
+        recorder = self.recorders[tunnel_id] = TrafficRecorder(path, **options)
+        print(f'[*] Recording tunnel {tunnel_id} to {path}')
+        return recorder
+    
+    def stop_recording(self, tunnel_id):
+        recorder = self.recorders.pop(tunnel_id, None)
+        if recorder is not None:
+            recorder.close()
+            print(f'[*] Stopped recording tunnel {tunnel_id}')
+        return recorder
+    
+    def service_down(self, tunnel_id):
+        """True only when the tunnel's client has reported its local service down."""
+        tunnel_info = self.connected_tunnels.get(tunnel_id)
+        return tunnel_info is not None and tunnel_info.get('service_healthy') is False
+    
+    def _reject_service_down(self, client_socket, tunnel_id, addr, http=False):
+        self.service_rejections[tunnel_id] = self.service_rejections.get(tunnel_id, 0) + 1
+        print(f'[!] Rejected TCP connection from {addr} for tunnel {tunnel_id}: local service down')
+        reject_connection(client_socket, 'local_service_down', 'Local service unavailable', http=http)
+    
+    def _wait_for_service(self, tunnel_id, public_port):
+        deadline = time.monotonic() + SERVICE_DOWN_GRACE
+        while self.service_down(tunnel_id):
+            if time.monotonic() >= deadline or public_port not in self.active_ports:
+                return False
+            time.sleep(0.1)
+        return True
+    
+    def export_listeners(self):
+        """Return (metadata, socket) for every bound public listener."""
+        exported = []
+        for (public_port, kind), server_socket in list(self.listeners.items()):
+            port_info = self.active_ports.get(public_port)
+            if port_info is None:
+                continue
+            exported.append(({
+                'tunnel_id': port_info['tunnel_id'],
+                'public_port': public_port,
+                'protocol': port_info['protocol'],
+                'kind': kind,
+                'socket_profile': port_info['socket_profile'],
+                'socket_options': port_info['socket_options'] if port_info['socket_profile'] == 'custom' else None
+            }, server_socket))
+        return exported
+    
+    def begin_drain(self):
+        """Stop accepting on every listener but keep existing streams running."""
+        self.draining = True
+        for public_port in list(self.stop_flags.keys()):
+            self.stop_flags[public_port] = True
+    
+    def active_stream_count(self, tunnel_id=None):
+        return sum(
+            1 for conn in list(active_connections.values())
+            if conn.type == 'TCP' and (tunnel_id is None or conn.tunnel_id == tunnel_id)
+        )
+    
+    def describe_thread(self, thread_name):
+        """Return what a proxy thread is serving, for thread dumps."""
+        kind, _, key = thread_name.rpartition('-')
+        if kind in ('tcp-accept', 'udp-listen') and key.isdigit():
+            port_info = self.active_ports.get(int(key))
+            if port_info:
+                return {'public_port': int(key), 'tunnel_id': port_info['tunnel_id'], 'protocol': port_info['protocol']}
+            return {'public_port': int(key), 'stopping': True}
+        
+        for prefix in ('tcp-stream-', 'udp-packet-'):
+            if thread_name.startswith(prefix):
+                conn_id = thread_name[len(prefix):]
+                conn_id = int(conn_id) if conn_id.isdigit() else conn_id
+                # Read without connection_lock so a dump never perturbs the
+                # contention it is trying to observe.
+                conn = active_connections.get(conn_id)
+                if conn:
+                    return {
+                        'conn_id': conn_id,
+                        'tunnel_id': conn.tunnel_id,
+                        'type': conn.type,
+                        'active': conn.active
+                    }
+                return {'conn_id': conn_id, 'registered': False}
+        return None
+    
+    def snapshot(self):
+        connections = {}
+        for conn in list(active_connections.values()):
+            key = (conn.tunnel_id, conn.type)
+            connections[key] = connections.get(key, 0) + 1
+        return {
+            'ports': [
+                dict(public_port=port, tunnel_id=info['tunnel_id'], protocol=info['protocol'], socket_profile=info['socket_profile'])
+                for port, info in list(self.active_ports.items())
+            ],
+            'connections': [
+                {'tunnel_id': tunnel_id, 'type': conn_type, 'count': count}
+                for (tunnel_id, conn_type), count in connections.items()
+            ],
+            'connection_lock': connection_lock.stats(),
+            'batching': {sid: batcher.stats() for sid, batcher in list(self.batchers.items())}
+        }
+    
+    def _tcp_proxy_worker(self, tunnel_id, public_port, options, auto_tune, server_socket=None, http=False):
+        inherited = server_socket is not None
+        if not inherited:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
         try:
-            server_socket.bind(('0.0.0.0', public_port))
-            server_socket.listen(50)
+            if not inherited:
+                backlog = apply_listener_options(server_socket, options)
+                server_socket.bind(('0.0.0.0', public_port))
+                server_socket.listen(backlog)
             server_socket.settimeout(1.0)
-            print(f'[*] TCP Proxy listening on 0.0.0.0:{public_port}')
+            self.listeners[(public_port, 'tcp')] = server_socket
+            print(f'[*] TCP Proxy {"inherited" if inherited else "listening on"} 0.0.0.0:{public_port}')
             
             while not self.stop_flags.get(public_port, False):
                 try:
                     client_socket, addr = server_socket.accept()
+                    
+                    # The client told us its local service is refusing
+                    # connections; fail now rather than after a round trip.
+                    if SERVICE_DOWN_GRACE <= 0 and self.service_down(tunnel_id):
+                        self._reject_service_down(client_socket, tunnel_id, addr, http)
+                        continue
+                    
+                    # Admission happens before a handler thread exists, so an
+                    # overloaded tunnel costs one accept and one close per
+                    # rejected connection. The accept loop never waits: a
+                    # queued connection waits for capacity on its own thread.
+                    reason = admission.try_admit_stream(tunnel_id)
+                    if reason and reason != QUEUED:
+                        print(f'[!] Rejected TCP connection from {addr} on port {public_port}: {reason}')
+                        reject_connection(client_socket, reason, http=http)
+                        continue
                     print(f'[+] New TCP connection from {addr} on port {public_port}')
                     
                     handler_thread = threading.Thread(
                         target=self._handle_tcp_stream,
-                        args=(client_socket, tunnel_id, public_port, addr),
+                        args=(client_socket, tunnel_id, public_port, addr, options, auto_tune, http, reason == QUEUED),
                         daemon=True
                     )
                     handler_thread.start()
@@ -96,19 +429,22 @@ class TrafficProxy:
         except Exception as e:
             print(f'[!] Error starting TCP proxy on port {public_port}: {e}')
         finally:
-            server_socket.close()
-            print(f'[-] TCP Proxy stopped on port {public_port}')
+            self._release_listener(public_port, 'tcp', server_socket)
     
-    def _udp_proxy_worker(self, tunnel_id, public_port):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    def _udp_proxy_worker(self, tunnel_id, public_port, options, server_socket=None):
+        inherited = server_socket is not None
+        udp_sessions = {}
+        if not inherited:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
         try:
-            server_socket.bind(('0.0.0.0', public_port))
+            if not inherited:
+                apply_listener_options(server_socket, options)
+                server_socket.bind(('0.0.0.0', public_port))
             server_socket.settimeout(1.0)
-            print(f'[*] UDP Proxy listening on 0.0.0.0:{public_port}')
-            
-            udp_sessions = {}
+            self.listeners[(public_port, 'udp')] = server_socket
+            print(f'[*] UDP Proxy {"inherited" if inherited else "listening on"} 0.0.0.0:{public_port}')
             
             while not self.stop_flags.get(public_port, False):
                 try:
@@ -117,30 +453,49 @@ class TrafficProxy:
                     
                     session_key = f"{addr[0]}:{addr[1]}"
                     if session_key not in udp_sessions:
-                        session_id = str(uuid.uuid4())
-                        udp_sessions[session_key] = {
-                            'session_id': session_id,
-                            'addr': addr,
-                            'last_activity': time.time()
-                        }
+                        if self.service_down(tunnel_id):
+                            self.service_rejections[tunnel_id] = self.service_rejections.get(tunnel_id, 0) + 1
+                            print(f'[!] Dropped UDP packet from {addr} on port {public_port}: local service down')
+                            continue
+                        reason = admission.admit_udp_session(tunnel_id)
+                        if reason:
+                            print(f'[!] Dropped UDP packet from {addr} on port {public_port}: {reason}')
+                            continue
+                        session_id = stream_ids.allocate()
+                        session = udp_sessions[session_key] = (session_id, Connection(server_socket, tunnel_id, 'UDP', addr))
+                        with connection_lock:
+                            active_connections[session_id] = session[1]
                         print(f'[*] Created UDP session {session_id} for {addr}')
                     else:
-                        udp_sessions[session_key]['last_activity'] = time.time()
+                        session = udp_sessions[session_key]
+                        session[1].last_activity = time.time()
                     
-                    session_id = udp_sessions[session_key]['session_id']
+                    session_id = session[0]
+                    
+                    # Each in-flight packet holds its payload on a thread;
+                    # cap the bytes rather than letting a flood spawn threads.
+                    reason = admission.reserve_bytes(tunnel_id, len(data), wait=False)
+                    if reason:
+                        print(f'[!] Dropped UDP packet from {addr} on port {public_port}: {reason}')
+                        continue
                     
                     handler_thread = threading.Thread(
                         target=self._handle_udp_packet,
                         args=(server_socket, data, addr, tunnel_id, public_port, session_id),
+                        name=f'udp-packet-{session_id}',
                         daemon=True
                     )
                     handler_thread.start()
                     
                     current_time = time.time()
-                    for key in list(udp_sessions.keys()):
-                        if current_time - udp_sessions[key]['last_activity'] > 120:
-                            print(f'[*] Expiring UDP session {udp_sessions[key]["session_id"]}')
+                    for key, (expired_id, expired) in list(udp_sessions.items()):
+                        if current_time - expired.last_activity > 120:
+                            print(f'[*] Expiring UDP session {expired_id}')
                             del udp_sessions[key]
+                            with connection_lock:
+                                active_connections.pop(expired_id, None)
+                            stream_ids.release(expired_id)
+                            admission.release_udp_session(tunnel_id)
                     
                 except socket.timeout:
                     continue
@@ -150,83 +505,298 @@ class TrafficProxy:
         except Exception as e:
             print(f'[!] Error starting UDP proxy on port {public_port}: {e}')
         finally:
+            if udp_sessions:
+                with connection_lock:
+                    for session_id, _ in udp_sessions.values():
+                        active_connections.pop(session_id, None)
+                for session_id, _ in udp_sessions.values():
+                    stream_ids.release(session_id)
+                admission.release_udp_session(tunnel_id, len(udp_sessions))
+            self._release_listener(public_port, 'udp', server_socket)
+    
+    def _release_listener(self, public_port, kind, server_socket):
+        if self.listeners.get((public_port, kind)) is server_socket:
+            del self.listeners[(public_port, kind)]
+        # While draining, the successor process owns the listener and UDP
+        # replies for existing sessions still go out through this socket, so
+        # it is left for process exit to close.
+        if not self.draining:
             server_socket.close()
-            print(f'[-] UDP Proxy stopped on port {public_port}')
+        print(f'[-] {kind.upper()} Proxy stopped on port {public_port}')
+    
+    def _read_initial_bytes(self, client_socket, read_size):
+        """Return the bytes the peer has already sent, without blocking."""
+        try:
+            if OPEN_DATA_WAIT > 0:
+                select.select([client_socket], [], [], OPEN_DATA_WAIT)
+            client_socket.settimeout(0.0)
+            return client_socket.recv(read_size)
+        except (BlockingIOError, InterruptedError):
+            return b''
+        finally:
+            client_socket.settimeout(300.0)
+    
+    def _wait_for_tunnel(self, tunnel_id, public_port):
+        deadline = time.monotonic() + RECONNECT_GRACE
+        while tunnel_id not in self.connected_tunnels:
+            if time.monotonic() >= deadline or public_port not in self.active_ports:
+                return False
+            time.sleep(0.1)
+        return True
     
-    def _handle_tcp_stream(self, client_socket, tunnel_id, public_port, addr):
-        conn_id = str(uuid.uuid4())
+    def _handle_tcp_stream(self, client_socket, tunnel_id, public_port, addr, options, auto_tune, http=False, queued=False):
+        if queued:
+            reason = admission.wait_stream(tunnel_id)
+            if reason:
+                print(f'[!] Rejected TCP connection from {addr} on port {public_port}: {reason}')
+                reject_connection(client_socket, reason, http=http)
+                return
+        try:
+            conn_id = stream_ids.allocate()
+        except RuntimeError as e:
+            print(f'[!] Rejected TCP connection from {addr}: {e}')
+            reject_connection(client_socket, 'stream_ids', http=http)
+            admission.release_stream(tunnel_id, True)
+            return
+        threading.current_thread().name = f'tcp-stream-{conn_id}'
+        # Admitted by the accept loop; stays pending until the client
+        # reports that its local connection is up.
+        conn = Connection(
+            client_socket, tunnel_id, 'TCP', addr, pending=True,
+            read_size=options['read_size'], qos_class=options['qos_class'],
+            classifier=StreamClassifier() if auto_tune and not http else None
+        )
+        conn.writer = StreamWriter(
+            client_socket, conn_id,
+            on_pause=lambda: self._signal_flow(tunnel_id, 'pause_stream', conn_id),
+            on_resume=lambda: self._signal_flow(tunnel_id, 'resume_stream', conn_id),
+            on_error=lambda e: _write_failed(conn, conn_id, e),
+            on_drained=lambda nbytes: admission.release_writer_bytes(tunnel_id, nbytes)
+        )
         
         try:
             client_socket.settimeout(300.0)
+            apply_stream_options(client_socket, options)
             
-            if tunnel_id not in self.connected_tunnels:
+            if tunnel_id not in self.connected_tunnels and not self._wait_for_tunnel(tunnel_id, public_port):
                 print(f'[!] Tunnel {tunnel_id} not connected')
-                client_socket.send(b'HTTP/1.1 503 Service Unavailable\r\n\r\nTunnel not connected')
-                client_socket.close()
+                reject_connection(client_socket, 'tunnel_not_connected', 'Tunnel not connected', http=http)
+                return
+            
+            if self.service_down(tunnel_id) and not self._wait_for_service(tunnel_id, public_port):
+                self._reject_service_down(client_socket, tunnel_id, addr, http)
                 return
             
             tunnel_info = self.connected_tunnels[tunnel_id]
-            client_sid = tunnel_info['sid']
             
             with connection_lock:
-                active_connections[conn_id] = {
-                    'socket': client_socket,
-                    'tunnel_id': tunnel_id,
-                    'type': 'TCP',
-                    'active': True,
-                    'buffer': []
-                }
-            
-            self.socketio.emit('new_connection', {
-                'conn_id': conn_id,
-                'tunnel_id': tunnel_id,
-                'protocol': 'TCP'
-            }, to=client_sid)
+                active_connections[conn_id] = conn
             
-            print(f'[*] TCP stream {conn_id} established for tunnel {tunnel_id}')
+            traffic_accountant.record(tunnel_id, connections=1)
+            recorder = self.recorders.get(tunnel_id)
+            if recorder is not None:
+                recorder.record(OPEN, conn_id)
             
-            while True:
-                with connection_lock:
-                    if conn_id not in active_connections or not active_connections[conn_id]['active']:
-                        break
-                
-                try:
-                    data = client_socket.recv(8192)
-                    if not data:
-                        print(f'[*] TCP client closed connection {conn_id}')
-                        break
-                    
-                    data_b64 = base64.b64encode(data).decode('ascii')
-                    self.socketio.emit('stream_data', {
-                        'conn_id': conn_id,
-                        'data': data_b64,
-                        'protocol': 'TCP'
-                    }, to=client_sid)
-                    
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    print(f'[!] Error reading TCP stream {conn_id}: {e}')
-                    break
+            # Clients too old for request multiplexing get HTTP tunnels as
+            # plain TCP streams.
+            if http and tunnel_info.get('http_requests'):
+                self._serve_http(conn_id, conn, tunnel_info, tunnel_id)
+                return
             
-            self.socketio.emit('close_connection', {
-                'conn_id': conn_id
-            }, to=client_sid)
+            # Optimistic open: a request the peer sent straight after
+            # connecting travels with the open instead of behind it.
+            initial = self._read_initial_bytes(client_socket, conn.read_size) if tunnel_info.get('early_data') else b''
+            if initial:
+                traffic_accountant.record(tunnel_id, bytes_in=len(initial))
+                if recorder is not None:
+                    recorder.record(DATA_IN, conn_id, initial)
+                if conn.classifier is not None:
+                    conn.classifier.observe(len(initial))
+            self._pump_tcp_stream(conn_id, conn, tunnel_info, tunnel_id, initial)
             
         except Exception as e:
             print(f'[!] Error handling TCP stream {conn_id}: {e}')
+            traffic_accountant.record(tunnel_id, errors=1)
         finally:
             with connection_lock:
-                if conn_id in active_connections:
-                    active_connections[conn_id]['active'] = False
-                    try:
-                        active_connections[conn_id]['socket'].close()
-                    except:
-                        pass
+                conn.active = False
+                if active_connections.get(conn_id) is conn:
                     del active_connections[conn_id]
+                pending = conn.pending
+                conn.pending = False
+                gate = paused_streams.pop(conn_id, None)
+            if gate is not None:
+                gate.set()
+            conn.writer.abort(client_socket.close)
+            stream_ids.release(conn_id)
+            admission.release_stream(tunnel_id, pending)
+            recorder = self.recorders.get(tunnel_id)
+            if recorder is not None:
+                recorder.record(CLOSE, conn_id)
             print(f'[-] TCP stream {conn_id} closed')
     
+    def _pump_tcp_stream(self, conn_id, conn, tunnel_info, tunnel_id, initial=b''):
+        """Open the stream on the client and copy public bytes to it until either side closes."""
+        client_socket = conn.socket
+        open_frame = {
+            'conn_id': conn_id,
+            'tunnel_id': tunnel_id,
+            'protocol': 'TCP',
+            'qos_class': conn.qos_class
+        }
+        if initial:
+            open_frame['data'] = base64.b64encode(initial).decode('ascii')
+        self.socketio.emit('new_connection', open_frame, to=tunnel_info['sid'])
+        print(f'[*] TCP stream {conn_id} established for tunnel {tunnel_id}'
+              + (f' with {len(initial)} bytes of early data' if initial else ''))
+        
+        while True:
+            with connection_lock:
+                if not conn.active or active_connections.get(conn_id) is not conn:
+                    break
+                read_size = conn.read_size
+                classifier = conn.classifier
+            
+            try:
+                data = client_socket.recv(read_size)
+                if not data:
+                    print(f'[*] TCP client closed connection {conn_id}')
+                    break
+                
+                traffic_accountant.record(tunnel_id, bytes_in=len(data))
+                recorder = self.recorders.get(tunnel_id)
+                if recorder is not None:
+                    recorder.record(DATA_IN, conn_id, data)
+                if classifier is not None:
+                    profile = classifier.observe(len(data))
+                    if profile:
+                        retune_stream(conn_id, profile)
+                
+                if not self._forward_inbound(tunnel_info, tunnel_id, conn, conn_id, data):
+                    break
+                
+            except socket.timeout:
+                continue
+            except Exception as e:
+                print(f'[!] Error reading TCP stream {conn_id}: {e}')
+                traffic_accountant.record(tunnel_id, errors=1)
+                break
+        
+        self._send_close(tunnel_info, conn_id, conn.qos_class)
+    
+    def _forward_inbound(self, tunnel_info, tunnel_id, conn, stream_id, data):
+        # Stop reading from this public socket while the client's side of the
+        # stream is paused or the tunnel is over its buffer budget.
+        gate = paused_streams.get(stream_id)
+        while gate is not None and conn.active and not gate.wait(1.0):
+            pass
+        reserved = admission.reserve_bytes(tunnel_id, len(data)) is None
+        while not reserved and conn.active:
+            time.sleep(0.05)
+            reserved = admission.reserve_bytes(tunnel_id, len(data)) is None
+        return reserved and self._send_stream_data(tunnel_info, tunnel_id, stream_id, data, conn.qos_class)
+    
+    def _read_public(self, conn_id, conn, tunnel_id):
+        """Next bytes from a public socket for HttpRequestReader; b'' once it is closed."""
+        while conn.active:
+            try:
+                data = conn.socket.recv(conn.read_size)
+            except socket.timeout:
+                continue
+            except OSError:
+                return b''
+            if data:
+                traffic_accountant.record(tunnel_id, bytes_in=len(data))
+                _record(tunnel_id, DATA_IN, conn_id, data)
+            return data
+        return b''
+    
+    def _serve_http(self, conn_id, conn, tunnel_info, tunnel_id):
+        """Send the requests on an HTTP tunnel connection to the client one at a time.
+
+        Each request gets its own stream id. The client writes the response
+        under conn_id, straight to the public socket, then closes the
+        request's id; it closes conn_id instead when the response can only
+        end with the connection. The next request is not sent until the
+        previous response is complete, which keeps pipelined responses in
+        order.
+        """
+        # No local connect is waited for per public connection.
+        mark_connection_ready(conn_id)
+        reader = HttpRequestReader(lambda: self._read_public(conn_id, conn, tunnel_id))
+        try:
+            while conn.active:
+                request = reader.read_head()
+                if request is None:
+                    return
+                if request.upgrade:
+                    print(f'[*] HTTP stream {conn_id} upgraded, forwarding it as raw TCP')
+                    self._pump_tcp_stream(conn_id, conn, tunnel_info, tunnel_id, request.head + reader.buffer)
+                    return
+                
+                framing = request.framing()
+                body = reader.read_body(framing)
+                head = request.local_head()
+                data = head
+                for chunk in body:
+                    data += chunk
+                    if len(data) - len(head) >= HTTP_BUFFER_BYTES:
+                        break
+                if not self._forward_request(conn_id, conn, tunnel_info, tunnel_id, request, framing, body, data):
+                    return
+                if not request.keep_alive:
+                    return
+        except HttpError as e:
+            print(f'[!] Bad request on HTTP stream {conn_id}: {e}')
+            try:
+                conn.socket.sendall(e.response())
+            except OSError:
+                pass
+        except ConnectionError:
+            pass
+    
+    def _forward_request(self, conn_id, conn, tunnel_info, tunnel_id, request, framing, body, data):
+        """Send one request and wait for its response; False if the connection has to end."""
+        req_id = stream_ids.allocate()
+        done = threading.Event()
+        with connection_lock:
+            http_requests[req_id] = (done, conn)
+        try:
+            self.socketio.emit('new_connection', {
+                'conn_id': req_id,
+                'stream': conn_id,
+                'tunnel_id': tunnel_id,
+                'protocol': 'HTTP',
+                'qos_class': conn.qos_class,
+                'method': request.method,
+                'complete': framing.done,
+                'data': base64.b64encode(data).decode('ascii')
+            }, to=tunnel_info['sid'])
+            
+            for chunk in body:
+                # Answered before the whole body was sent: the rest can
+                # only be discarded along with the connection.
+                if done.is_set():
+                    return False
+                if not self._forward_inbound(tunnel_info, tunnel_id, conn, req_id, chunk):
+                    return False
+            
+            while not done.wait(1.0):
+                if not conn.active or active_connections.get(conn_id) is not conn:
+                    return False
+            return framing.done
+        finally:
+            with connection_lock:
+                http_requests.pop(req_id, None)
+                gate = paused_streams.pop(req_id, None)
+            if gate is not None:
+                gate.set()
+            if not done.is_set():
+                self._send_close(tunnel_info, req_id, conn.qos_class)
+            stream_ids.release(req_id)
+    
     def _handle_udp_packet(self, server_socket, data, addr, tunnel_id, public_port, session_id):
+        handed_off = False
         try:
             if tunnel_id not in self.connected_tunnels:
                 print(f'[!] Tunnel {tunnel_id} not connected')
@@ -235,71 +805,169 @@ class TrafficProxy:
             tunnel_info = self.connected_tunnels[tunnel_id]
             client_sid = tunnel_info['sid']
             
+            traffic_accountant.record(tunnel_id, bytes_in=len(data), udp_packets=1)
+            recorder = self.recorders.get(tunnel_id)
+            if recorder is not None:
+                recorder.record(UDP_IN, session_id, data)
             data_b64 = base64.b64encode(data).decode('ascii')
             
-            self.socketio.emit('udp_packet', {
+            # From here the reservation is _emit_reserved's to release.
+            handed_off = True
+            self._emit_reserved('udp_packet', {
                 'session_id': session_id,
                 'data': data_b64,
                 'tunnel_id': tunnel_id,
                 'addr': f"{addr[0]}:{addr[1]}"
-            }, to=client_sid)
-            
-            with connection_lock:
-                if session_id not in active_connections:
-                    active_connections[session_id] = {
-                        'socket': server_socket,
-                        'tunnel_id': tunnel_id,
-                        'type': 'UDP',
-                        'addr': addr,
-                        'active': True
-                    }
+            }, client_sid, tunnel_id, len(data))
             
         except Exception as e:
             print(f'[!] Error handling UDP packet: {e}')
+            traffic_accountant.record(tunnel_id, errors=1)
+        finally:
+            if not handed_off:
+                admission.release_bytes(tunnel_id, len(data))
 
 proxy_instance = None
 
+def _release_flushed_bytes(accounts):
+    for tunnel_id, nbytes in accounts.items():
+        admission.release_bytes(tunnel_id, nbytes)
+
+def _record(tunnel_id, kind, stream_key, data):
+    recorder = proxy_instance.recorders.get(tunnel_id) if proxy_instance is not None else None
+    if recorder is not None:
+        recorder.record(kind, stream_key, data)
+
 def get_proxy_instance(socketio_instance, connected_tunnels):
     global proxy_instance
     if proxy_instance is None:
         proxy_instance = TrafficProxy(socketio_instance, connected_tunnels)
     return proxy_instance
 
+def retune_stream(conn_id, profile):
+    """Apply an auto-classified profile to both ends of a TCP stream."""
+    options = resolve_profile(profile)
+    with connection_lock:
+        conn = active_connections.get(conn_id)
+        if conn is None or not conn.active:
+            return
+        conn.classifier = None
+        conn.read_size = options['read_size']
+        conn.qos_class = options['qos_class']
+        apply_stream_options(conn.socket, options)
+        tunnel_id = conn.tunnel_id
+    
+    if proxy_instance is not None and tunnel_id in proxy_instance.connected_tunnels:
+        proxy_instance.socketio.emit('tune_connection', {
+            'conn_id': conn_id,
+            'profile': profile,
+            'socket_options': options
+        }, to=proxy_instance.connected_tunnels[tunnel_id]['sid'])
+    print(f'[*] TCP stream {conn_id} classified as {profile}')
+
 def handle_stream_response(conn_id, data):
     with connection_lock:
-        if conn_id in active_connections and active_connections[conn_id]['active']:
-            try:
-                if isinstance(data, str):
-                    data = base64.b64decode(data)
-                active_connections[conn_id]['socket'].send(data)
-                return True
-            except Exception as e:
-                print(f'[!] Error sending to connection {conn_id}: {e}')
-                active_connections[conn_id]['active'] = False
-                return False
-    return False
+        conn = active_connections.get(conn_id)
+        if conn is None or not conn.active or conn.type != 'TCP':
+            return False
+    
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    # Queued for the stream's own writer: this runs on the thread applying
+    # the client's batches, which a public peer that stops reading must
+    # never block. Only a client that cannot be paused is held up, once
+    # STREAM_BUFFER_MAX bytes are queued. Writer backlogs count against the
+    # tunnel's writer budget; over it, the stream is paused early.
+    tunnel_info = proxy_instance.connected_tunnels.get(conn.tunnel_id) if proxy_instance else None
+    block = not (tunnel_info and tunnel_info.get('stream_pause'))
+    over_budget = admission.hold_writer_bytes(conn.tunnel_id, len(data))
+    if not conn.writer.write(data, block=block, pause=over_budget):
+        admission.release_writer_bytes(conn.tunnel_id, len(data))
+        return False
+    classifier = conn.classifier
+    profile = classifier.observe(len(data)) if classifier is not None else None
+    traffic_accountant.record(conn.tunnel_id, bytes_out=len(data))
+    _record(conn.tunnel_id, DATA_OUT, conn_id, data)
+    if profile:
+        retune_stream(conn_id, profile)
+    return True
+
+def _write_failed(conn, conn_id, error):
+    print(f'[!] Error sending to connection {conn_id}: {error}')
+    traffic_accountant.record(conn.tunnel_id, errors=1)
+    conn.active = False
+
+def mark_connection_ready(conn_id):
+    """The client connected to its local service; the open is no longer pending."""
+    with connection_lock:
+        conn = active_connections.get(conn_id)
+        if conn is None or not conn.pending:
+            return
+        conn.pending = False
+        tunnel_id = conn.tunnel_id
+    admission.stream_opened(tunnel_id)
 
 def handle_udp_response(session_id, data):
     with connection_lock:
-        if session_id in active_connections and active_connections[session_id]['type'] == 'UDP':
-            try:
-                if isinstance(data, str):
-                    data = base64.b64decode(data)
-                server_socket = active_connections[session_id]['socket']
-                addr = active_connections[session_id]['addr']
-                server_socket.sendto(data, addr)
-                return True
-            except Exception as e:
-                print(f'[!] Error sending UDP to session {session_id}: {e}')
-                return False
-    return False
+        conn = active_connections.get(session_id)
+        if conn is None or conn.type != 'UDP':
+            return False
+        try:
+            if isinstance(data, str):
+                data = base64.b64decode(data)
+            conn.socket.sendto(data, conn.addr)
+            traffic_accountant.record(conn.tunnel_id, bytes_out=len(data))
+            _record(conn.tunnel_id, UDP_OUT, session_id, data)
+            return True
+        except Exception as e:
+            print(f'[!] Error sending UDP to session {session_id}: {e}')
+            traffic_accountant.record(conn.tunnel_id, errors=1)
+            return False
 
 def close_connection(conn_id):
     with connection_lock:
-        if conn_id in active_connections:
-            active_connections[conn_id]['active'] = False
-            try:
-                active_connections[conn_id]['socket'].close()
-            except:
-                pass
+        request = http_requests.get(conn_id)
+        if request is not None:
+            # The response is complete once the public socket has it all.
+            done, conn = request
+            conn.writer.finish(done.set)
+            return
+        conn = active_connections.get(conn_id)
+        # UDP sessions share the listener socket and end by expiring.
+        if conn is None or conn.type != 'TCP':
+            return
+    # Data the client sent before the close is written out first.
+    conn.writer.finish(lambda: _shut_stream(conn_id, conn))
+
+def _shut_stream(conn_id, conn):
+    with connection_lock:
+        conn.active = False
+        if active_connections.get(conn_id) is conn:
             del active_connections[conn_id]
+    # close() sends no FIN while the stream's thread is blocked in recv() on
+    # the socket; shutdown() wakes it, and it closes the socket itself on
+    # the way out.
+    try:
+        conn.socket.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def stream_tunnel(stream_id):
+    """Tunnel id of a live TCP stream, UDP session or HTTP request, or None."""
+    with connection_lock:
+        request = http_requests.get(stream_id)
+        conn = request[1] if request is not None else active_connections.get(stream_id)
+        return conn.tunnel_id if conn is not None else None
+
+def pause_stream(stream_id):
+    """The client's local service is not keeping up: stop reading this stream from the public side."""
+    with connection_lock:
+        conn = active_connections.get(stream_id)
+        if stream_id in http_requests or (conn is not None and conn.type == 'TCP'):
+            paused_streams.setdefault(stream_id, threading.Event())
+
+def resume_stream(stream_id):
+    with connection_lock:
+        gate = paused_streams.pop(stream_id, None)
+    if gate is not None:
+        gate.set()
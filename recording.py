@@ -0,0 +1,171 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+# Opt-in per-tunnel traffic recording. Events go into a fixed-size file that
+# is memory-mapped and used as a ring: once it is full the oldest events are
+# overwritten, so a recording can be left running without filling the disk.
+RECORDING_DIR = os.getenv('RECORDING_DIR', 'recordings')
+RECORDING_MAX_BYTES = int(os.getenv('RECORDING_MAX_BYTES', str(64 * 1024 * 1024)))
+# Payloads longer than this are truncated; only their length is kept.
+# -1 keeps whole payloads, 0 records traffic shape only.
+RECORDING_PAYLOAD_BYTES = int(os.getenv('RECORDING_PAYLOAD_BYTES', '-1'))
+
+MAGIC = b'PFREC001'
+# magic, capacity, head, tail, wrap_end, count, dropped, payload_limit, started
+HEADER = struct.Struct('<8sQQQQQQqd')
+HEADER_SIZE = 128
+# microseconds since start, kind, stream, original length, stored length
+EVENT = struct.Struct('<QBIII')
+
+OPEN, DATA_IN, DATA_OUT, CLOSE, UDP_IN, UDP_OUT = range(1, 7)
+KIND_NAMES = {
+    OPEN: 'open', DATA_IN: 'data_in', DATA_OUT: 'data_out',
+    CLOSE: 'close', UDP_IN: 'udp_in', UDP_OUT: 'udp_out'
+}
+
+
+class TrafficRecorder:
+    """Writes open/data/close/UDP events for one tunnel into a ring file.
+
+    DATA_IN/UDP_IN are bytes from the public peer, DATA_OUT/UDP_OUT bytes
+    sent back to it. Streams are numbered in order of first appearance so
+    an event costs EVENT.size bytes plus its stored payload. Events never
+    straddle the end of the ring; a write that does not fit wraps to the
+    start and evicts the oldest events it overlaps.
+    """
+
+    def __init__(self, path, max_bytes=RECORDING_MAX_BYTES, payload_limit=RECORDING_PAYLOAD_BYTES):
+        self.path = path
+        self.payload_limit = payload_limit
+        self.capacity = max(max_bytes - HEADER_SIZE, EVENT.size * 16)
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._next_stream = 0
+        self._started = time.time()
+        self._clock = time.monotonic()
+        self._head = self._tail = self._count = self._dropped = 0
+        self._wrap_end = self.capacity
+        self.events = 0
+        self.bytes = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'w+b')
+        self._file.truncate(HEADER_SIZE + self.capacity)
+        self._map = mmap.mmap(self._file.fileno(), HEADER_SIZE + self.capacity)
+        self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(
+            self._map, 0, MAGIC, self.capacity, self._head, self._tail, self._wrap_end,
+            self._count, self._dropped, self.payload_limit, self._started
+        )
+
+    def _evict(self):
+        _, _, _, _, stored = EVENT.unpack_from(self._map, HEADER_SIZE + self._tail)
+        self._tail += EVENT.size + stored
+        self._count -= 1
+        self._dropped += 1
+        if self._tail >= self._wrap_end:
+            self._tail = 0
+            self._wrap_end = self.capacity
+
+    def record(self, kind, stream_key, data=b'', length=None):
+        length = len(data) if length is None else length
+        if self.payload_limit >= 0 and len(data) > self.payload_limit:
+            data = data[:self.payload_limit]
+        size = EVENT.size + len(data)
+        if size > self.capacity:
+            return
+
+        with self._lock:
+            if self._map is None:
+                return
+            stream = self._streams.get(stream_key)
+            if stream is None:
+                stream = self._streams[stream_key] = self._next_stream
+                self._next_stream += 1
+            if kind == CLOSE:
+                del self._streams[stream_key]
+
+            if self._head + size > self.capacity:
+                # Everything after head is older than what we are about to
+                # write; it is given up along with the unused tail space.
+                while self._count and self._tail >= self._head:
+                    self._evict()
+                self._wrap_end = self._head
+                self._head = 0
+            while self._count and self._head <= self._tail < self._head + size:
+                self._evict()
+            if not self._count:
+                self._tail = self._head
+                self._wrap_end = self.capacity
+
+            offset = HEADER_SIZE + self._head
+            micros = int((time.monotonic() - self._clock) * 1000000)
+            EVENT.pack_into(self._map, offset, micros, kind, stream, length, len(data))
+            if data:
+                self._map[offset + EVENT.size:offset + size] = data
+            self._head += size
+            self._count += 1
+            self.events += 1
+            self.bytes += length
+            self._write_header()
+
+    def status(self):
+        return {
+            'path': self.path,
+            'started': self._started,
+            'capacity': self.capacity,
+            'payload_limit': self.payload_limit,
+            'events': self.events,
+            'bytes': self.bytes,
+            'retained_events': self._count,
+            'overwritten_events': self._dropped,
+            'open_streams': len(self._streams)
+        }
+
+    def close(self):
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.close()
+
+
+def read_recording(path):
+    """Return (header dict, events oldest first) from a ring file.
+
+    Each event is (seconds since recording start, kind, stream, length,
+    payload); payload may be shorter than length if it was truncated.
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    magic, capacity, head, tail, wrap_end, count, dropped, payload_limit, started = HEADER.unpack_from(raw, 0)
+    if magic != MAGIC:
+        raise ValueError(f'{path} is not a traffic recording')
+
+    events = []
+    pos = tail
+    for _ in range(count):
+        if pos >= wrap_end:
+            pos = 0
+        micros, kind, stream, length, stored = EVENT.unpack_from(raw, HEADER_SIZE + pos)
+        start = HEADER_SIZE + pos + EVENT.size
+        events.append((micros / 1000000, kind, stream, length, raw[start:start + stored]))
+        pos += EVENT.size + stored
+
+    header = {
+        'capacity': capacity,
+        'events': count,
+        'overwritten_events': dropped,
+        'payload_limit': payload_limit,
+        'started': started
+    }
+    return header, events
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Replay a traffic recording against a tunnel's public port.
+
+Every recorded TCP stream and UDP session is re-opened against HOST:PORT
+and its inbound bytes are sent with the original timing divided by
+`speed`; `copies` runs that many instances of the recording at once.
+Truncated payloads are padded with zeros to their recorded length, so the
+traffic shape is preserved even when the content was not kept.
+
+Streams whose open was overwritten in the ring are skipped; replaying
+them from the middle would not mean anything to the backend.
+
+Usage: python replay.py RECORDING HOST PORT [speed] [copies]
+"""
+import socket
+import sys
+import threading
+import time
+
+from recording import CLOSE, DATA_IN, DATA_OUT, OPEN, UDP_IN, UDP_OUT, read_recording
+
+# How long to wait for the responses a stream got in the recording.
+RESPONSE_TIMEOUT = 5.0
+
+
+def _payload(payload, length):
+    if len(payload) < length:
+        return payload + bytes(length - len(payload))
+    return payload
+
+
+def _first_byte_latencies(sends, receives):
+    """Time from each send to the first byte received before the next send."""
+    latencies = []
+    index = 0
+    for i, sent in enumerate(sends):
+        limit = sends[i + 1] if i + 1 < len(sends) else float('inf')
+        while index < len(receives) and receives[index] < sent:
+            index += 1
+        if index < len(receives) and receives[index] < limit:
+            latencies.append(receives[index] - sent)
+    return latencies
+
+
+class Replay:
+    def __init__(self, path, host, port, speed=1.0, copies=1):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.copies = copies
+        self.header, events = read_recording(path)
+        # Replay starts at the oldest retained event, not at the time the
+        # recording was switched on.
+        base = events[0][0] if events else 0.0
+        self.streams = {}
+        for offset, kind, stream, length, payload in events:
+            self.streams.setdefault(stream, []).append((offset - base, kind, stream, length, payload))
+        self.lock = threading.Lock()
+        self.results = {
+            'streams': 0, 'udp_sessions': 0, 'skipped': 0, 'failed': 0,
+            'bytes_sent': 0, 'bytes_received': 0, 'bytes_expected': 0
+        }
+        self.latencies = []
+
+    def _add(self, sent, received, expected, latencies, key):
+        with self.lock:
+            self.results[key] += 1
+            self.results['bytes_sent'] += sent
+            self.results['bytes_received'] += received
+            self.results['bytes_expected'] += expected
+            self.latencies.extend(latencies)
+
+    def _wait_until(self, start, offset):
+        delay = start + offset / self.speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _replay_tcp(self, events, start):
+        expected = sum(length for _, kind, _, length, _ in events if kind == DATA_OUT)
+        receives = []
+        received = [0]
+        done = threading.Event()
+
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=10)
+        except OSError as e:
+            print(f'[!] Connect failed: {e}')
+            with self.lock:
+                self.results['failed'] += 1
+            return
+
+        def read():
+            try:
+                while True:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    receives.append(time.perf_counter())
+                    received[0] += len(data)
+                    if received[0] >= expected:
+                        done.set()
+            except OSError:
+                pass
+            done.set()
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        sends = []
+        sent = 0
+        try:
+            for offset, kind, _, length, payload in events:
+                self._wait_until(start, offset)
+                if kind == DATA_IN:
+                    sock.sendall(_payload(payload, length))
+                    sends.append(time.perf_counter())
+                    sent += length
+                elif kind == CLOSE:
+                    break
+            if received[0] < expected:
+                done.wait(RESPONSE_TIMEOUT)
+        except OSError as e:
+            print(f'[!] Stream failed: {e}')
+            with self.lock:
+                self.results['failed'] += 1
+        finally:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+            reader.join(timeout=1)
+        self._add(sent, received[0], expected, _first_byte_latencies(sends, receives), 'streams')
+
+    def _replay_udp(self, events, start):
+        expected = sum(length for _, kind, _, length, _ in events if kind == UDP_OUT)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receives = []
+        received = 0
+        sends = []
+        sent = 0
+
+        def drain(timeout):
+            nonlocal received
+            sock.settimeout(timeout)
+            try:
+                while True:
+                    data = sock.recv(65535)
+                    receives.append(time.perf_counter())
+                    received += len(data)
+            except OSError:
+                pass
+
+        try:
+            for offset, kind, _, length, payload in events:
+                if kind != UDP_IN:
+                    continue
+                self._wait_until(start, offset)
+                sock.sendto(_payload(payload, length), (self.host, self.port))
+                sends.append(time.perf_counter())
+                sent += length
+                drain(0.0)
+            deadline = time.perf_counter() + RESPONSE_TIMEOUT
+            while received < expected and time.perf_counter() < deadline:
+                drain(0.1)
+        finally:
+            sock.close()
+        self._add(sent, received, expected, _first_byte_latencies(sends, receives), 'udp_sessions')
+
+    def run(self):
+        jobs = []
+        for events in self.streams.values():
+            kinds = {kind for _, kind, _, _, _ in events}
+            if kinds & {UDP_IN, UDP_OUT}:
+                jobs.append((events[0][0], self._replay_udp, events))
+            elif OPEN in kinds:
+                jobs.append((events[0][0], self._replay_tcp, events))
+            else:
+                self.results['skipped'] += 1
+        jobs.sort(key=lambda job: job[0])
+
+        threads = []
+        start = time.perf_counter()
+        # Threads are started when their stream opens rather than up front,
+        # so a long recording does not hold thousands of sleeping threads.
+        for offset, target, events in jobs:
+            self._wait_until(start, offset)
+            for _ in range(self.copies):
+                thread = threading.Thread(target=target, args=(events, start), daemon=True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def main():
+    if len(sys.argv) < 4:
+        print(__doc__)
+        sys.exit(1)
+    path, host, port = sys.argv[1], sys.argv[2], int(sys.argv[3])
+    speed = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+    copies = int(sys.argv[5]) if len(sys.argv) > 5 else 1
+
+    replay = Replay(path, host, port, speed, copies)
+    header = replay.header
+    print(f'[*] {header["events"]} events, {len(replay.streams)} streams '
+          f'({header["overwritten_events"]} events overwritten before the recording was read)')
+    print(f'[*] Replaying against {host}:{port} at {speed:g}x speed, {copies} cop{"y" if copies == 1 else "ies"}')
+    elapsed = replay.run()
+
+    results = replay.results
+    latencies = sorted(replay.latencies)
+    print(f'[+] Replayed {results["streams"]} TCP streams and {results["udp_sessions"]} UDP sessions in {elapsed:.2f}s '
+          f'({results["skipped"]} skipped, {results["failed"]} failed)')
+    print(f'    sent {results["bytes_sent"]} bytes, received {results["bytes_received"]} of '
+          f'{results["bytes_expected"]} expected ({results["bytes_sent"] / elapsed / (1024 * 1024):.2f} MiB/s out)')
+    if latencies:
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000
+        print(f'    first-byte latency p50 {p50:.2f} ms, p99 {p99:.2f} ms over {len(latencies)} requests')
+
+
+if __name__ == '__main__':
+    main()
@@ -5,18 +5,73 @@ import socket
 import time
 import logging
 import base64
+import json
 import threading
+import os
+import select
+import signal
+import traceback
+from collections import Counter, deque
 
 logging.basicConfig(level=logging.WARNING)
 
-if len(sys.argv) < 5:
-    print("Usage: python simple_client.py <server_url> <token> <tunnel_id> <local_port>")
-    sys.exit(1)
+USAGE = """Usage: python simple_client.py <server_url> <token> <tunnel_id> <local_port>
+       python simple_client.py <server_url> --config <tunnels.json>
+
+The config file lists every tunnel this client serves, all over one connection:
+  {"tunnels": [{"id": 1, "token": "...", "local": "127.0.0.1:8080", "protocol": "TCP"}, ...]}
+"local" may also be a bare port on 127.0.0.1; "protocol" is only checked
+against what the server has configured for the tunnel."""
+
+# Socket tuning applied to local sockets until the server sends a tunnel's own in auth_response.
+DEFAULT_SOCKET_OPTIONS = {'nodelay': True, 'keepalive': True, 'keepidle': 60, 'keepintvl': 15, 'keepcnt': 4, 'read_size': 8192}
+
+class LocalTunnel:
+    """One tunnel served by this client and the local service behind it."""
+    
+    __slots__ = (
+        'id', 'token', 'host', 'port', 'protocol', 'socket_options', 'active',
+        'health', 'next_probe', 'backoff', 'http_pool'
+    )
+    
+    def __init__(self, tunnel_id, token, host, port, protocol='TCP'):
+        self.id = tunnel_id
+        self.token = token
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.socket_options = dict(DEFAULT_SOCKET_OPTIONS)
+        self.active = False
+        # Last local service state reported to the server; None until first probed.
+        self.health = {'healthy': None, 'error': None}
+        self.next_probe = 0.0
+        self.backoff = 0.0
+        # Idle keep-alive connections for HTTP tunnels: (socket, idle since), most recently used last
+        self.http_pool = []
 
-server_url = sys.argv[1]
-token = sys.argv[2]
-tunnel_id = int(sys.argv[3])
-local_port = int(sys.argv[4])
+def load_tunnel_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    loaded = {}
+    for entry in config['tunnels'] if isinstance(config, dict) else config:
+        host, _, port = str(entry['local']).rpartition(':')
+        tunnel = LocalTunnel(int(entry['id']), entry['token'], host or '127.0.0.1', int(port),
+                             str(entry.get('protocol', 'TCP')).upper())
+        loaded[tunnel.id] = tunnel
+    return loaded
+
+if len(sys.argv) == 4 and sys.argv[2] == '--config':
+    server_url = sys.argv[1]
+    tunnels = load_tunnel_config(sys.argv[3])
+elif len(sys.argv) >= 5:
+    server_url = sys.argv[1]
+    tunnels = {int(sys.argv[3]): LocalTunnel(int(sys.argv[3]), sys.argv[2], '127.0.0.1', int(sys.argv[4]))}
+else:
+    print(USAGE)
+    sys.exit(1)
+if not tunnels:
+    print("[!] No tunnels configured")
+    sys.exit(1)
 
 sio = socketio.Client(
     reconnection=True,
@@ -27,10 +82,652 @@ sio = socketio.Client(
     engineio_logger=False
 )
 
-tunnel_protocol = 'TCP'
 heartbeat_running = False
+server_restarting = False
 active_local_connections = {}
-local_connections_lock = threading.Lock()
+# Set when the server accepts stream_batch; replies from all local
+# connections are then coalesced into batched emits.
+response_batcher = None
+inbound_sequencer = None
+BATCH_MAX_BYTES = int(os.environ.get('STREAM_BATCH_BYTES', '65536'))
+BATCH_MAX_DELAY = float(os.environ.get('STREAM_BATCH_DELAY', '0.0005'))
+CLOSE_FRAME = -1
+# Replies from interactive connections are sent ahead of bulk ones.
+QOS_CLASSES = ('interactive', 'bulk')
+QOS_CHUNK_BYTES = int(os.environ.get('QOS_CHUNK_BYTES', '16384'))
+QOS_BULK_MIN_SHARE = float(os.environ.get('QOS_BULK_MIN_SHARE', '0.25'))
+QOS_WINDOW_BYTES = int(os.environ.get('QOS_WINDOW_BYTES', str(512 * 1024)))
+# Each tunnel's local service is probed every HEALTH_CHECK_INTERVAL seconds; while it
+# is down, probes start at HEALTH_MIN_BACKOFF and back off to the interval.
+HEALTH_CHECK_INTERVAL = float(os.environ.get('HEALTH_CHECK_INTERVAL', '5'))
+HEALTH_MIN_BACKOFF = 0.5
+HEALTH_PROBE_TIMEOUT = 2
+# UDP services are only probed when this is set: the probe is an empty datagram,
+# which the service receives every HEALTH_CHECK_INTERVAL seconds.
+HEALTH_PROBE_UDP = os.environ.get('HEALTH_PROBE_UDP', 'false').lower() in ('1', 'true', 'yes')
+service_health_lock = threading.Lock()
+health_recheck = threading.Event()
+health_checker_running = False
+# Stream data (and closes, as None) that arrived before the new_connection
+# it belongs to was handled: conn_id -> [expires, bytes, frames].
+early_frames = {}
+# Kept below the server's STREAM_ID_REUSE_DELAY so a frame for a closed
+# connection expires before its id can be handed out again.
+EARLY_DATA_TTL = 10
+EARLY_DATA_MAX_BYTES = int(os.environ.get('EARLY_DATA_MAX_BYTES', str(1024 * 1024)))
+# HTTP tunnels: the server sends requests one at a time and they are replayed
+# on idle keep-alive connections to the local service. At most HTTP_POOL_SIZE
+# are kept per tunnel, and none longer than HTTP_POOL_IDLE seconds so the
+# service does not close one just as a request is written to it (Node.js
+# drops idle connections after 5s).
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '8'))
+HTTP_POOL_IDLE = float(os.environ.get('HTTP_POOL_IDLE', '4'))
+HTTP_MAX_HEAD_BYTES = 64 * 1024
+http_pool_lock = threading.Lock()
+CAPABILITIES = ["stream_batch", "batch_ack", "early_data", "http_requests", "stream_pause"]
+# Data for a local connection is written by its StreamWriter, so a local
+# service that stops reading never holds up the batches for the others. The
+# server is asked to pause the stream once STREAM_BUFFER_HIGH bytes are
+# waiting and to resume below a quarter of that; writes only block past
+# STREAM_BUFFER_MAX for a server that cannot be paused.
+STREAM_BUFFER_HIGH = int(os.environ.get('STREAM_BUFFER_HIGH', str(1024 * 1024)))
+STREAM_BUFFER_LOW = STREAM_BUFFER_HIGH // 4
+STREAM_BUFFER_MAX = int(os.environ.get('STREAM_BUFFER_MAX', str(8 * 1024 * 1024)))
+WRITER_IDLE = 2.0
+# Set when the server accepts pause_stream; it then also pauses our streams.
+server_pauses = False
+# stream id -> Event for streams the server asked us to stop reading; set on resume
+paused_streams = {}
+
+class LocalConnection:
+    """One forwarded TCP connection to the local service.
+
+    `pending` holds data for the connection while the local connect is in
+    progress and is None once it has been written out.
+    """
+    
+    __slots__ = ('socket', 'active', 'writer', 'read_size', 'qos_class', 'pending')
+    
+    def __init__(self, sock, read_size, qos_class):
+        self.socket = sock
+        self.active = True
+        self.pending = None
+        self.writer = None
+        self.read_size = read_size
+        self.qos_class = qos_class
+
+class StreamWriter:
+    """Writes one connection's data to its local socket from a thread of its own.
+
+    `write` queues the data and returns; the thread is started on demand
+    and exits after WRITER_IDLE seconds without work. `on_pause` and
+    `on_resume` are called as the queue crosses the buffer marks, and
+    `on_error(exc)` once if a write fails, after which data is dropped.
+    """
+    
+    def __init__(self, sock, name, on_pause=None, on_resume=None, on_error=None):
+        self.sock = sock
+        self.name = name
+        self._on_pause = on_pause
+        self._on_resume = on_resume
+        self._on_error = on_error
+        self._cond = threading.Condition(threading.Lock())
+        # bytes to write, or callables to run once everything before them is written
+        self._queue = deque()
+        self._size = 0
+        self._running = False
+        self._busy = False
+        self._paused = False
+        self.failed = False
+    
+    def write(self, data, block=True):
+        with self._cond:
+            while block and self._size >= STREAM_BUFFER_MAX and not self.failed:
+                self._cond.wait()
+            if self.failed:
+                return False
+            self._queue.append(data)
+            self._size += len(data)
+            pause = not self._paused and self._size >= STREAM_BUFFER_HIGH
+            if pause:
+                self._paused = True
+            self._wake()
+        if pause and self._on_pause is not None:
+            self._on_pause()
+        return True
+    
+    def finish(self, callback):
+        """Run callback once everything queued so far is written or dropped."""
+        with self._cond:
+            if self._queue or self._busy:
+                self._queue.append(callback)
+                self._wake()
+                return
+        callback()
+    
+    def abort(self, callback):
+        """Drop queued data and run callback once the socket is no longer being written."""
+        with self._cond:
+            self.failed = True
+            self._size = 0
+            self._queue = deque(item for item in self._queue if callable(item))
+            resume = self._paused
+            self._paused = False
+            self._cond.notify_all()
+            if self._busy:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._queue.append(callback)
+                callbacks = ()
+            else:
+                callbacks = list(self._queue) + [callback]
+                self._queue.clear()
+        if resume and self._on_resume is not None:
+            self._on_resume()
+        for item in callbacks:
+            item()
+    
+    def _wake(self):
+        if self._running:
+            self._cond.notify_all()
+        else:
+            self._running = True
+            threading.Thread(target=self._run, name=f"stream-writer-{self.name}", daemon=True).start()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    if not self._cond.wait(WRITER_IDLE) and not self._queue:
+                        self._running = False
+                        return
+                item = self._queue.popleft()
+                self._busy = True
+                failed = self.failed
+            error = None
+            try:
+                if callable(item):
+                    item()
+                elif not failed:
+                    self.sock.sendall(item)
+            except Exception as e:
+                error = e
+            report = resume = False
+            with self._cond:
+                self._busy = False
+                if not callable(item) and not self.failed:
+                    self._size -= len(item)
+                    if error is not None:
+                        self.failed = report = True
+                        self._size = 0
+                    if self._paused and self._size <= STREAM_BUFFER_LOW:
+                        self._paused = False
+                        resume = True
+                self._cond.notify_all()
+            if callable(item) and error is not None:
+                print(f"[!] Error closing connection {self.name}: {error}")
+            if report and self._on_error is not None:
+                self._on_error(error)
+            if resume and self._on_resume is not None:
+                self._on_resume()
+
+def signal_flow(event, conn_id):
+    if server_pauses and sio.connected:
+        try:
+            sio.emit(event, {'conn_id': conn_id})
+        except Exception as e:
+            print(f"[!] Could not send {event} for connection {conn_id}: {e}")
+
+def wait_while_paused(stream_id, connection):
+    # Stop reading the local service while the public side cannot keep up.
+    gate = paused_streams.get(stream_id)
+    while gate is not None and connection.active and not gate.wait(1.0):
+        pass
+
+class TimedLock:
+    """Lock that records how long callers had to wait for it."""
+    
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    def __enter__(self):
+        if not self._lock.acquire(False):
+            start = time.perf_counter()
+            self._lock.acquire()
+            waited = time.perf_counter() - start
+            self.contended += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        self.acquisitions += 1
+        return True
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self._lock.release()
+    
+    def stats(self):
+        return (f"{self.name}: acquisitions={self.acquisitions} contended={self.contended} "
+                f"total_wait={self.total_wait * 1000:.3f}ms max_wait={self.max_wait * 1000:.3f}ms")
+
+local_connections_lock = TimedLock('local_connections_lock')
+profile_lock = threading.Lock()
+
+class ResponseBatcher:
+    """Coalesces stream_response chunks from all local connections.
+
+    Flushes one stream_batch event ({'seq': n, 'frames': [[conn_id, length], ...],
+    'data': base64}) when BATCH_MAX_BYTES are queued or BATCH_MAX_DELAY
+    seconds after the first chunk. A length of CLOSE_FRAME closes the stream.
+
+    Connections the server classified as interactive are sent ahead of bulk
+    ones (bulk keeps QOS_BULK_MIN_SHARE of each batch) and chunks are split
+    at QOS_CHUNK_BYTES. When the server acknowledges batches, bulk data is
+    held back while more than `window` bytes are unacknowledged.
+    """
+    
+    def __init__(self, max_bytes=BATCH_MAX_BYTES, max_delay=BATCH_MAX_DELAY, window=None):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.window = window
+        self._unacked = deque()
+        self._sent_total = 0
+        self._acked_total = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._queues = {qos: [] for qos in QOS_CLASSES}
+        self._streams = {}
+        self._size = 0
+        self._deadline = 0.0
+        self._closed = False
+        self._window_wait = False
+        self._seq = 0
+        self.batches = 0
+        self.frames_sent = 0
+        # class -> [frames, total delay, max delay]
+        self.delays = {qos: [0, 0.0, 0.0] for qos in QOS_CLASSES}
+        threading.Thread(target=self._run, name="batch-flush", daemon=True).start()
+    
+    def _put(self, conn_id, chunks, qos):
+        now = time.monotonic()
+        with self._cond:
+            if self._closed:
+                return False
+            # A connection keeps its class until its queued frames are sent,
+            # so reclassifying it never reorders its data.
+            stream = self._streams.setdefault(conn_id, [qos, 0])
+            stream[1] += len(chunks)
+            was_empty = not any(self._queues.values())
+            added = 0
+            for chunk in chunks:
+                self._queues[stream[0]].append((conn_id, chunk, now))
+                added += len(chunk) if chunk else 0
+            self._size += added
+            if was_empty:
+                self._deadline = now + self.max_delay
+                self._cond.notify()
+            elif self._size >= self.max_bytes > self._size - added:
+                self._cond.notify()
+            elif self._window_wait and stream[0] == 'interactive':
+                self._cond.notify()
+            return True
+    
+    def send(self, conn_id, data, qos='interactive'):
+        chunks = [data[i:i + QOS_CHUNK_BYTES] for i in range(0, len(data), QOS_CHUNK_BYTES)]
+        return self._put(conn_id, chunks, qos)
+    
+    def send_close(self, conn_id, qos='interactive'):
+        return self._put(conn_id, [None], qos)
+    
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+    
+    def _pop(self, qos, limit, batch, now):
+        queue = self._queues[qos]
+        delays = self.delays[qos]
+        taken = count = 0
+        while count < len(queue) and taken < limit:
+            conn_id, data, queued_at = queue[count]
+            taken += len(data) if data else 0
+            count += 1
+            delays[0] += 1
+            delays[1] += now - queued_at
+            delays[2] = max(delays[2], now - queued_at)
+            stream = self._streams[conn_id]
+            stream[1] -= 1
+            if stream[1] == 0:
+                del self._streams[conn_id]
+            batch.append((conn_id, data))
+        del queue[:count]
+        return taken
+    
+    def _take(self, bulk_allowed):
+        with self._cond:
+            while not any(self._queues.values()) and not self._closed:
+                self._cond.wait()
+            while not self._closed and self._size < self.max_bytes:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._closed:
+                return None
+            batch = []
+            now = time.monotonic()
+            if bulk_allowed:
+                bulk_share = int(self.max_bytes * QOS_BULK_MIN_SHARE) if self._queues['bulk'] else 0
+                size = self._pop('interactive', self.max_bytes - bulk_share, batch, now)
+                size += self._pop('bulk', self.max_bytes - size, batch, now)
+                size += self._pop('interactive', self.max_bytes - size, batch, now)
+            else:
+                size = self._pop('interactive', self.max_bytes, batch, now)
+            self._size -= size
+            if any(self._queues.values()):
+                self._deadline = now
+            return batch
+    
+    def ack(self, seq):
+        with self._cond:
+            while self._unacked and self._unacked[0][0] <= seq:
+                self._acked_total = self._unacked.popleft()[1]
+            if self._window_wait:
+                self._cond.notify()
+    
+    def _window_full(self):
+        return self.window is not None and self._sent_total - self._acked_total >= self.window
+    
+    def _wait_for_transport(self):
+        # Emitted batches are written in FIFO order; holding bulk data back
+        # here keeps priority decisions in this queue. Interactive-only
+        # batches are small and always go out (returns False for those).
+        # ack() and interactive sends wake the wait.
+        with self._cond:
+            self._window_wait = True
+            try:
+                while not self._closed and self._window_full():
+                    if self._queues['interactive']:
+                        return False
+                    self._cond.wait()
+                return True
+            finally:
+                self._window_wait = False
+    
+    def _run(self):
+        while True:
+            bulk_allowed = self._wait_for_transport()
+            batch = self._take(bulk_allowed)
+            if batch is None:
+                return
+            try:
+                blob = b''.join(data for _, data in batch if data)
+                sio.emit("stream_batch", {
+                    'seq': self._seq,
+                    'frames': [[conn_id, CLOSE_FRAME if data is None else len(data)] for conn_id, data in batch],
+                    'data': base64.b64encode(blob).decode('ascii')
+                })
+                if self.window is not None:
+                    with self._cond:
+                        self._sent_total += len(blob)
+                        self._unacked.append((self._seq, self._sent_total))
+                self._seq += 1
+                self.batches += 1
+                self.frames_sent += len(batch)
+            except Exception as e:
+                print(f"[!] Error sending stream batch: {e}")
+    
+    def stats(self):
+        per_batch = self.frames_sent / self.batches if self.batches else 0.0
+        lines = [f"response_batcher: batches={self.batches} frames={self.frames_sent} frames_per_batch={per_batch:.2f}"]
+        for qos, (frames, total, worst) in self.delays.items():
+            average = total * 1000 / frames if frames else 0.0
+            lines.append(f"  {qos}: frames={frames} queued={len(self._queues[qos])} "
+                         f"avg_delay={average:.3f}ms max_delay={worst * 1000:.3f}ms")
+        return "\n".join(lines)
+
+class BatchSequencer:
+    """Applies the server's stream batches in 'seq' order.
+
+    Socket.IO handles each event on its own thread, so batches can reach
+    on_stream_batch out of order; whichever handler holds the next expected
+    batch applies it and any queued behind it. Every QOS_WINDOW_BYTES / 4
+    applied bytes are acknowledged so the server's send window reopens.
+    """
+    
+    def __init__(self, apply):
+        self._apply = apply
+        self._unacked_bytes = 0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._next = 0
+        self._draining = False
+    
+    def submit(self, payload):
+        with self._lock:
+            self._pending[payload.get('seq', self._next)] = payload
+            if self._draining:
+                return
+            self._draining = True
+        while True:
+            with self._lock:
+                payload = self._pending.pop(self._next, None)
+                if payload is None:
+                    self._draining = False
+                    return
+                self._next += 1
+            try:
+                self._apply(payload)
+            except Exception as e:
+                print(f"[!] Error applying stream batch: {e}")
+            self._unacked_bytes += sum(length for _, length in payload.get('frames') or () if length > 0)
+            if self._unacked_bytes >= QOS_WINDOW_BYTES // 4:
+                self._unacked_bytes = 0
+                sio.emit("stream_batch_ack", {'seq': payload.get('seq', self._next - 1)})
+
+def send_stream_response(conn_id, data, qos='interactive'):
+    batcher = response_batcher
+    if batcher is not None and batcher.send(conn_id, data, qos):
+        return
+    sio.emit("stream_response", {
+        'conn_id': conn_id,
+        'data': base64.b64encode(data).decode('ascii')
+    })
+
+def send_close_connection(conn_id, qos='interactive'):
+    batcher = response_batcher
+    if batcher is not None and batcher.send_close(conn_id, qos):
+        return
+    sio.emit("close_connection", {'conn_id': conn_id})
+
+def apply_socket_options(sock, options):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if options.get('nodelay') else 0)
+        for key, opt in (('sndbuf', socket.SO_SNDBUF), ('rcvbuf', socket.SO_RCVBUF)):
+            if options.get(key):
+                sock.setsockopt(socket.SOL_SOCKET, opt, options[key])
+        if options.get('keepalive'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if sys.platform == 'win32':
+                sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, options['keepidle'] * 1000, options['keepintvl'] * 1000))
+            else:
+                if hasattr(socket, 'TCP_KEEPIDLE'):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, options['keepidle'])
+                if hasattr(socket, 'TCP_KEEPINTVL'):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, options['keepintvl'])
+                if hasattr(socket, 'TCP_KEEPCNT'):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, options['keepcnt'])
+    except (OSError, ValueError, KeyError) as e:
+        print(f"[!] Could not apply socket options: {e}")
+
+def format_thread_dump():
+    frames = sys._current_frames()
+    lines = []
+    for thread in threading.enumerate():
+        lines.append(f"--- {thread.name} (daemon={thread.daemon})")
+        frame = frames.get(thread.ident)
+        if frame is not None:
+            lines.extend(line.rstrip() for line in traceback.format_stack(frame, limit=12))
+    with local_connections_lock:
+        lines.append(f"active local connections: {len(active_local_connections)}")
+    lines.append(local_connections_lock.stats())
+    if response_batcher is not None:
+        lines.append(response_batcher.stats())
+    return "\n".join(lines) + "\n"
+
+def sample_profile(seconds, interval=0.005):
+    """Sample all thread stacks and return them as collapsed (flamegraph) lines."""
+    if not profile_lock.acquire(False):
+        return "profile already running\n"
+    try:
+        own_ident = threading.get_ident()
+        counts = Counter()
+        deadline = time.monotonic() + min(max(seconds, 0.1), 120)
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).split('-')[0])
+                counts[';'.join(reversed(stack))] += 1
+            time.sleep(interval)
+        return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+    finally:
+        profile_lock.release()
+
+def handle_debug_command(command):
+    parts = command.split()
+    if not parts:
+        return "commands: threads | profile [seconds] | locks | qos | health\n"
+    if parts[0] == 'threads':
+        return format_thread_dump()
+    if parts[0] == 'profile':
+        return sample_profile(float(parts[1]) if len(parts) > 1 else 10)
+    if parts[0] == 'locks':
+        return local_connections_lock.stats() + "\n"
+    if parts[0] == 'health':
+        with service_health_lock:
+            return "".join(f"tunnel {tunnel.id} ({tunnel.host}:{tunnel.port}): {tunnel.health}\n" for tunnel in tunnels.values())
+    if parts[0] == 'qos':
+        return (response_batcher.stats() if response_batcher is not None else "stream batching not negotiated") + "\n"
+    return f"unknown command: {parts[0]}\n"
+
+def run_debug_server(port):
+    # Local-only introspection port, e.g. `echo profile 5 | nc 127.0.0.1 <port>`.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(5)
+    print(f"[*] Debug port listening on 127.0.0.1:{port}")
+    while True:
+        conn, _ = server.accept()
+        try:
+            conn.settimeout(10)
+            command = conn.recv(1024).decode('utf-8', 'replace').strip()
+            conn.sendall(handle_debug_command(command).encode('utf-8'))
+        except Exception as e:
+            print(f"[!] Debug command failed: {e}")
+        finally:
+            conn.close()
+
+def install_debug_hooks():
+    debug_port = os.environ.get('TUNNEL_DEBUG_PORT')
+    if debug_port:
+        threading.Thread(target=run_debug_server, args=(int(debug_port),), name='debug-server', daemon=True).start()
+    
+    # SIGUSR1 prints a thread dump, SIGUSR2 writes a 10 second profile (POSIX only).
+    # Both run on a thread of their own: the dump takes local_connections_lock,
+    # which the interrupted thread may be holding.
+    if hasattr(signal, 'SIGUSR1'):
+        def print_thread_dump():
+            print(format_thread_dump(), flush=True)
+        signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=print_thread_dump, daemon=True).start())
+    if hasattr(signal, 'SIGUSR2'):
+        def write_profile():
+            path = f"tunnel_client_profile_{os.getpid()}.folded"
+            with open(path, 'w') as f:
+                f.write(sample_profile(10))
+            print(f"[*] Profile written to {path}")
+        signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=write_profile, daemon=True).start())
+
+def health_checked(tunnel):
+    return tunnel.active and (tunnel.protocol != 'UDP' or HEALTH_PROBE_UDP)
+
+def probe_local_service(tunnel):
+    """Return None if the tunnel's local service is reachable, otherwise the error."""
+    if tunnel.protocol == 'UDP':
+        # Nothing to connect to: an empty datagram to a closed port comes
+        # back as ICMP port unreachable, silence means something is bound.
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.settimeout(0.5)
+        try:
+            probe.connect((tunnel.host, tunnel.port))
+            probe.send(b'')
+            probe.recv(1)
+        except socket.timeout:
+            pass
+        except OSError as e:
+            return str(e)
+        finally:
+            probe.close()
+        return None
+    try:
+        socket.create_connection((tunnel.host, tunnel.port), timeout=HEALTH_PROBE_TIMEOUT).close()
+    except OSError as e:
+        return str(e)
+    return None
+
+def report_service_health(tunnel):
+    with service_health_lock:
+        state = dict(tunnel.health, tunnel_id=tunnel.id)
+    if state['healthy'] is None or not sio.connected:
+        return
+    try:
+        sio.emit("service_health", state)
+    except Exception as e:
+        print(f"[!] Could not report local service health: {e}")
+
+def set_service_health(tunnel, healthy, error=None):
+    """Record a tunnel's local service state and tell the server when it changes."""
+    with service_health_lock:
+        if tunnel.health['healthy'] == healthy:
+            return
+        tunnel.health['healthy'] = healthy
+        tunnel.health['error'] = error
+    if healthy:
+        print(f"[+] Local service {tunnel.host}:{tunnel.port} (tunnel {tunnel.id}) is up")
+    else:
+        print(f"[!] Local service {tunnel.host}:{tunnel.port} (tunnel {tunnel.id}) is down: {error}")
+        # Re-probe quickly so recovery is noticed within the backoff.
+        tunnel.next_probe = 0.0
+        health_recheck.set()
+    report_service_health(tunnel)
+
+def run_health_checks():
+    # One thread probes every tunnel, each on its own schedule.
+    while True:
+        for tunnel in list(tunnels.values()):
+            if not health_checked(tunnel) or tunnel.next_probe > time.monotonic():
+                continue
+            error = probe_local_service(tunnel)
+            set_service_health(tunnel, error is None, error)
+            if error is None:
+                tunnel.backoff = HEALTH_MIN_BACKOFF
+                tunnel.next_probe = time.monotonic() + HEALTH_CHECK_INTERVAL
+            else:
+                tunnel.next_probe = time.monotonic() + max(tunnel.backoff, HEALTH_MIN_BACKOFF)
+                tunnel.backoff = min(max(tunnel.backoff, HEALTH_MIN_BACKOFF) * 2, HEALTH_CHECK_INTERVAL)
+        due = [tunnel.next_probe for tunnel in tunnels.values() if health_checked(tunnel)]
+        health_recheck.wait(max(min(due, default=time.monotonic() + HEALTH_CHECK_INTERVAL) - time.monotonic(), 0.05))
+        health_recheck.clear()
 
 def send_heartbeat():
     global heartbeat_running
@@ -43,141 +740,504 @@ def send_heartbeat():
 
 @sio.on("connect")
 def on_connect():
+    global inbound_sequencer
+    # The server numbers batches per connection, starting again at zero.
+    inbound_sequencer = BatchSequencer(apply_stream_batch)
     print("[+] Connected to tunnel server")
-    print("[*] Authenticating...")
-    sio.emit("tunnel_auth", {
-        "token": token,
-        "tunnel_id": tunnel_id,
-        "local_port": local_port
-    })
+    print(f"[*] Authenticating {len(tunnels)} tunnel{'s' if len(tunnels) != 1 else ''}...")
+    specs = [{"token": tunnel.token, "tunnel_id": tunnel.id, "local_port": tunnel.port} for tunnel in tunnels.values()]
+    auth = {"capabilities": CAPABILITIES}
+    if len(specs) == 1:
+        # The single-tunnel form is the only one older servers understand.
+        auth.update(specs[0])
+    else:
+        auth["tunnels"] = specs
+    sio.emit("tunnel_auth", auth)
 
 @sio.on("auth_response")
 def on_auth_response(data):
-    global tunnel_protocol, heartbeat_running
-    print("\n" + "="*60)
-    if data.get("success"):
-        tunnel_protocol = data.get('protocol', 'TCP')
-        print("[SUCCESS] Tunnel authenticated and active!")
-        print("="*60)
-        print(f"Protocol: {tunnel_protocol}")
-        print(f"Public Port: {data.get('public_port')}")
-        print(f"Local Port: {local_port}")
-        print(f"\n{data.get('message')}")
-        print("\nTunnel is running. Press Ctrl+C to stop.")
-        
-        if not heartbeat_running:
-            heartbeat_thread = threading.Thread(target=send_heartbeat, daemon=True)
-            heartbeat_thread.start()
+    global heartbeat_running, response_batcher, health_checker_running, server_pauses
+    if 'tunnels' in data:
+        results = data['tunnels']
     else:
-        print("[ERROR] Authentication failed!")
-        print("="*60)
-        print(f"Error: {data.get('error')}")
-        if "verification_url" in data:
-            print(f"\nPlease verify at: {server_url}{data.get('verification_url')}")
-        sys.exit(1)
+        results = [dict(data, tunnel_id=data.get('tunnel_id', next(iter(tunnels))))]
+    
+    print("\n" + "="*60)
+    for result in results:
+        tunnel = tunnels.get(result.get('tunnel_id'))
+        if tunnel is None:
+            continue
+        if not result.get("success"):
+            tunnel.active = False
+            print(f"[ERROR] Tunnel {tunnel.id} authentication failed: {result.get('error')}")
+            if "verification_url" in result:
+                print(f"  Please verify at: {server_url}{result.get('verification_url')}")
+            continue
+        protocol = result.get('protocol', 'TCP')
+        if len(tunnels) > 1 and protocol != tunnel.protocol:
+            print(f"[!] Tunnel {tunnel.id} is configured as {protocol} on the server, not {tunnel.protocol}")
+        tunnel.protocol = protocol
+        tunnel.socket_options = result.get('socket_options') or tunnel.socket_options
+        tunnel.active = True
+        print(f"[SUCCESS] Tunnel {tunnel.id} authenticated and active!")
+        print(f"  Protocol: {protocol}")
+        print(f"  Public Port: {result.get('public_port')}")
+        print(f"  Local Service: {tunnel.host}:{tunnel.port}")
+        print(f"  Socket Profile: {result.get('socket_profile', 'auto')}")
+        print(f"  {result.get('message')}")
     print("="*60)
+    
+    if not any(tunnel.active for tunnel in tunnels.values()):
+        print("[ERROR] No tunnel could be authenticated")
+        sys.exit(1)
+    
+    capabilities = data.get('capabilities') or []
+    server_pauses = 'stream_pause' in capabilities
+    if 'stream_batch' in capabilities and response_batcher is None:
+        response_batcher = ResponseBatcher(window=QOS_WINDOW_BYTES if 'batch_ack' in capabilities else None)
+    print("\nTunnel client is running. Press Ctrl+C to stop.")
+    
+    if not heartbeat_running:
+        heartbeat_thread = threading.Thread(target=send_heartbeat, daemon=True)
+        heartbeat_thread.start()
+    
+    # A new server connection knows nothing about the local services yet.
+    for tunnel in tunnels.values():
+        if tunnel.active:
+            report_service_health(tunnel)
+    if not health_checker_running:
+        health_checker_running = True
+        threading.Thread(target=run_health_checks, name="health-check", daemon=True).start()
+
+class BodyFraming:
+    """Finds the end of an HTTP/1.1 message body in a byte stream.
+
+    `feed` returns how many of the given bytes belong to the body, so chunk
+    sizes and trailers pass through as they are. With neither a length nor
+    chunked encoding the body runs until the connection closes.
+    """
+    
+    def __init__(self, length=None, chunked=False):
+        self.remaining = length
+        self.chunked = chunked
+        self.done = length == 0 and not chunked
+        self._state = 'size'
+        self._line = b''
+    
+    def feed(self, data):
+        if self.done:
+            return 0
+        if not self.chunked:
+            if self.remaining is None:
+                return len(data)
+            taken = min(self.remaining, len(data))
+            self.remaining -= taken
+            self.done = not self.remaining
+            return taken
+        
+        pos = 0
+        while pos < len(data) and not self.done:
+            if self._state == 'data':
+                taken = min(self.remaining, len(data) - pos)
+                self.remaining -= taken
+                pos += taken
+                if not self.remaining:
+                    self._state = 'data_end'
+                continue
+            end = data.find(b'\n', pos)
+            if end < 0:
+                self._line += data[pos:]
+                if len(self._line) > HTTP_MAX_HEAD_BYTES:
+                    raise ValueError('Chunk header too long')
+                return len(data)
+            line = (self._line + data[pos:end]).strip()
+            self._line = b''
+            pos = end + 1
+            if self._state == 'size':
+                size = int(line.split(b';', 1)[0], 16)
+                if size < 0:
+                    raise ValueError('Invalid chunk size')
+                self.remaining = size
+                self._state = 'data' if size else 'trailer'
+            elif self._state == 'data_end':
+                self._state = 'size'
+            elif not line:
+                self.done = True
+        return pos
+
+def response_framing(head, method):
+    """Return (BodyFraming, keep_alive) for a response head; BodyFraming is None for a 1xx interim response."""
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/1.') or not parts[1].isdigit():
+        raise ValueError(f'Malformed status line: {lines[0][:80]!r}')
+    status = int(parts[1])
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        if name:
+            headers[name] = f"{headers[name]}, {value.strip()}" if name in headers else value.strip()
+    connection = {token.strip().lower() for token in headers.get('connection', '').split(',')}
+    keep_alive = 'keep-alive' in connection if parts[0] == 'HTTP/1.0' else 'close' not in connection
+    
+    if 100 <= status < 200 and status != 101:
+        return None, keep_alive
+    if method == 'HEAD' or status in (204, 304):
+        return BodyFraming(0), keep_alive
+    if status == 101:
+        return BodyFraming(), False
+    if 'transfer-encoding' in headers:
+        if headers['transfer-encoding'].split(',')[-1].strip().lower() == 'chunked':
+            return BodyFraming(chunked=True), keep_alive
+        return BodyFraming(), False
+    if 'content-length' in headers:
+        return BodyFraming(int(headers['content-length'].split(',')[0])), keep_alive
+    return BodyFraming(), False
+
+def take_pooled_socket(tunnel):
+    now = time.monotonic()
+    with http_pool_lock:
+        http_pool = tunnel.http_pool
+        while http_pool and now - http_pool[0][1] > HTTP_POOL_IDLE:
+            http_pool.pop(0)[0].close()
+        while http_pool:
+            sock, _ = http_pool.pop()
+            # An idle connection the service has closed polls readable.
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return sock
+            sock.close()
+    return None
+
+def return_to_pool(tunnel, sock):
+    with http_pool_lock:
+        if len(tunnel.http_pool) < HTTP_POOL_SIZE:
+            tunnel.http_pool.append((sock, time.monotonic()))
+            return
+    sock.close()
+
+def fail_http_request(stream, qos, message):
+    body = message.encode('utf-8')
+    send_stream_response(stream, (
+        'HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'
+    ).encode('ascii') + body, qos)
+    send_close_connection(stream, qos)
+
+def relay_http_response(tunnel, conn_id, connection, request):
+    """Copy one response from the local service back to the request's public stream.
+
+    The local connection goes back to the pool only if the response had a
+    definite end, the service allows keep-alive and the whole request came
+    in the open. The request's id is closed once the response is complete; if
+    it has no definite end the public stream is closed instead.
+    """
+    stream = request.get('stream')
+    method = request.get('method')
+    qos = connection.qos_class
+    local_socket = connection.socket
+    framing = None
+    keep_alive = False
+    buffer = b''
+    try:
+        while connection.active and not (framing is not None and framing.done):
+            wait_while_paused(stream, connection)
+            try:
+                chunk = local_socket.recv(connection.read_size)
+            except socket.timeout:
+                continue
+            if not chunk:
+                break
+            if framing is None:
+                buffer += chunk
+                # The final head may follow 1xx interim responses.
+                while framing is None:
+                    end = buffer.find(b'\r\n\r\n')
+                    if end < 0:
+                        if len(buffer) > HTTP_MAX_HEAD_BYTES:
+                            raise ValueError('Response head too large')
+                        break
+                    head, buffer = buffer[:end + 4], buffer[end + 4:]
+                    send_stream_response(stream, head, qos)
+                    framing, keep_alive = response_framing(head, method)
+                if framing is None:
+                    continue
+                chunk, buffer = buffer, b''
+            taken = framing.feed(chunk)
+            if taken:
+                send_stream_response(stream, chunk[:taken], qos)
+            if taken < len(chunk):
+                # Bytes past the end of the response: the connection is
+                # not in a state anyone else can use.
+                keep_alive = False
+    except Exception as e:
+        print(f"[!] Error relaying HTTP response {conn_id}: {e}")
+    finally:
+        complete = framing is not None and framing.done
+        with local_connections_lock:
+            if active_local_connections.get(conn_id) is connection:
+                del active_local_connections[conn_id]
+            reuse = complete and keep_alive and request.get('complete') and connection.active
+            connection.active = False
+        if reuse:
+            # Only once the writer has sent the last of the request.
+            connection.writer.finish(lambda: return_to_pool(tunnel, local_socket))
+        else:
+            connection.writer.abort(lambda: close_quietly(local_socket))
+        send_close_connection(conn_id if complete else stream, qos)
 
 @sio.on("new_connection")
 def on_new_connection(data):
     conn_id = data.get('conn_id')
     protocol = data.get('protocol', 'TCP')
+    # An HTTP open is one request; its response goes to the public stream.
+    http = protocol == 'HTTP'
+    tunnel = tunnels.get(data.get('tunnel_id'))
+    if tunnel is None:
+        print(f"[!] Connection {conn_id} is for unknown tunnel {data.get('tunnel_id')}")
+        sio.emit("close_connection", {'conn_id': data.get('stream', conn_id)})
+        return
+    socket_options = tunnel.socket_options
+    
+    if http:
+        print(f"[+] New HTTP request {conn_id} on stream {data.get('stream')} (tunnel {tunnel.id})")
+    else:
+        print(f"[+] New {protocol} connection: {conn_id} (tunnel {tunnel.id})")
     
-    print(f"[+] New {protocol} connection: {conn_id}")
+    # Registered before dialing so data that follows the open is queued on
+    # the connection instead of being dropped while the connect is running.
+    connection = LocalConnection(
+        None,
+        socket_options.get('read_size', 8192),
+        data.get('qos_class') or socket_options.get('qos_class', 'interactive')
+    )
+    connection.pending = [base64.b64decode(data['data'])] if data.get('data') else []
+    with local_connections_lock:
+        early = early_frames.pop(conn_id, None)
+        if early is not None:
+            connection.pending.extend(early[2])
+        if None in connection.pending:
+            print(f"[*] Connection {conn_id} was closed before it was opened")
+            return
+        active_local_connections[conn_id] = connection
+    
+    def discard():
+        connection.active = False
+        with local_connections_lock:
+            if active_local_connections.get(conn_id) is connection:
+                del active_local_connections[conn_id]
     
     try:
-        local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        local_socket.settimeout(10)
+        local_socket = take_pooled_socket(tunnel) if http else None
+        if local_socket is None:
+            local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            local_socket.settimeout(10)
+            apply_socket_options(local_socket, socket_options)
+            
+            try:
+                local_socket.connect((tunnel.host, tunnel.port))
+                local_socket.settimeout(300.0)
+            except ConnectionRefusedError as e:
+                print(f"[!] Cannot connect to {tunnel.host}:{tunnel.port} - Is your service running?")
+                set_service_health(tunnel, False, str(e))
+                discard()
+                local_socket.close()
+                if http:
+                    fail_http_request(data.get('stream'), connection.qos_class, 'Local service unavailable')
+                else:
+                    sio.emit("close_connection", {'conn_id': conn_id})
+                return
+            set_service_health(tunnel, True)
         
-        try:
-            local_socket.connect(('127.0.0.1', local_port))
-            local_socket.settimeout(300.0)
-        except ConnectionRefusedError:
-            print(f"[!] Cannot connect to localhost:{local_port} - Is your service running?")
-            sio.emit("close_connection", {'conn_id': conn_id})
-            return
+        def write_failed(error):
+            print(f"[!] Error forwarding stream data: {error}")
+            send_close_connection(conn_id, connection.qos_class)
         
+        writer = StreamWriter(
+            local_socket, conn_id,
+            on_pause=lambda: signal_flow("pause_stream", conn_id),
+            on_resume=lambda: signal_flow("resume_stream", conn_id),
+            on_error=write_failed
+        )
+        # What was queued during the connect goes to the writer first, under
+        # the same lock forward_to_local takes, so stream order is kept.
         with local_connections_lock:
-            active_local_connections[conn_id] = {
-                'socket': local_socket,
-                'active': True
-            }
+            if not connection.active:
+                local_socket.close()
+                return
+            connection.socket = local_socket
+            connection.writer = writer
+            for frame in connection.pending:
+                writer.write(frame, block=False)
+            connection.pending = None
+        
+        if http:
+            threading.Thread(
+                target=relay_http_response, args=(tunnel, conn_id, connection, data),
+                name=f"http-relay-{conn_id}", daemon=True
+            ).start()
+            return
+        sio.emit("connection_ready", {'conn_id': conn_id})
         
         def read_from_local():
+            qos = 'interactive'
             try:
-                while True:
-                    with local_connections_lock:
-                        if conn_id not in active_local_connections or not active_local_connections[conn_id]['active']:
-                            break
+                # Ids are reused by the server, so this reader only ever
+                # looks at its own record, never at whatever holds its id now.
+                while connection.active:
+                    wait_while_paused(conn_id, connection)
+                    read_size = connection.read_size
+                    qos = connection.qos_class
                     
                     try:
-                        data = local_socket.recv(8192)
+                        data = local_socket.recv(read_size)
                         if not data:
                             print(f"[*] Local service closed connection {conn_id}")
                             break
                         
-                        data_b64 = base64.b64encode(data).decode('ascii')
-                        sio.emit("stream_response", {
-                            'conn_id': conn_id,
-                            'data': data_b64
-                        })
+                        send_stream_response(conn_id, data, qos)
                     except socket.timeout:
                         continue
                     except Exception as e:
                         print(f"[!] Error reading from local: {e}")
                         break
                 
-                sio.emit("close_connection", {'conn_id': conn_id})
+                send_close_connection(conn_id, qos)
             except Exception as e:
                 print(f"[!] Error in read_from_local: {e}")
             finally:
-                with local_connections_lock:
-                    if conn_id in active_local_connections:
-                        active_local_connections[conn_id]['active'] = False
+                connection.active = False
         
-        read_thread = threading.Thread(target=read_from_local, daemon=True)
+        read_thread = threading.Thread(target=read_from_local, name=f"local-reader-{conn_id}", daemon=True)
         read_thread.start()
         
     except Exception as e:
         print(f"[!] Error handling new connection {conn_id}: {e}")
-        sio.emit("close_connection", {'conn_id': conn_id})
+        discard()
+        if http:
+            fail_http_request(data.get('stream'), connection.qos_class, 'Local service error')
+        else:
+            sio.emit("close_connection", {'conn_id': conn_id})
+
+def buffer_early_frame(conn_id, frame):
+    # Called with local_connections_lock held. frame is None for a close.
+    now = time.monotonic()
+    entry = early_frames.get(conn_id)
+    if entry is None:
+        for key in [key for key, (expires, _, _) in early_frames.items() if expires < now]:
+            del early_frames[key]
+        entry = early_frames[conn_id] = [now + EARLY_DATA_TTL, 0, []]
+    size = len(frame) if frame else 0
+    if entry[1] + size > EARLY_DATA_MAX_BYTES:
+        print(f"[!] Dropping early data for connection {conn_id}: over {EARLY_DATA_MAX_BYTES} bytes")
+        return
+    entry[1] += size
+    entry[2].append(frame)
+
+def forward_to_local(conn_id, stream_data):
+    with local_connections_lock:
+        connection = active_local_connections.get(conn_id)
+        if connection is None:
+            # The new_connection for this id may still be on its way.
+            buffer_early_frame(conn_id, stream_data)
+            return
+        if connection.pending is not None:
+            connection.pending.append(stream_data)
+            return
+    if not connection.active:
+        print(f"[!] Connection {conn_id} not found or inactive")
+        return
+    # Queued for the connection's writer: this runs on the thread applying
+    # the server's batches, which must not wait for one slow local socket.
+    # A server that honours pause_stream is never blocked on; an older one
+    # is held up once the writer has STREAM_BUFFER_MAX bytes queued.
+    connection.writer.write(stream_data, block=not server_pauses)
 
 @sio.on("stream_data")
 def on_stream_data(data):
-    conn_id = data.get('conn_id')
     stream_data = data.get('data', '')
+    if isinstance(stream_data, str):
+        stream_data = base64.b64decode(stream_data)
+    forward_to_local(data.get('conn_id'), stream_data)
+
+def apply_stream_batch(data):
+    blob = data.get('data') or b''
+    if isinstance(blob, str):
+        blob = base64.b64decode(blob)
+    offset = 0
+    for conn_id, length in data.get('frames') or ():
+        if length == CLOSE_FRAME:
+            on_close_connection({'conn_id': conn_id})
+            continue
+        forward_to_local(conn_id, blob[offset:offset + length])
+        offset += length
+
+@sio.on("stream_batch")
+def on_stream_batch(data):
+    inbound_sequencer.submit(data)
+
+@sio.on("stream_batch_ack")
+def on_stream_batch_ack(data):
+    batcher = response_batcher
+    if batcher is not None:
+        batcher.ack(data.get('seq', -1))
+
+@sio.on("tune_connection")
+def on_tune_connection(data):
+    conn_id = data.get('conn_id')
+    options = data.get('socket_options') or {}
     
-    try:
-        if isinstance(stream_data, str):
-            stream_data = base64.b64decode(stream_data)
-        
-        with local_connections_lock:
-            if conn_id in active_local_connections and active_local_connections[conn_id]['active']:
-                local_socket = active_local_connections[conn_id]['socket']
-                local_socket.sendall(stream_data)
-            else:
-                print(f"[!] Connection {conn_id} not found or inactive")
-    except Exception as e:
-        print(f"[!] Error forwarding stream data: {e}")
-        sio.emit("close_connection", {'conn_id': conn_id})
+    with local_connections_lock:
+        connection = active_local_connections.get(conn_id)
+        if connection is not None and connection.active:
+            if connection.socket is not None:
+                apply_socket_options(connection.socket, options)
+            connection.read_size = options.get('read_size', 8192)
+            connection.qos_class = options.get('qos_class', 'interactive')
+            print(f"[*] Connection {conn_id} tuned for {data.get('profile')} traffic")
 
 @sio.on("close_connection")
 def on_close_connection(data):
     conn_id = data.get('conn_id')
     
     with local_connections_lock:
-        if conn_id in active_local_connections:
-            active_local_connections[conn_id]['active'] = False
-            try:
-                active_local_connections[conn_id]['socket'].close()
-            except:
-                pass
-            del active_local_connections[conn_id]
-            print(f"[-] Connection {conn_id} closed")
+        connection = active_local_connections.pop(conn_id, None)
+        if connection is None:
+            buffer_early_frame(conn_id, None)
+            return
+        connection.active = False
+        gate = paused_streams.pop(conn_id, None)
+    if gate is not None:
+        gate.set()
+    if connection.writer is not None:
+        # Data the server sent before the close is written out first.
+        connection.writer.finish(lambda: close_quietly(connection.socket))
+    print(f"[-] Connection {conn_id} closed")
+
+def close_quietly(sock):
+    try:
+        sock.close()
+    except:
+        pass
+
+@sio.on("pause_stream")
+def on_pause_stream(data):
+    paused_streams.setdefault(data.get('conn_id'), threading.Event())
+
+@sio.on("resume_stream")
+def on_resume_stream(data):
+    gate = paused_streams.pop(data.get('conn_id'), None)
+    if gate is not None:
+        gate.set()
 
 @sio.on("udp_packet")
 def on_udp_packet(data):
     session_id = data.get('session_id')
     packet_data = data.get('data', '')
+    tunnel = tunnels.get(data.get('tunnel_id'))
+    if tunnel is None:
+        return
     
     try:
         if isinstance(packet_data, str):
@@ -186,7 +1246,7 @@ def on_udp_packet(data):
         udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         udp_socket.settimeout(5)
         
-        udp_socket.sendto(packet_data, ('127.0.0.1', local_port))
+        udp_socket.sendto(packet_data, (tunnel.host, tunnel.port))
         
         def wait_for_response():
             try:
@@ -209,37 +1269,77 @@ def on_udp_packet(data):
     except Exception as e:
         print(f"[!] Error handling UDP packet: {e}")
 
+@sio.on("reconnect_required")
+def on_reconnect_required(data):
+    global server_restarting
+    # The server handed its listeners to a new process; reconnecting lands
+    # on the new process, which already accepts on our public port.
+    print(f"[*] Server asked us to reconnect ({data.get('reason', 'restart')})")
+    server_restarting = True
+    threading.Thread(target=sio.disconnect, daemon=True).start()
+
+def reconnect_after_restart():
+    global server_restarting
+    delay = 0.5
+    while True:
+        try:
+            sio.connect(server_url, transports=['websocket', 'polling'])
+            server_restarting = False
+            return
+        except Exception as e:
+            print(f"[!] Reconnect failed: {e}; retrying in {delay:.1f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
 @sio.on("disconnect")
 def on_disconnect():
-    global heartbeat_running
+    global heartbeat_running, response_batcher
     heartbeat_running = False
+    if response_batcher is not None:
+        response_batcher.close()
+        response_batcher = None
     
     with local_connections_lock:
-        for conn_id in list(active_local_connections.keys()):
-            try:
-                active_local_connections[conn_id]['socket'].close()
-            except:
-                pass
+        connections = list(active_local_connections.values())
         active_local_connections.clear()
+        early_frames.clear()
+    for connection in connections:
+        connection.active = False
+        if connection.writer is not None:
+            connection.writer.abort(lambda sock=connection.socket: close_quietly(sock))
+    for gate in list(paused_streams.values()):
+        gate.set()
+    paused_streams.clear()
+    with http_pool_lock:
+        for tunnel in tunnels.values():
+            for sock, _ in tunnel.http_pool:
+                sock.close()
+            tunnel.http_pool.clear()
     
     print("[-] Disconnected from tunnel server")
 
 try:
     print("[*] Starting tunnel client...")
     print(f"[*] Server: {server_url}")
-    print(f"[*] Tunnel ID: {tunnel_id}")
-    print(f"[*] Local Port: {local_port}")
+    for tunnel in tunnels.values():
+        print(f"[*] Tunnel {tunnel.id} -> {tunnel.host}:{tunnel.port}")
     print("[*] Connecting...\n")
+    install_debug_hooks()
     sio.connect(server_url, transports=['websocket', 'polling'])
-    sio.wait()
+    while True:
+        sio.wait()
+        if not server_restarting:
+            break
+        reconnect_after_restart()
 except KeyboardInterrupt:
     print("\n[*] Shutting down...")
     heartbeat_running = False
     
     with local_connections_lock:
-        for conn_id in list(active_local_connections.keys()):
+        for connection in active_local_connections.values():
+            connection.active = False
             try:
-                active_local_connections[conn_id]['socket'].close()
+                connection.socket.close()
             except:
                 pass
         active_local_connections.clear()
@@ -248,6 +1348,5 @@ except KeyboardInterrupt:
 except Exception as e:
     print(f"\n[!] Connection error: {e}")
     print("[!] Make sure the server is reachable and try again.")
-    import traceback
     traceback.print_exc()
     sys.exit(1)
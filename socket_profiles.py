@@ -0,0 +1,170 @@
+import socket
+import sys
+import time
+
+# Socket tuning profiles. "interactive" favours latency (SSH, RDP, games),
+# "bulk" favours throughput (downloads, backups). "auto" starts from the
+# default below and re-tunes each stream once StreamClassifier has seen
+# enough of its traffic. qos_class picks the outbound priority queue the
+# stream's data waits in (see batching.py).
+PROFILES = {
+    'interactive': {
+        'backlog': 128,
+        'nodelay': True,
+        'sndbuf': 64 * 1024,
+        'rcvbuf': 64 * 1024,
+        'keepalive': True,
+        'keepidle': 30,
+        'keepintvl': 10,
+        'keepcnt': 3,
+        'read_size': 4096,
+        'qos_class': 'interactive',
+    },
+    'bulk': {
+        'backlog': 512,
+        'nodelay': False,
+        'sndbuf': 1024 * 1024,
+        'rcvbuf': 1024 * 1024,
+        'keepalive': True,
+        'keepidle': 60,
+        'keepintvl': 20,
+        'keepcnt': 5,
+        'read_size': 65536,
+        'qos_class': 'bulk',
+    },
+}
+
+AUTO_DEFAULTS = {
+    'backlog': 256,
+    'nodelay': True,
+    'sndbuf': None,
+    'rcvbuf': 256 * 1024,
+    'keepalive': True,
+    'keepidle': 60,
+    'keepintvl': 15,
+    'keepcnt': 4,
+    'read_size': 16384,
+    'qos_class': 'interactive',
+}
+
+PROFILE_NAMES = ('auto', 'interactive', 'bulk', 'custom')
+QOS_CLASSES = ('interactive', 'bulk')
+DEFAULT_PROFILE = 'auto'
+
+MIN_READ_SIZE = 1024
+MAX_READ_SIZE = 1024 * 1024
+
+
+def resolve_profile(name, custom_options=None):
+    """Return the concrete option dict for a profile name.
+
+    Custom options are layered over the auto defaults so a custom profile
+    only needs to name the settings it changes.
+    """
+    if name in PROFILES:
+        options = dict(PROFILES[name])
+    else:
+        options = dict(AUTO_DEFAULTS)
+    if name == 'custom' and custom_options:
+        options.update({k: v for k, v in custom_options.items() if k in AUTO_DEFAULTS})
+    options['read_size'] = max(MIN_READ_SIZE, min(MAX_READ_SIZE, int(options['read_size'])))
+    return options
+
+
+def validate_custom_options(custom_options):
+    if not isinstance(custom_options, dict):
+        return 'socket_options must be an object'
+    for key, value in custom_options.items():
+        if key not in AUTO_DEFAULTS:
+            return f'Unknown socket option: {key}'
+        if key == 'qos_class':
+            if value not in QOS_CLASSES:
+                return f'qos_class must be one of: {", ".join(QOS_CLASSES)}'
+        elif key in ('nodelay', 'keepalive'):
+            if not isinstance(value, bool):
+                return f'{key} must be true or false'
+        elif value is not None and (not isinstance(value, int) or isinstance(value, bool) or value <= 0):
+            return f'{key} must be a positive integer'
+    return None
+
+
+def apply_listener_options(sock, options):
+    # Buffer sizes must be set before listen() for the window scale to be
+    # negotiated; accepted sockets inherit them.
+    _set_buffers(sock, options)
+    return options['backlog']
+
+
+def apply_stream_options(sock, options):
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if options['nodelay'] else 0)
+    except OSError:
+        pass
+    _set_buffers(sock, options)
+    _set_keepalive(sock, options)
+
+
+def _set_buffers(sock, options):
+    for key, opt in (('sndbuf', socket.SO_SNDBUF), ('rcvbuf', socket.SO_RCVBUF)):
+        if options.get(key):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, options[key])
+            except OSError:
+                pass
+
+
+def _set_keepalive(sock, options):
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1 if options['keepalive'] else 0)
+        if not options['keepalive']:
+            return
+        if sys.platform == 'win32':
+            sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, options['keepidle'] * 1000, options['keepintvl'] * 1000))
+            return
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, options['keepidle'])
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, options['keepidle'])
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, options['keepintvl'])
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, options['keepcnt'])
+    except (OSError, ValueError):
+        pass
+
+
+class StreamClassifier:
+    """Classifies a stream as interactive or bulk from its first seconds.
+
+    A stream that moves BULK_BYTES inside the window with mostly large
+    chunks is bulk; anything still undecided when the window closes is
+    treated as interactive. observe() returns the profile name exactly once,
+    when the decision is made, and None otherwise.
+    """
+
+    WINDOW = 2.0
+    BULK_BYTES = 512 * 1024
+    LARGE_CHUNK = 4096
+
+    __slots__ = ('started', 'total_bytes', 'chunks', 'large_chunks', 'decided')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.total_bytes = 0
+        self.chunks = 0
+        self.large_chunks = 0
+        self.decided = None
+
+    def observe(self, nbytes):
+        if self.decided is not None:
+            return None
+        self.total_bytes += nbytes
+        self.chunks += 1
+        if nbytes >= self.LARGE_CHUNK:
+            self.large_chunks += 1
+
+        if self.total_bytes >= self.BULK_BYTES and self.large_chunks * 2 >= self.chunks:
+            self.decided = 'bulk'
+        elif time.monotonic() - self.started >= self.WINDOW:
+            self.decided = 'interactive'
+        return self.decided
@@ -0,0 +1,109 @@
+"""Limit tests for AdmissionController, including its wait queue.
+
+Run with: python -m pytest tests
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import LIMITS, QUEUED, RESOURCES, TUNNEL_LIMITS, AdmissionController
+
+
+def controller(queue_timeout=0.5, **tunnel_limits):
+    return AdmissionController(
+        limits=dict(LIMITS), tunnel_limits=dict(TUNNEL_LIMITS, **tunnel_limits),
+        queue_timeout=queue_timeout, queue_size=8,
+    )
+
+
+def wait_until_queued(admission, count):
+    deadline = time.monotonic() + 2
+    while admission.metrics()['queued_now'] < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_rejects_over_a_tunnel_limit_without_waiting():
+    admission = controller(streams=1)
+    assert admission.admit_stream(1, wait=False) is None
+    assert admission.admit_stream(1, wait=False) == 'tunnel_streams'
+    assert admission.admit_stream(2, wait=False) is None
+
+
+def test_queued_stream_is_admitted_when_capacity_frees():
+    admission = controller(streams=1)
+    assert admission.try_admit_stream(1) is None
+    assert admission.try_admit_stream(1) == QUEUED
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(admission.wait_stream(1)))
+    waiter.start()
+    wait_until_queued(admission, 1)
+    admission.release_stream(1, pending=True)
+    waiter.join(2)
+
+    assert result == [None]
+    assert admission.metrics()['tunnels'][1]['streams'] == 1
+
+
+def test_queued_stream_keeps_the_tunnel_limit_after_the_tunnel_goes_idle():
+    # Releasing A leaves the tunnel idle, which drops its usage entry; B must
+    # be counted in the entry C is checked against, not in the dropped one.
+    admission = controller(streams=1)
+    assert admission.try_admit_stream(1) is None
+    assert admission.try_admit_stream(1) == QUEUED
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(admission.wait_stream(1)))
+    waiter.start()
+    wait_until_queued(admission, 1)
+    admission.release_stream(1, pending=True)
+    waiter.join(2)
+    assert result == [None]
+
+    assert admission.try_admit_stream(1) == QUEUED
+    assert admission.wait_stream(1) is not None
+    metrics = admission.metrics()
+    assert metrics['tunnels'][1]['streams'] == 1
+    assert metrics['totals']['streams'] == 1
+
+
+def test_byte_waiters_never_exceed_the_tunnel_budget():
+    admission = controller(buffered_bytes=100)
+    held = []
+    peak = []
+    lock = threading.Lock()
+
+    def reader():
+        for _ in range(50):
+            assert admission.reserve_bytes(1, 60) is None
+            with lock:
+                held.append(60)
+                peak.append(sum(held))
+            time.sleep(0.0005)
+            with lock:
+                held.remove(60)
+            admission.release_bytes(1, 60)
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert max(peak) <= 100
+    metrics = admission.metrics()
+    assert all(metrics['totals'][resource] == 0 for resource in RESOURCES)
+    assert 1 not in metrics['tunnels']
+
+
+def test_queued_waiter_times_out_with_the_blocking_reason():
+    admission = controller(queue_timeout=0.05, streams=1)
+    assert admission.admit_stream(1) is None
+    assert admission.admit_stream(1) == 'tunnel_streams'
+    metrics = admission.metrics()
+    assert metrics['decisions']['stream'] == {'admitted': 1, 'queued': 1, 'rejected': 1}
+    assert metrics['queued_now'] == 0
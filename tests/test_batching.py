@@ -0,0 +1,229 @@
+"""Ordering tests for stream batching: OutboundBatcher, BatchSequencer, StreamWriter.
+
+Run with: python -m pytest tests
+"""
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import batching
+from batching import BULK, INTERACTIVE, BatchSequencer, OutboundBatcher, StreamWriter, iter_batch
+
+
+class Collector:
+    """emit() target that records every batch."""
+
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+
+    def __call__(self, payload):
+        with self.lock:
+            self.batches.append(payload)
+
+    def frames(self):
+        with self.lock:
+            batches = list(self.batches)
+        return [frame for payload in batches for frame in iter_batch(payload)]
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.005)
+
+
+def stream_bytes(frames, conn_id):
+    return b''.join(data for cid, data in frames if cid == conn_id and data is not None)
+
+
+def test_batcher_keeps_per_stream_order_across_batches():
+    emit = Collector()
+    batcher = OutboundBatcher(emit, 'test', max_bytes=4096, max_delay=0.001)
+    expected = {conn_id: b'' for conn_id in range(1, 6)}
+    try:
+        for i in range(200):
+            conn_id = i % 5 + 1
+            chunk = bytes([i % 256]) * random.randint(1, 3000)
+            expected[conn_id] += chunk
+            batcher.send(conn_id, chunk, qos=BULK if conn_id % 2 else INTERACTIVE)
+        total = sum(len(data) for data in expected.values())
+        wait_until(lambda: batcher.bytes_sent == total)
+    finally:
+        batcher.close()
+
+    assert [payload['seq'] for payload in emit.batches] == list(range(len(emit.batches)))
+    assert len(emit.batches) > 1
+    frames = emit.frames()
+    for conn_id, data in expected.items():
+        assert stream_bytes(frames, conn_id) == data
+
+
+def test_batcher_close_follows_data_even_when_reclassified():
+    emit = Collector()
+    batcher = OutboundBatcher(emit, 'test', max_bytes=1024, max_delay=0.05)
+    try:
+        # Bulk data is still queued when the stream turns interactive; its
+        # close must not jump ahead of it.
+        batcher.send(7, b'a' * 5000, qos=BULK)
+        batcher.send(8, b'b' * 10, qos=INTERACTIVE)
+        batcher.send_close(7, qos=INTERACTIVE)
+        wait_until(lambda: any(data is None for _, data in emit.frames()))
+    finally:
+        batcher.close()
+
+    frames = [(cid, data) for cid, data in emit.frames() if cid == 7]
+    assert frames[-1] == (7, None)
+    assert stream_bytes(frames, 7) == b'a' * 5000
+
+
+def test_batcher_splits_large_writes_into_chunks():
+    emit = Collector()
+    batcher = OutboundBatcher(emit, 'test', max_delay=0.001)
+    data = os.urandom(batching.CHUNK_BYTES * 3 + 17)
+    try:
+        batcher.send(1, data)
+        wait_until(lambda: batcher.bytes_sent == len(data))
+    finally:
+        batcher.close()
+
+    frames = emit.frames()
+    assert max(len(chunk) for _, chunk in frames) <= batching.CHUNK_BYTES
+    assert stream_bytes(frames, 1) == data
+
+
+def test_sequencer_applies_out_of_order_batches_in_order():
+    applied = []
+    sequencer = BatchSequencer(lambda payload: applied.append(payload['seq']))
+    for seq in (2, 0, 3, 1, 5, 4):
+        sequencer.submit({'seq': seq, 'frames': []})
+    assert applied == [0, 1, 2, 3, 4, 5]
+
+
+def test_sequencer_orders_concurrent_submitters():
+    applied = []
+    sequencer = BatchSequencer(lambda payload: applied.append(payload['seq']))
+    payloads = [{'seq': seq, 'frames': []} for seq in range(500)]
+    random.shuffle(payloads)
+    threads = [
+        threading.Thread(target=lambda part=payloads[i::8]: [sequencer.submit(p) for p in part])
+        for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert applied == list(range(500))
+
+
+def test_sequencer_acks_after_ack_bytes():
+    acks = []
+    sequencer = BatchSequencer(lambda payload: None, ack=acks.append, ack_bytes=100)
+    for seq in range(6):
+        sequencer.submit({'seq': seq, 'frames': [[1, 40], [2, batching.CLOSE_FRAME]]})
+    assert acks == [2, 5]
+
+
+def read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def test_writer_preserves_order_and_runs_finish_after_data():
+    left, right = socket.socketpair()
+    writer = StreamWriter(left, 'test')
+    expected = b''
+    for i in range(100):
+        chunk = bytes([i]) * 5000
+        expected += chunk
+        assert writer.write(chunk)
+    finished = threading.Event()
+    writer.finish(lambda: (left.close(), finished.set()))
+
+    assert read_all(right) == expected
+    assert finished.wait(5)
+    right.close()
+
+
+def test_writer_pauses_and_resumes_around_buffer_marks(monkeypatch):
+    monkeypatch.setattr(batching, 'STREAM_BUFFER_HIGH', 64 * 1024)
+    monkeypatch.setattr(batching, 'STREAM_BUFFER_LOW', 16 * 1024)
+    left, right = socket.socketpair()
+    events = []
+    writer = StreamWriter(left, 'test', on_pause=lambda: events.append('pause'),
+                          on_resume=lambda: events.append('resume'))
+    # Nobody reads `right` yet, so the writer backs up past the high mark.
+    for _ in range(64):
+        writer.write(b'x' * 16384, block=False)
+    wait_until(lambda: events == ['pause'])
+
+    received = 0
+    while received < 64 * 16384:
+        received += len(right.recv(65536))
+    wait_until(lambda: events == ['pause', 'resume'])
+    writer.abort(left.close)
+    right.close()
+
+
+def test_writer_nonblocking_write_never_waits_for_reader(monkeypatch):
+    monkeypatch.setattr(batching, 'STREAM_BUFFER_MAX', 32 * 1024)
+    left, right = socket.socketpair()
+    writer = StreamWriter(left, 'test')
+    start = time.monotonic()
+    for _ in range(200):
+        assert writer.write(b'y' * 8192, block=False)
+    assert time.monotonic() - start < 1.0
+    writer.abort(left.close)
+    right.close()
+
+
+def test_writer_abort_drops_data_and_runs_callbacks():
+    left, right = socket.socketpair()
+    writer = StreamWriter(left, 'test')
+    for _ in range(200):
+        writer.write(b'z' * 65536, block=False)
+    finished, aborted = threading.Event(), threading.Event()
+    writer.finish(finished.set)
+    writer.abort(lambda: (left.close(), aborted.set()))
+    assert aborted.wait(5) and finished.wait(5)
+    assert not writer.write(b'late')
+    right.close()
+
+
+def test_close_after_data_through_batcher_sequencer_and_writer():
+    """Data queued right before a close reaches the socket in full, then EOF."""
+    left, right = socket.socketpair()
+    writer = StreamWriter(left, 'test')
+
+    def apply(payload):
+        for conn_id, data in iter_batch(payload):
+            if data is None:
+                writer.finish(left.close)
+            else:
+                writer.write(data, block=False)
+
+    sequencer = BatchSequencer(apply)
+    # Deliver each batch on its own thread, as Socket.IO does.
+    emit = lambda payload: threading.Thread(target=sequencer.submit, args=(payload,)).start()
+    batcher = OutboundBatcher(emit, 'test', max_bytes=8192, max_delay=0.001)
+    expected = os.urandom(300000)
+    try:
+        for offset in range(0, len(expected), 1000):
+            batcher.send(1, expected[offset:offset + 1000])
+        batcher.send_close(1)
+        right.settimeout(10)
+        assert read_all(right) == expected
+    finally:
+        batcher.close()
+        right.close()
@@ -0,0 +1,107 @@
+"""Ring buffer tests for TrafficRecorder and read_recording.
+
+Run with: python -m pytest tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from recording import (
+    CLOSE, DATA_IN, DATA_OUT, EVENT, HEADER_SIZE, OPEN, TrafficRecorder, read_recording
+)
+
+
+def payloads(events):
+    return [payload for _, _, _, _, payload in events]
+
+
+def test_reads_back_events_in_order(tmp_path):
+    path = str(tmp_path / 'small.rec')
+    recorder = TrafficRecorder(path, max_bytes=64 * 1024)
+    recorder.record(OPEN, 'a')
+    recorder.record(DATA_IN, 'a', b'request')
+    recorder.record(OPEN, 'b')
+    recorder.record(DATA_OUT, 'a', b'response')
+    recorder.record(CLOSE, 'a')
+    recorder.close()
+
+    header, events = read_recording(path)
+    assert header['events'] == 5
+    assert header['overwritten_events'] == 0
+    assert [(kind, stream) for _, kind, stream, _, _ in events] == [
+        (OPEN, 0), (DATA_IN, 0), (OPEN, 1), (DATA_OUT, 0), (CLOSE, 0)
+    ]
+    assert payloads(events) == [b'', b'request', b'', b'response', b'']
+    times = [seconds for seconds, _, _, _, _ in events]
+    assert times == sorted(times)
+
+
+def test_ring_wraps_and_keeps_the_newest_events(tmp_path):
+    path = str(tmp_path / 'ring.rec')
+    recorder = TrafficRecorder(path, max_bytes=HEADER_SIZE + 4096)
+    written = [b'%06d' % i + b'x' * 30 for i in range(1000)]
+    for payload in written:
+        recorder.record(DATA_IN, 'a', payload)
+    status = recorder.status()
+    recorder.close()
+
+    assert os.path.getsize(path) == HEADER_SIZE + 4096
+    header, events = read_recording(path)
+    kept = payloads(events)
+    assert 0 < len(kept) < len(written)
+    assert kept == written[-len(kept):]
+    assert header['overwritten_events'] == len(written) - len(kept)
+    assert status['retained_events'] == len(kept)
+    assert status['events'] == len(written)
+
+
+def test_varied_sizes_keep_a_contiguous_suffix(tmp_path):
+    path = str(tmp_path / 'sizes.rec')
+    capacity = 2048
+    recorder = TrafficRecorder(path, max_bytes=HEADER_SIZE + capacity)
+    rng = random.Random(7)
+    written = []
+    for i in range(500):
+        payload = (b'%05d' % i) * rng.randint(1, 60)
+        written.append(payload)
+        recorder.record(DATA_OUT, 'a', payload)
+        if i % 50 == 49:
+            _, events = read_recording(path)
+            kept = payloads(events)
+            assert kept and kept == written[-len(kept):]
+            assert sum(EVENT.size + len(payload) for payload in kept) <= capacity
+    recorder.close()
+
+
+def test_truncates_payloads_but_keeps_their_length(tmp_path):
+    path = str(tmp_path / 'shape.rec')
+    recorder = TrafficRecorder(path, max_bytes=64 * 1024, payload_limit=4)
+    recorder.record(DATA_IN, 'a', b'0123456789')
+    recorder.record(DATA_IN, 'a', b'abc')
+    recorder.close()
+
+    header, events = read_recording(path)
+    assert header['payload_limit'] == 4
+    assert [(length, payload) for _, _, _, length, payload in events] == [(10, b'0123'), (3, b'abc')]
+
+
+def test_skips_events_larger_than_the_ring(tmp_path):
+    path = str(tmp_path / 'big.rec')
+    recorder = TrafficRecorder(path, max_bytes=HEADER_SIZE + 1024)
+    recorder.record(DATA_IN, 'a', b'small')
+    recorder.record(DATA_IN, 'a', b'x' * 4096)
+    recorder.close()
+
+    _, events = read_recording(path)
+    assert payloads(events) == [b'small']
+
+
+def test_rejects_files_that_are_not_recordings(tmp_path):
+    path = tmp_path / 'other.rec'
+    path.write_bytes(b'\0' * HEADER_SIZE)
+    with pytest.raises(ValueError):
+        read_recording(str(path))
@@ -0,0 +1,252 @@
+import atexit
+import os
+import threading
+import time
+from sqlalchemy import delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from datetime import datetime, timedelta
+from models import get_session, TrafficRollup, TunnelSession
+
+RESOLUTIONS = {'1m': 60, '1h': 3600, '1d': 86400}
+
+FLUSH_INTERVAL = float(os.getenv('TRAFFIC_FLUSH_INTERVAL', '10'))
+PRUNE_INTERVAL = 3600
+
+# How long each rollup resolution is kept, in seconds. Finer buckets expire
+# first; coarser ones keep the long-term history for capacity planning.
+RETENTION = {
+    60: int(os.getenv('TRAFFIC_RETENTION_1M', str(2 * 86400))),
+    3600: int(os.getenv('TRAFFIC_RETENTION_1H', str(90 * 86400))),
+    86400: int(os.getenv('TRAFFIC_RETENTION_1D', str(730 * 86400))),
+}
+SESSION_RETENTION = int(os.getenv('SESSION_RETENTION', str(30 * 86400)))
+
+COUNTER_FIELDS = ('bytes_in', 'bytes_out', 'connections', 'udp_packets', 'errors')
+
+
+class TrafficAccountant:
+    """Aggregates per-tunnel traffic in memory and flushes it in batches.
+
+    The proxy hot path only touches an in-memory counter list. A background
+    thread folds those counters into 1 minute / 1 hour / 1 day rollups with a
+    single upsert per flush and periodically prunes expired buckets.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # (tunnel_id, minute) -> [bytes_in, bytes_out, connections, udp_packets, errors]
+        self._pending = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._last_prune = 0
+
+    def record(self, tunnel_id, bytes_in=0, bytes_out=0, connections=0, udp_packets=0, errors=0):
+        key = (tunnel_id, int(time.time()) // 60)
+        with self._lock:
+            counters = self._pending.get(key)
+            if counters is None:
+                counters = self._pending[key] = [0, 0, 0, 0, 0]
+            counters[0] += bytes_in
+            counters[1] += bytes_out
+            counters[2] += connections
+            counters[3] += udp_packets
+            counters[4] += errors
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._flush_loop, name='traffic-flusher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        print(f'[*] Traffic accounting started (flush every {self.flush_interval}s)')
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+            if time.time() - self._last_prune >= PRUNE_INTERVAL:
+                self.prune()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if not pending:
+            return 0
+
+        rows = {}
+        for (tunnel_id, minute), counters in pending.items():
+            ts = minute * 60
+            for resolution in RESOLUTIONS.values():
+                key = (tunnel_id, resolution, ts - ts % resolution)
+                row = rows.get(key)
+                if row is None:
+                    rows[key] = list(counters)
+                else:
+                    for i, value in enumerate(counters):
+                        row[i] += value
+
+        params = [
+            dict(zip(COUNTER_FIELDS, counters), tunnel_id=tunnel_id, resolution=resolution, bucket_start=bucket_start)
+            for (tunnel_id, resolution, bucket_start), counters in rows.items()
+        ]
+        stmt = insert(TrafficRollup)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['tunnel_id', 'resolution', 'bucket_start'],
+            set_={field: getattr(TrafficRollup, field) + getattr(stmt.excluded, field) for field in COUNTER_FIELDS}
+        )
+
+        session = get_session()
+        try:
+            session.execute(stmt, params)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[!] Error flushing traffic stats: {e}')
+            self._restore(pending)
+            return 0
+        finally:
+            session.close()
+        return len(params)
+
+    def _restore(self, pending):
+        with self._lock:
+            for key, counters in pending.items():
+                current = self._pending.get(key)
+                if current is None:
+                    self._pending[key] = counters
+                else:
+                    for i, value in enumerate(counters):
+                        current[i] += value
+
+    def prune(self):
+        now = int(time.time())
+        self._last_prune = now
+        session = get_session()
+        try:
+            for resolution, retention in RETENTION.items():
+                session.execute(
+                    delete(TrafficRollup)
+                    .where(TrafficRollup.resolution == resolution)
+                    .where(TrafficRollup.bucket_start < now - retention)
+                )
+            session.execute(
+                delete(TunnelSession)
+                .where(TunnelSession.is_active == False)
+                .where(TunnelSession.disconnected_at < datetime.utcnow() - timedelta(seconds=SESSION_RETENTION))
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f'[!] Error pruning traffic stats: {e}')
+        finally:
+            session.close()
+
+    def _pending_rows(self, resolution, tunnel_id=None, since=None, until=None):
+        """Unflushed counters folded into buckets, limited to those the range selects from the table."""
+        first = None if since is None else since - since % resolution
+        with self._lock:
+            snapshot = [(key, list(counters)) for key, counters in self._pending.items()]
+        rows = {}
+        for (tid, minute), counters in snapshot:
+            if tunnel_id is not None and tid != tunnel_id:
+                continue
+            ts = minute * 60
+            bucket_start = ts - ts % resolution
+            if (first is not None and bucket_start < first) or (until is not None and bucket_start > until):
+                continue
+            key = (tid, bucket_start)
+            row = rows.setdefault(key, [0, 0, 0, 0, 0])
+            for i, value in enumerate(counters):
+                row[i] += value
+        return rows
+
+    def query_series(self, tunnel_id, resolution=None, since=None, until=None):
+        now = int(time.time())
+        until = now if until is None else int(until)
+        since = until - 3600 if since is None else int(since)
+        if resolution is None:
+            resolution = pick_resolution(until - since)
+
+        session = get_session()
+        try:
+            result = session.execute(
+                select(TrafficRollup)
+                .where(TrafficRollup.tunnel_id == tunnel_id)
+                .where(TrafficRollup.resolution == resolution)
+                .where(TrafficRollup.bucket_start >= since - since % resolution)
+                .where(TrafficRollup.bucket_start <= until)
+                .order_by(TrafficRollup.bucket_start)
+            ).scalars()
+            series = {
+                r.bucket_start: [getattr(r, field) for field in COUNTER_FIELDS]
+                for r in result
+            }
+        finally:
+            session.close()
+
+        for (_, bucket_start), counters in self._pending_rows(resolution, tunnel_id, since, until).items():
+            row = series.setdefault(bucket_start, [0, 0, 0, 0, 0])
+            for i, value in enumerate(counters):
+                row[i] += value
+
+        return {
+            'tunnel_id': tunnel_id,
+            'resolution': resolution,
+            'since': since,
+            'until': until,
+            'points': [
+                dict(zip(COUNTER_FIELDS, series[bucket_start]), bucket_start=bucket_start)
+                for bucket_start in sorted(series)
+            ]
+        }
+
+    def query_totals(self, since=None, until=None):
+        # Daily rollups are the coarsest table, so totals stay cheap no
+        # matter how much minute-level history is kept.
+        resolution = RESOLUTIONS['1d']
+        since = None if since is None else int(since)
+        until = None if until is None else int(until)
+        session = get_session()
+        try:
+            stmt = (
+                select(TrafficRollup.tunnel_id, *[func.sum(getattr(TrafficRollup, field)) for field in COUNTER_FIELDS])
+                .where(TrafficRollup.resolution == resolution)
+            )
+            if since is not None:
+                stmt = stmt.where(TrafficRollup.bucket_start >= since - since % resolution)
+            if until is not None:
+                stmt = stmt.where(TrafficRollup.bucket_start <= until)
+            stmt = stmt.group_by(TrafficRollup.tunnel_id)
+            totals = {row[0]: [value or 0 for value in row[1:]] for row in session.execute(stmt)}
+        finally:
+            session.close()
+
+        for (tunnel_id, _), counters in self._pending_rows(resolution, since=since, until=until).items():
+            row = totals.setdefault(tunnel_id, [0, 0, 0, 0, 0])
+            for i, value in enumerate(counters):
+                row[i] += value
+
+        return [
+            dict(zip(COUNTER_FIELDS, counters), tunnel_id=tunnel_id)
+            for tunnel_id, counters in sorted(totals.items())
+        ]
+
+
+def pick_resolution(span):
+    if span <= 6 * 3600:
+        return RESOLUTIONS['1m']
+    if span <= 14 * 86400:
+        return RESOLUTIONS['1h']
+    return RESOLUTIONS['1d']
+
+
+traffic_accountant = TrafficAccountant()